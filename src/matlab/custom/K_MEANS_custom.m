@@ -22,6 +22,7 @@ classdef K_MEANS_custom< matlab.mixin.Copyable
             cluster.PARA.cluster_variable_class_index = [];
             cluster.PARA.cluster_variable_scaling = [];  % ability to force a variable to me more important than the others
             cluster.PARA.cluster_variable_scaling_index = []; 
+            cluster.PARA.precomputed_clusters_file = [];  % e.g. clusters.mat in the forcing folder (written in Python), empty to cluster here
         end
         
         function cluster = provide_STATVAR(cluster)
@@ -39,6 +40,13 @@ classdef K_MEANS_custom< matlab.mixin.Copyable
          function cluster = compute_clusters(cluster)
             n_clusters = cluster.PARA.number_of_clusters;
 
+            % LUKE: use the clusters precomputed in Python (clustering.precompute_clusters) if they are set and match
+            fname = get_precomputed_clusters_file(cluster);
+            if ~isempty(fname)
+                cluster = load_precomputed_clusters(cluster, fname);
+                return
+            end
+
             data_cube = [];
             for i=1:size(cluster.PARA.cluster_variable_class,1)
                 cluster_variable_class = copy(cluster.RUN_INFO.PPROVIDER.CLASSES.(cluster.PARA.cluster_variable_class{i,1}){cluster.PARA.cluster_variable_class_index(i,1),1});
@@ -80,6 +88,141 @@ classdef K_MEANS_custom< matlab.mixin.Copyable
             cluster.STATVAR.cluster_number = cn;
             cluster.STATVAR.sample_centroid_index = indsc;
          end
+
+
+         function fname = get_precomputed_clusters_file(cluster)
+            % the file in PARA.precomputed_clusters_file (absolute or relative to the
+            % forcing folder) - empty if it is not set, does not exist, was not
+            % computed with the number of clusters, cluster variables and scaling
+            % of PARA and the current geospatial_data.nc, or has no cluster for
+            % some gridcells (excluded or NaN in Python)
+            fname = cluster.PARA.precomputed_clusters_file;
+            if isempty(fname) || ~ischar(fname)
+                fname = [];
+                return
+            end
+            forcing_path = fullfile(cluster.RUN_INFO.PPROVIDER.PARA.result_path, cluster.RUN_INFO.PPROVIDER.PARA.run_name, 'forcing');
+            if ~exist(fname, 'file')
+                fname = fullfile(forcing_path, fname);
+            end
+            if ~exist(fname, 'file')
+                disp(sprintf('%s does not exist, computing the clusters', fname));
+                fname = [];
+                return
+            end
+
+            info = load(fname, 'n_clusters', 'signature', 'scaling', 'exclude', 'geospatial_bytes', 'geospatial_mtime');
+            geo = dir(fullfile(forcing_path, 'geospatial_data.nc'));
+            reason = [];
+            if ~all(isfield(info, {'signature', 'scaling', 'exclude', 'geospatial_bytes', 'geospatial_mtime'}))
+                reason = 'written by an older version';
+            elseif info.n_clusters ~= cluster.PARA.number_of_clusters
+                reason = sprintf('k=%d, but number_of_clusters=%d', info.n_clusters, cluster.PARA.number_of_clusters);
+            elseif ~strcmp(info.signature, get_cluster_signature(cluster))
+                reason = sprintf('cluster variables %s, but %s', info.signature, get_cluster_signature(cluster));
+            elseif any(abs(info.scaling(:)' - get_cluster_scaling(cluster, numel(info.scaling))) > 1e-6)
+                reason = 'the cluster_variable_scaling differs';
+            elseif isempty(geo) || geo.bytes ~= info.geospatial_bytes
+                reason = 'geospatial_data.nc has changed since';
+            else
+                % dir gives the local modification time, Python the POSIX time
+                geo_mtime = posixtime(datetime(geo.datenum, 'ConvertFrom', 'datenum', 'TimeZone', 'local'));
+                if abs(geo_mtime - info.geospatial_mtime) > 1
+                    reason = 'geospatial_data.nc has changed since';
+                end
+            end
+            if isempty(reason)
+                % pixels excluded in Python (info.exclude) or with a NaN variable have no cluster
+                pre = load(fname, 'x', 'y', 'cluster_number');
+                [~, n_missing] = get_precomputed_index(cluster, pre);
+                if n_missing > 0
+                    exclude = info.exclude;
+                    if isempty(exclude)
+                        exclude = 'none';
+                    end
+                    reason = sprintf('%d gridcells have no cluster, excluded: %s', n_missing, exclude);
+                end
+            end
+            if ~isempty(reason)
+                disp(sprintf('ignoring %s (%s), computing the clusters', fname, reason));
+                fname = [];
+            end
+         end
+
+
+         function signature = get_cluster_signature(cluster)
+            % the cluster variable classes (with their variables if they have any),
+            % as written by clustering.get_cluster_config in Python
+            signature = '';
+            for i=1:size(cluster.PARA.cluster_variable_class,1)
+                name = cluster.PARA.cluster_variable_class{i,1};
+                index = cluster.PARA.cluster_variable_class_index(i,1);
+                signature = [signature sprintf('%s_%d', name, index)];
+                variable_class = cluster.RUN_INFO.PPROVIDER.CLASSES.(name){index,1};
+                if isfield(variable_class.PARA, 'variables')
+                    variables = variable_class.PARA.variables;
+                    signature = [signature '(' strjoin(variables(:)', ',') ')'];
+                end
+                signature = [signature ';'];
+            end
+         end
+
+
+         function scaling = get_cluster_scaling(cluster, n_columns)
+            % the factor of each column, as in compute_clusters
+            scaling = ones(1, n_columns);
+            for k = 1:size(cluster.PARA.cluster_variable_scaling_index)
+                scaling(1, cluster.PARA.cluster_variable_scaling_index(k)) = cluster.PARA.cluster_variable_scaling(k);
+            end
+         end
+
+
+         function cluster = load_precomputed_clusters(cluster, fname)
+            % the cluster number and distance to the centroid of each gridcell are
+            % looked up on the grid of the precomputed clusters by coordinates
+            % (get_precomputed_clusters_file checked that each gridcell has one)
+            disp(sprintf('loading precomputed clusters from %s', fname));
+            pre = load(fname);
+            ind = get_precomputed_index(cluster, pre);
+
+            cn = double(pre.cluster_number(ind));
+            D = double(pre.distance(ind));
+
+            % clusters without gridcells (e.g. masked in MATLAB only) are dropped
+            [~, ~, cn] = unique(cn);
+            n_clusters = max(cn);
+
+            % the gridcell closest to the centroid of each cluster (as in compute_clusters)
+            indsc = zeros(n_clusters, 1);
+            ind = (1:numel(cn))';
+            for j=1:n_clusters
+                these = (cn==j);
+                indc = ind(these);
+                Dc = D(these);
+                here = (Dc==min(Dc));
+                indsc(j) = min(indc(here));
+            end
+            cluster.STATVAR.cluster_number = cn;
+            cluster.STATVAR.sample_centroid_index = indsc;
+         end
+        
+        
+         
+         function [ind, n_missing] = get_precomputed_index(cluster, pre)
+            % the index of each gridcell in the grid of the precomputed clusters
+            % (by coordinates), and the number of gridcells outside of the grid or
+            % without a cluster (cluster_number 0)
+            dx = pre.x(2) - pre.x(1);
+            dy = pre.y(2) - pre.y(1);
+            col = round((cluster.RUN_INFO.SPATIAL.STATVAR.coord_x(:) - pre.x(1)) ./ dx) + 1;
+            row = round((cluster.RUN_INFO.SPATIAL.STATVAR.coord_y(:) - pre.y(1)) ./ dy) + 1;
+            inside = col >= 1 & col <= numel(pre.x) & row >= 1 & row <= numel(pre.y);
+            ind = zeros(size(col));
+            ind(inside) = sub2ind(size(pre.cluster_number), row(inside), col(inside));
+            covered = inside;
+            covered(inside) = pre.cluster_number(ind(inside)) >= 1;
+            n_missing = sum(~covered);
+         end
         
         
          
@@ -95,6 +238,8 @@ classdef K_MEANS_custom< matlab.mixin.Copyable
              cluster.PARA.comment.max_iterations = {'maximum number of interations, interrupts k-means algorithm if no convergence is reached'};
              cluster.PARA.default_value.max_iterations = {1000};
              
+             cluster.PARA.comment.precomputed_clusters_file = {'clusters computed in Python (relative to the forcing folder, e.g. clusters.mat), only used if they match this config, default: empty (compute here)'};
+
              cluster.PARA.comment.cluster_variable_class = {'list of classes providing the data to which the clustering is applied'};
              cluster.PARA.options.cluster_variable_class.name = 'H_LIST';
              cluster.PARA.options.cluster_variable_class.entries_x = {'CLUSTER_RAW_VARIABLES' 'CLUSTER_SLOPE_ASPECT'};
@@ -1,5 +1,4 @@
 import pathlib
-from functools import lru_cache
 from typing import Union
 
 import matplotlib.pyplot as plt
@@ -218,80 +217,13 @@ def get_bbox(fpath: pathlib.Path) -> list[str]:
     return bbox
 
 
-@lru_cache
-def get_era5_from_s3_bucket(bbox: tuple, time_start: str, time_end: str):
-    from copy import deepcopy
-
-    import dotenv
-    import pandas as pd
-    import xarray as xr
-
-    bbox = list(deepcopy(bbox))
-
-    if not dotenv.load_dotenv():
-        raise FileNotFoundError("Could not find .env file with S3 credentials")
-
-    t0 = pd.Timestamp(time_start)
-    t1 = pd.Timestamp(time_end)
-    year0 = t0.year
-    year1 = t1.year
-
-    fname_era5_s3 = (
-        "s3://spi-pamir-c7-sdsc/era5_data/central_asia/central_asia-{year}.zarr"
-    )
-    flist_era5_zarr = [
-        fname_era5_s3.format(year=year) for year in range(year0, year1 + 1)
-    ]
-
-    ds_central_asia = xr.open_mfdataset(
-        flist_era5_zarr,
-        parallel=True,
-        engine="zarr",
-        combine="by_coords",  # combines by time dime
-        compat="override",  # fastest option
-        coords="all",  # keep all coordinates
-    )  # make sure that .env is set up correctly
-
-    logger.info(
-        f"Downloading ERA5 data for bbox {bbox} from {time_start} to {time_end}"
-    )
-
-    ds = (
-        ds_central_asia.sel(  # contains all central asia data from 1940 to 2024-10-01
-            time=slice(time_start, time_end)
-        )  # there are some values in 1959-01-01 that are nans
-        .rio.write_crs(4326)  # set the crs to epsg:4326 so we can clip using rioxarray
-        .rename(z_surf="Zs")  # prepare for the cg.era5_to_matlab function
-    )
-
-    # clip to our bbox
-    ds_bbox = ds.rio.clip_box(*bbox, crs="epsg:4326", allow_one_dimensional_raster=True)
-
-    if ds_bbox.latitude.size == 0 or ds_bbox.longitude.size == 0:
-        raise ValueError(
-            f"Could not find any data for bbox {bbox} from {time_start} to {time_end}"
-        )
-
-    if ds_bbox.latitude.size <= 1 or ds_bbox.longitude.size <= 1:
-        logger.warning(
-            f"Only one point found for bbox {bbox}, expanding the bbox to include more data"
-        )
-        if ds_bbox.latitude.size <= 1:
-            # expand_bbox to have two points
-            bbox[1] -= 0.2
-            bbox[3] += 0.2
-        if ds_bbox.longitude.size <= 1:
-            bbox[0] -= 0.2
-            bbox[2] += 0.2
-
-        ds_bbox = ds.rio.clip_box(*bbox, crs="epsg:4326").isel(
-            latitude=slice(0, 2), longitude=slice(0, 2)
-        )
-
-    # load the data into memory (takes ~20 secs with fast connection)
-    ds_bbox = ds_bbox.load()
+def get_era5_from_s3_bucket(
+    bbox: tuple, time_start: str, time_end: str, use_cache=False
+):
+    # shares the on-disk ERA5 cache with the templater package
+    from .templater.data import get_era5_from_s3_bucket
 
-    return ds_bbox
+    return get_era5_from_s3_bucket(tuple(bbox), time_start, time_end, use_cache)
 
 
 def get_geospatial_data(bbox: tuple, n_land_classes=3) -> xr.Dataset:
@@ -416,12 +348,14 @@ def plot_geospatial_data(ds: xr.Dataset) -> tuple[plt.Figure, plt.Axes]:
 
 
 def get_google_scene(ds):
+    from .templater.reproject import reproject_with_plan
     from .viz.google_maps_getter import GoogleScene
 
     bbox = [float(f) for f in ds.elevation.rv.get_bbox_latlon()]
     scene = GoogleScene(bbox)
     da = scene.xr
-    da_crs = da.rio.reproject_match(ds.elevation)
+    # one plan for all three bands (and cached for the next plot of the bbox)
+    da_crs = reproject_with_plan(da, match=ds.elevation)
 
     return da_crs
 
@@ -83,5 +83,119 @@ def create_report(experiment_path, report_path, no_profile_plots):
     )
 
 
+@click.command()
+@click.option(
+    "--store-dir",
+    "-s",
+    type=click.Path(),
+    default=None,
+    help="Forcing store to clean up (default: <project>/data/forcing_store)",
+)
+@click.option(
+    "--dry-run",
+    "-d",
+    is_flag=True,
+    help="Only list the entries that would be removed",
+)
+def gc_forcing_store(store_dir, dry_run):
+    from .templater.store import get_forcing_store
+
+    store = get_forcing_store(store_dir)
+    removed = store.gc(dry_run=dry_run)
+    for key in removed:
+        click.echo(f"{'Would remove' if dry_run else 'Removed'}: {key}")
+
+
+@click.command()
+@click.argument("name", type=click.Choice(["era5", "geospatial"]))
+@click.option(
+    "--max-size-gb",
+    "-m",
+    type=float,
+    default=None,
+    help="Remove the least recently used entries until the cache is smaller than this",
+)
+@click.option("--clear", is_flag=True, help="Remove all entries from the cache")
+def manage_cache(name, max_size_gb, clear):
+    from .templater.data import get_era5_cache, get_geospatial_cache
+
+    cache = dict(era5=get_era5_cache, geospatial=get_geospatial_cache)[name]()
+    if clear:
+        cache.clear()
+    elif max_size_gb is not None:
+        removed = cache.evict(max_size_gb=max_size_gb)
+        click.echo(f"Removed {len(removed)} entries")
+
+    click.echo(repr(cache))
+    df = cache.to_dataframe()
+    if not df.empty:
+        click.echo(df.to_string())
+
+
+@click.command()
+@click.option(
+    "--bbox",
+    "-b",
+    required=True,
+    callback=parse_bbox,
+    help="Bounding box as comma-separated values (W,S,E,N)",
+)
+@click.option(
+    "--config",
+    "-c",
+    "config_path_or_url",
+    default=None,
+    help="Excel config or Google Sheets url (default: templates/run_config.xlsx)",
+)
+@click.option("--id", "run_id", default="run", help="Prefix of the run names")
+@click.option("--n-variants", "-n", type=int, default=None, help="Number of variants")
+@click.option(
+    "--method",
+    "-m",
+    type=click.Choice(["index", "random"]),
+    default="index",
+    help="Sample indices 0..n-1 or random seeds 0..n-1 of the ground info table",
+)
+@click.option(
+    "--samplings",
+    "-s",
+    default=None,
+    help="Comma-separated samplings instead of --n-variants (e.g. 0,3,random7)",
+)
+@click.option(
+    "--stacked",
+    type=click.Path(),
+    default=None,
+    help="Write one netcdf with a variant dimension instead of run folders "
+    "(--config must then be a local excel file)",
+)
+def create_sampling_variants(
+    bbox, config_path_or_url, run_id, n_variants, method, samplings, stacked
+):
+    from .templater.data import get_geospatial_variants, save_geospatial_netcdf
+    from .templater.surface_index import get_sampling_variants, parse_sampling
+
+    if samplings is not None:
+        samplings = [parse_sampling(s) for s in samplings.split(",")]
+    elif n_variants is not None:
+        samplings = get_sampling_variants(n_variants, method=method)
+    else:
+        raise click.UsageError("Either --n-variants or --samplings is required")
+
+    if stacked is not None:
+        if config_path_or_url is None:
+            raise click.UsageError("--stacked requires --config")
+        ds = get_geospatial_variants(bbox, config_path_or_url, samplings, res_m=30)
+        save_geospatial_netcdf(ds, stacked)
+        click.echo(f"Variants {', '.join(ds.variant.values)} written to {stacked}")
+        return
+
+    paths = templater.new_cluster_run_variants(
+        list(bbox), samplings, config_path_or_url=config_path_or_url, id=run_id
+    )
+    for fpath_bbox, fpath_config in paths:
+        click.echo(f"Run created at {fpath_config.parent}")
+
+
 if __name__ == "__main__":
     create_new_run()
@@ -19,8 +19,27 @@ def new_cluster_run(
     sampling="random",
     runs_dir=BASE / "runs",
     template_dir=BASE / "templates",
+    n_clusters=None,
+    stream_era5=False,
+    extend_era5=False,
+    use_store=False,
+    compact_era5=False,
+    compact_geospatial=False,
+    pyramid_res_m=None,
+    tile_size=None,
     **kwargs,
 ):
+    """
+    Create a new spatial cluster run. Set n_clusters to precompute the
+    clustering of the config in Python (see clustering.precompute_clusters),
+    so that the MATLAB job does not have to. K_MEANS_custom only uses the
+    clusters if its precomputed_clusters_file is set to clusters.mat and
+    n_clusters matches its number_of_clusters.
+
+    stream_era5, extend_era5, use_store, compact_era5, compact_geospatial,
+    pyramid_res_m and tile_size are passed on to
+    data.make_data_for_cluster_run. The other kwargs fill in run_name.
+    """
     from cryogrid_pytools import CryoGridConfigExcel
 
     from .data import make_data_for_cluster_run
@@ -39,16 +58,91 @@ def new_cluster_run(
     )
 
     fpath_bbox, fpath_config = make_data_for_cluster_run(
-        run_path, res_m=30, sampling=sampling
+        run_path,
+        res_m=30,
+        sampling=sampling,
+        stream_era5=stream_era5,
+        extend_era5=extend_era5,
+        use_store=use_store,
+        compact_era5=compact_era5,
+        compact_geospatial=compact_geospatial,
+        pyramid_res_m=pyramid_res_m,
+        tile_size=tile_size,
     )
 
     make_forcing_plots(run_path)
 
+    if n_clusters is not None:
+        from .clustering import precompute_clusters
+
+        precompute_clusters(run_path, n_clusters)
+
     CryoGridConfigExcel(fpath_config)
 
     return fpath_bbox, fpath_config
 
 
+def new_cluster_run_variants(
+    bbox_WSEN,
+    samplings,
+    config_path_or_url=None,
+    run_name="{id}-{bbox_str}-smpl{sampling}",
+    runs_dir=BASE / "runs",
+    template_dir=BASE / "templates",
+    stream_era5=False,
+    extend_era5=False,
+    use_store=False,
+    compact_era5=False,
+    compact_geospatial=False,
+    pyramid_res_m=None,
+    tile_size=None,
+    **kwargs,
+):
+    """
+    Like new_cluster_run, but one run for each sampling of the ground info
+    table, with the geospatial data computed only once for all runs (see
+    data.make_data_for_cluster_run_variants). run_name must contain {sampling}.
+    """
+    from cryogrid_pytools import CryoGridConfigExcel
+
+    from .data import make_data_for_cluster_run_variants
+    from .files_n_folders import make_run_folder_structure
+    from .plotting import make_forcing_plots
+
+    bbox_str = "".join(
+        [f"{coord * 100:.0f}{cardinal}" for coord, cardinal in zip(bbox_WSEN, "wsen")]
+    )
+
+    run_paths = [
+        runs_dir / run_name.format(bbox_str=bbox_str, sampling=sampling, **kwargs)
+        for sampling in samplings
+    ]
+    if len(set(run_paths)) != len(run_paths):
+        raise ValueError(f"run_name must contain {{sampling}}: {run_name}")
+
+    for run_path in run_paths:
+        make_run_folder_structure(run_path, template_dir, config_path_or_url, bbox_WSEN)
+
+    paths = make_data_for_cluster_run_variants(
+        run_paths,
+        samplings,
+        res_m=30,
+        stream_era5=stream_era5,
+        extend_era5=extend_era5,
+        use_store=use_store,
+        compact_era5=compact_era5,
+        compact_geospatial=compact_geospatial,
+        pyramid_res_m=pyramid_res_m,
+        tile_size=tile_size,
+    )
+
+    for run_path, (fpath_bbox, fpath_config) in zip(run_paths, paths):
+        make_forcing_plots(run_path)
+        CryoGridConfigExcel(fpath_config)
+
+    return paths
+
+
 def make_new_ensemble_run(
     run_name, era5_mat_source=BASE / "data/era5-cryogrid-pamirs-1990_2023.mat"
 ):
@@ -0,0 +1,434 @@
+"""
+Benchmarks for the slow steps of creating a run. These run offline on
+synthetic data by default so that changes can be timed without access to
+the S3 bucket or the geospatial data providers.
+
+Each benchmark returns a pandas.DataFrame with one row per case.
+"""
+
+import pathlib
+import tempfile
+import time
+
+import pandas as pd
+from loguru import logger
+
+
+def benchmark_era5_extraction(
+    source=None,
+    bbox_sizes_deg=(0.1, 0.5, 2.0),
+    n_years=(1, 2),
+    center=(72.0, 38.5),
+    first_year=2000,
+    methods=("in_memory", "streaming"),
+) -> pd.DataFrame:
+    """
+    Time the open, clip, load and export steps of the ERA5 extraction.
+
+    Parameters
+    ----------
+    source : era5.ERA5Source or str, optional
+        The yearly zarr stores to read from. If None, synthetic stores that
+        cover all cases are written to the fsspec memory filesystem first.
+    bbox_sizes_deg : tuple, optional
+        The width/height of the (square) bboxes in degrees.
+    n_years : tuple, optional
+        The lengths of the periods in years, starting at first_year.
+    center : tuple, optional
+        The (lon, lat) center of the bboxes, by default in the Pamirs.
+    first_year : int, optional
+        The first year of the periods.
+    methods : tuple, optional
+        "in_memory" times the steps of get_era5_from_s3_bucket + era5_to_matlab,
+        "streaming" times era5.era5_to_matlab_streaming (total only) and
+        "chunked" times era5.read_era5_extract as load_s (no export).
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns: method, bbox_size_deg, n_years, n_gridpoints, n_times, mb
+        (loaded data), open_s, clip_s, load_s, export_s, total_s, mat_mb
+        (size of era5.mat), mb_per_s and s_per_year. The chunked rows also
+        have mb_requested, mb_decoded and amplification (see read_era5_extract).
+    """
+    from cryogrid_pytools.forcing import era5_to_matlab
+
+    from .data import clip_era5_to_bbox
+    from .era5 import (
+        ERA5Source,
+        era5_to_matlab_streaming,
+        make_synthetic_era5_stores,
+        open_era5_mfdataset,
+        read_era5_extract,
+    )
+
+    lon, lat = center
+    if source is None:
+        half = max(bbox_sizes_deg) / 2 + 1
+        source = ERA5Source.in_memory(name=f"era5-benchmark-{time.time_ns()}")
+        years = range(first_year, first_year + max(n_years))
+        logger.info(f"Writing synthetic ERA5 data for {len(years)} years to {source}")
+        make_synthetic_era5_stores(
+            source, years, bbox=(lon - half, lat - half, lon + half, lat + half)
+        )
+
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="era5-benchmark-"))
+    rows = []
+    for size in bbox_sizes_deg:
+        bbox = (lon - size / 2, lat - size / 2, lon + size / 2, lat + size / 2)
+        for n in n_years:
+            time_start = f"{first_year}-01-01"
+            time_end = f"{first_year + n - 1}-12-31"
+            fname_mat = tmp_dir / f"era5-{size}deg-{n}yrs.mat"
+
+            for method in methods:
+                row = dict(method=method, bbox_size_deg=size, n_years=n)
+                t0 = time.perf_counter()
+                if method == "in_memory":
+                    ds = open_era5_mfdataset(time_start, time_end, source)
+                    row["open_s"] = time.perf_counter() - t0
+
+                    t = time.perf_counter()
+                    ds_bbox, _ = clip_era5_to_bbox(ds, bbox)
+                    row["clip_s"] = time.perf_counter() - t
+
+                    t = time.perf_counter()
+                    ds_bbox = ds_bbox.load()
+                    row["load_s"] = time.perf_counter() - t
+
+                    t = time.perf_counter()
+                    era5_to_matlab(ds_bbox, save_path=str(fname_mat))
+                    row["export_s"] = time.perf_counter() - t
+
+                    row["n_gridpoints"] = ds_bbox.latitude.size * ds_bbox.longitude.size
+                    row["n_times"] = ds_bbox.time.size
+                    row["mb"] = ds_bbox.nbytes / 1e6
+                elif method == "streaming":
+                    era5_to_matlab_streaming(
+                        bbox,
+                        time_start,
+                        time_end,
+                        save_path=fname_mat,
+                        source=source,
+                        progress_callback=lambda *args: None,
+                    )
+                elif method == "chunked":
+                    ds = open_era5_mfdataset(time_start, time_end, source)
+                    _, bbox_used = clip_era5_to_bbox(ds, bbox)
+                    row["open_s"] = time.perf_counter() - t0
+
+                    t = time.perf_counter()
+                    _, stats = read_era5_extract(
+                        bbox_used, time_start, time_end, source
+                    )
+                    row["load_s"] = time.perf_counter() - t
+                    for key in ["mb_requested", "mb_decoded", "amplification"]:
+                        row[key] = stats[key]
+                else:
+                    raise ValueError(f"Unknown method: {method}")
+
+                row["total_s"] = time.perf_counter() - t0
+                if fname_mat.exists():
+                    row["mat_mb"] = fname_mat.stat().st_size / 1e6
+                    fname_mat.unlink()
+
+                rows.append(row)
+                logger.info(f"ERA5 benchmark: {row}")
+
+    df = pd.DataFrame(rows)
+    # the streaming rows have the same amount of data as the in_memory rows
+    for key in ["mb", "n_gridpoints", "n_times"]:
+        if key in df:
+            df[key] = df.groupby(["bbox_size_deg", "n_years"])[key].transform("max")
+    df["mb_per_s"] = df["mb"] / df["total_s"]
+    df["s_per_year"] = df["total_s"] / df["n_years"]
+
+    tmp_dir.rmdir()
+
+    return df
+
+
+def benchmark_era5_mat_formats(
+    n_years=(10, 30),
+    bbox_size_deg=0.5,
+    center=(72.0, 38.5),
+    first_year=2000,
+    formats=("v5", "compact"),
+    source=None,
+) -> pd.DataFrame:
+    """
+    Compare the size, write time and read time of the era5.mat formats.
+
+    One year of ERA5 data is converted with era5_to_matlab and tiled along
+    time to get multi-decade forcing without having to extract decades of
+    data. The read times are for Python (era5.load_era5_mat), which reads
+    the same HDF5 chunks as MATLAB's load.
+
+    Parameters
+    ----------
+    n_years : tuple, optional
+        The lengths of the forcing in years.
+    bbox_size_deg : float, optional
+        The width/height of the (square) bbox in degrees.
+    center : tuple, optional
+        The (lon, lat) center of the bbox, by default in the Pamirs.
+    first_year : int, optional
+        The year that is extracted (and tiled).
+    formats : tuple, optional
+        "v5" is the current scipy.io.savemat file and "compact" the MATLAB
+        v7.3 file with float32 and chunked/compressed arrays.
+    source : era5.ERA5Source or str, optional
+        The yearly zarr stores to read from. If None, a synthetic store for
+        first_year is written to the fsspec memory filesystem first.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns: format, n_years, n_times, mat_mb, write_s, read_s and
+        size/write/read relative to the first format (size_ratio, ...).
+    """
+    import numpy as np
+    from cryogrid_pytools.forcing import era5_to_matlab
+
+    from .data import get_era5_from_s3_bucket
+    from .era5 import (
+        ERA5Source,
+        _get_time_keys,
+        load_era5_mat,
+        make_synthetic_era5_stores,
+        save_era5_mat,
+    )
+
+    lon, lat = center
+    bbox = (
+        lon - bbox_size_deg / 2,
+        lat - bbox_size_deg / 2,
+        lon + bbox_size_deg / 2,
+        lat + bbox_size_deg / 2,
+    )
+    if source is None:
+        half = bbox_size_deg / 2 + 1
+        source = ERA5Source.in_memory(name=f"era5-benchmark-{time.time_ns()}")
+        make_synthetic_era5_stores(
+            source, [first_year], bbox=(lon - half, lat - half, lon + half, lat + half)
+        )
+
+    ds = get_era5_from_s3_bucket(
+        bbox,
+        f"{first_year}-01-01",
+        f"{first_year}-12-31",
+        use_cache=False,
+        source=source,
+    )
+    # Zs has a time dimension in multi-year files
+    ds = ds.assign(Zs=ds["Zs"].expand_dims(time=ds.time))
+    era_year = era5_to_matlab(ds)["era"]
+
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="era5-formats-"))
+    rows = []
+    for n in n_years:
+        era = dict(era_year)
+        for key in _get_time_keys(era_year):
+            era[key] = np.concatenate([era_year[key]] * n, axis=-1)
+        # t is a MATLAB datenum, so shift each repetition by a year (in days)
+        t = np.ravel(era_year["t"])
+        era["t"] = np.concatenate([t + 365.25 * i for i in range(n)])
+
+        for fmt in formats:
+            fname = tmp_dir / f"era5-{fmt}-{n}yrs.mat"
+            row = dict(format=fmt, n_years=n, n_times=era["t"].size)
+
+            t0 = time.perf_counter()
+            save_era5_mat(era, fname, compact=(fmt == "compact"))
+            row["write_s"] = time.perf_counter() - t0
+            row["mat_mb"] = fname.stat().st_size / 1e6
+
+            t0 = time.perf_counter()
+            load_era5_mat(fname)
+            row["read_s"] = time.perf_counter() - t0
+
+            fname.unlink()
+            rows.append(row)
+            logger.info(f"ERA5 format benchmark: {row}")
+
+    tmp_dir.rmdir()
+
+    df = pd.DataFrame(rows)
+    for key, col in [("size", "mat_mb"), ("write", "write_s"), ("read", "read_s")]:
+        first = df.groupby("n_years")[col].transform("first")
+        df[f"{key}_ratio"] = df[col] / first
+
+    return df
+
+
+def benchmark_remap_values(
+    shapes=((1000, 1000), (4000, 4000)),
+    n_classes=5,
+    n_mappings=2,
+    seed=0,
+) -> pd.DataFrame:
+    """
+    Compare surface_index.exchage_values with the lookup tables of remap_values.
+
+    Parameters
+    ----------
+    shapes : tuple, optional
+        The (y, x) shapes of the synthetic surface index.
+    n_classes : int, optional
+        The number of surface index values, by default 5 (as in calc_surface_index).
+    n_mappings : int, optional
+        The number of mappings, alternating indices (int) and parameters (float).
+    seed : int, optional
+        The seed of the random surface index and mappings.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns: method, n_pixels, n_mappings, time_s, mpix_per_s and
+        equal (whether the outputs are the same as those of exchage_values).
+    """
+    import numpy as np
+    import xarray as xr
+
+    from .surface_index import exchage_values, remap_values
+
+    rng = np.random.default_rng(seed)
+    mappings = {
+        f"mapping_{i}": {
+            c: (int(rng.integers(1, 20)) if i % 2 == 0 else float(rng.random()))
+            for c in range(n_classes)
+        }
+        for i in range(n_mappings)
+    }
+
+    rows = []
+    for shape in shapes:
+        da = xr.DataArray(
+            rng.integers(0, n_classes, size=shape, dtype=np.uint8), dims=("y", "x")
+        )
+
+        t0 = time.perf_counter()
+        expected = {k: exchage_values(da, m) for k, m in mappings.items()}
+        time_s = time.perf_counter() - t0
+        rows.append(dict(method="exchage_values", n_pixels=da.size, time_s=time_s))
+
+        t0 = time.perf_counter()
+        ds = remap_values(da, mappings)
+        time_s = time.perf_counter() - t0
+        equal = all(
+            np.allclose(ds[k].values, expected[k].values, rtol=1e-6) for k in mappings
+        )
+        rows.append(
+            dict(method="remap_values", n_pixels=da.size, time_s=time_s, equal=equal)
+        )
+        logger.info(f"Remap benchmark: {rows[-2:]}")
+
+    df = pd.DataFrame(rows)
+    df["n_mappings"] = n_mappings
+    df["mpix_per_s"] = df["n_pixels"] * n_mappings / df["time_s"] / 1e6
+    df["equal"] = df["equal"].fillna(True)
+
+    return df
+
+
+def benchmark_geospatial_encoding(
+    shapes=((1000, 1000), (3000, 3000)),
+    cases=("default", "compact", "compact_int16"),
+    seed=0,
+) -> pd.DataFrame:
+    """
+    Compare the size and write time of geospatial_data.nc and the GeoTIFFs.
+
+    The synthetic geospatial data have the layers of get_geospatial_data:
+    smooth continuous fields, land cover classes, glacier masks and the
+    surface index layers (all float32, as after make_dataset_netcdf_ready).
+
+    Parameters
+    ----------
+    shapes : tuple, optional
+        The (y, x) shapes of the synthetic layers.
+    cases : tuple, optional
+        "default" is the zlib netcdf and plain GeoTIFFs written one at a time,
+        "compact" the dtype-aware netcdf encoding and tiled, compressed
+        GeoTIFFs written concurrently (see data.save_geospatial_netcdf and
+        data.save_geospatial_rasters), and "compact_int16" the same with
+        the continuous layers as scaled int16.
+    seed : int, optional
+        The seed of the random fields.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns: case, n_pixels, nc_mb, nc_write_s, tif_mb, tif_write_s and
+        the size/write time relative to the first case (nc_size_ratio, ...).
+    """
+    import numpy as np
+    import xarray as xr
+    from scipy.ndimage import gaussian_filter
+
+    from .data import save_geospatial_netcdf, save_geospatial_rasters
+
+    rng = np.random.default_rng(seed)
+
+    def smooth(shape, sigma, vmin, vmax):
+        field = gaussian_filter(rng.standard_normal(shape), sigma)
+        field = (field - field.min()) / (field.max() - field.min())
+        return (vmin + field * (vmax - vmin)).astype("float32")
+
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="geospatial-encoding-"))
+    rows = []
+    for shape in shapes:
+        ny, nx = shape
+        coords = dict(y=38.5 - np.arange(ny) * 3e-4, x=72.0 + np.arange(nx) * 3e-4)
+        surface_index = np.digitize(smooth(shape, 20, 0, 1), [0.2, 0.4, 0.6, 0.8])
+        layers = dict(
+            elevation=smooth(shape, 30, 2000, 6000),
+            slope=smooth(shape, 5, 0, 60),
+            glaciers=(smooth(shape, 25, 0, 1) > 0.7),
+            rock_glaciers=(smooth(shape, 10, 0, 1) > 0.9),
+            emissivity=smooth(shape, 15, 0.9, 1.0),
+            albedo=smooth(shape, 15, 0.1, 0.8),
+            snow_index=smooth(shape, 15, 100, 250),
+            land_cover=np.digitize(smooth(shape, 10, 0, 1), [0.3, 0.5, 0.7, 0.9]),
+            surface_index_rule=surface_index,
+            stratigraphy_index=surface_index + 1,
+            roughness_length=np.array([0.001, 0.01, 0.05, 0.1, 0.5])[surface_index],
+        )
+        ds = xr.Dataset(
+            {k: (("y", "x"), v.astype("float32")) for k, v in layers.items()},
+            coords=coords,
+        ).rio.write_crs(4326)
+
+        for case in cases:
+            row = dict(case=case, n_pixels=ny * nx)
+            compact = case != "default"
+            kwargs = dict(continuous="int16") if case == "compact_int16" else {}
+
+            fname = tmp_dir / f"geospatial_data-{case}.nc"
+            t0 = time.perf_counter()
+            save_geospatial_netcdf(ds, fname, compact=compact, **kwargs)
+            row["nc_write_s"] = time.perf_counter() - t0
+            row["nc_mb"] = fname.stat().st_size / 1e6
+            fname.unlink()
+
+            t0 = time.perf_counter()
+            fnames = save_geospatial_rasters(
+                ds, tmp_dir, compact=compact, max_workers=6 if compact else 1
+            )
+            row["tif_write_s"] = time.perf_counter() - t0
+            row["tif_mb"] = sum(f.stat().st_size for f in fnames) / 1e6
+            for f in fnames:
+                f.unlink()
+
+            rows.append(row)
+            logger.info(f"Geospatial encoding benchmark: {row}")
+
+    tmp_dir.rmdir()
+
+    df = pd.DataFrame(rows)
+    for key in ["nc_mb", "nc_write_s", "tif_mb", "tif_write_s"]:
+        first = df.groupby("n_pixels")[key].transform("first")
+        name = key.replace("_mb", "_size").replace("_write_s", "_write")
+        df[f"{name}_ratio"] = df[key] / first
+
+    return df
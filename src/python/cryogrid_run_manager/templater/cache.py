@@ -0,0 +1,364 @@
+"""
+Persistent on-disk caches for data that are slow to fetch (e.g. ERA5 from the
+S3 bucket). Entries are stored as compressed zarr stores in a cache directory
+with a small json index that keeps track of the extent of each entry, the
+last time it was used, and the hit/miss statistics of the cache.
+
+A request can be served by any entry that covers (contains) the requested
+bbox and time period, so a smaller region or a shorter period is read from a
+larger cached extract rather than being downloaded again.
+"""
+
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+import uuid
+from typing import Optional, Union
+
+import pandas as pd
+import xarray as xr
+from loguru import logger
+
+
+def get_default_cache_dir(name: str) -> pathlib.Path:
+    """Returns <project>/data/cache/<name> where <project> contains pyproject.toml"""
+    import dotenv
+
+    base = pathlib.Path(dotenv.find_dotenv("pyproject.toml")).parent
+    return base / "data" / "cache" / name
+
+
+class BboxCache:
+    """
+    A size-bounded, least-recently-used cache of xarray.Datasets on disk.
+
+    Each entry is described by a bbox [W, S, E, N], an optional time period
+    and any number of extra keys (e.g. the variables or the resolution).
+    A lookup matches an entry when the extra keys are equal, the requested
+    bbox and time period lie within the entry's, and requested variables are
+    a subset of the cached variables.
+
+    Parameters
+    ----------
+    cache_dir : Union[str, pathlib.Path]
+        Directory where the zarr stores and the index.json are kept.
+    max_size_gb : float, optional
+        The maximum size of the cache. Least recently used entries are
+        removed when the cache grows beyond this size, by default 20 GB.
+    bbox_decimals : int, optional
+        Number of decimals the bbox is rounded to when stored and compared,
+        by default 6 (~0.1 m at the equator).
+    """
+
+    index_name = "index.json"
+
+    def __init__(
+        self,
+        cache_dir: Union[str, pathlib.Path],
+        max_size_gb: float = 20.0,
+        bbox_decimals: int = 6,
+    ):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size_gb = max_size_gb
+        self.bbox_decimals = bbox_decimals
+        # the index is read, modified and written, which must not interleave
+        # when the cache is used from several threads
+        self._lock = threading.RLock()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        stats = self.stats
+        return (
+            f"{self.__class__.__name__}('{self.cache_dir}', "
+            f"entries={stats['entries']}, size={stats['size_gb']:.2f}/{self.max_size_gb} GB, "
+            f"hit_rate={stats['hit_rate']:.0%})"
+        )
+
+    @property
+    def index_path(self) -> pathlib.Path:
+        return self.cache_dir / self.index_name
+
+    def _read_index(self) -> dict:
+        if not self.index_path.exists():
+            return dict(entries={}, stats=dict(hits=0, misses=0, evictions=0))
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index: dict):
+        # write to a temporary file first so that a crash never leaves a broken index
+        fname_tmp = self.index_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        with open(fname_tmp, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(fname_tmp, self.index_path)
+
+    def _round_bbox(self, bbox) -> list[float]:
+        return [round(float(c), self.bbox_decimals) for c in bbox]
+
+    @property
+    def stats(self) -> dict:
+        """Number of entries, size on disk, and the hit/miss counts of the cache"""
+        index = self._read_index()
+        stats = dict(index["stats"])
+        n_lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / n_lookups if n_lookups else 0.0
+        stats["entries"] = len(index["entries"])
+        stats["size_gb"] = sum(e["size_bytes"] for e in index["entries"].values()) / 1e9
+        return stats
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns a table of the cache entries sorted by the last time they were used"""
+        entries = self._read_index()["entries"]
+        df = pd.DataFrame.from_dict(entries, orient="index")
+        if df.empty:
+            return df
+        df["last_access"] = pd.to_datetime(df["last_access"], unit="s")
+        df["size_mb"] = df.pop("size_bytes") / 1e6
+        return df.sort_values("last_access", ascending=False)
+
+    def _entry_matches(
+        self, entry: dict, bbox, time_start=None, time_end=None, variables=None, **keys
+    ) -> bool:
+        tol = 10**-self.bbox_decimals
+        W, S, E, N = entry["bbox"]
+        w, s, e, n = self._round_bbox(bbox)
+        if not (
+            (w >= W - tol) and (s >= S - tol) and (e <= E + tol) and (n <= N + tol)
+        ):
+            return False
+
+        if entry["keys"] != _jsonable(keys):
+            return False
+
+        if variables is not None:
+            if not set(variables).issubset(entry["variables"]):
+                return False
+
+        if time_start is not None or time_end is not None:
+            if entry["time_start"] is None or entry["time_end"] is None:
+                return False
+            if pd.Timestamp(time_start) < pd.Timestamp(entry["time_start"]):
+                return False
+            if pd.Timestamp(time_end) > pd.Timestamp(entry["time_end"]):
+                return False
+
+        return True
+
+    def lookup(
+        self, bbox, time_start=None, time_end=None, variables=None, **keys
+    ) -> Union[dict, None]:
+        """
+        Find the smallest entry that covers the request without counting a hit/miss.
+
+        Parameters
+        ----------
+        bbox : tuple
+            The bounding box [W, S, E, N] of the request.
+        time_start, time_end : str or pd.Timestamp, optional
+            The time period of the request.
+        variables : list[str], optional
+            The variables that are required. Entries with more variables match.
+        **keys
+            Any other keys that have to be equal to the entry's keys.
+
+        Returns
+        -------
+        dict or None
+            The index entry (with the entry's `path`) or None if nothing matches.
+        """
+        entries = self._read_index()["entries"]
+        candidates = [
+            (name, entry)
+            for name, entry in entries.items()
+            if self._entry_matches(entry, bbox, time_start, time_end, variables, **keys)
+        ]
+        if len(candidates) == 0:
+            return None
+
+        # the smallest matching entry is the cheapest to subset
+        name, entry = min(candidates, key=lambda c: c[1]["size_bytes"])
+        if not (self.cache_dir / name).exists():
+            logger.warning(f"Cache entry {name} is in the index but not on disk")
+            self.remove(name)
+            return None
+
+        return dict(entry, name=name, path=self.cache_dir / name)
+
+    def get(
+        self, bbox, time_start=None, time_end=None, variables=None, **keys
+    ) -> Union[xr.Dataset, None]:
+        """
+        Open a cached dataset that covers the request. Updates the hit/miss statistics.
+
+        The returned dataset is opened lazily from the zarr store and is not
+        subset to the request - that is left to the caller since the way of
+        clipping the data depends on the data (e.g. pixel centres vs bounds).
+        The time period is subset if given.
+
+        Returns
+        -------
+        xr.Dataset or None
+            The cached dataset (or None when there is a cache miss).
+        """
+        with self._lock:  # the entry cannot be evicted before the hit is counted
+            entry = self.lookup(bbox, time_start, time_end, variables, **keys)
+            if not self.record_access(entry):
+                return None
+
+        logger.debug(f"Cache hit: serving request from {entry['path']}")
+        return self.open(entry, time_start, time_end, variables)
+
+    def open(
+        self, entry: dict, time_start=None, time_end=None, variables=None
+    ) -> xr.Dataset:
+        """Lazily open the zarr store of an entry returned by `lookup`"""
+        ds = xr.open_zarr(entry["path"])
+        if variables is not None:
+            ds = ds[list(variables)]
+        if time_start is not None or time_end is not None:
+            ds = ds.sel(time=slice(time_start, time_end))
+        return ds
+
+    def record_access(self, entry: Union[dict, None]) -> bool:
+        """
+        Count a hit (and mark the entry as recently used) or a miss if entry is None.
+
+        An entry that was evicted since its `lookup` (e.g. by another thread)
+        is counted as a miss. Returns whether a hit was counted.
+        """
+        with self._lock:
+            index = self._read_index()
+            current = None if entry is None else index["entries"].get(entry["name"])
+            if current is None:
+                index["stats"]["misses"] += 1
+            else:
+                index["stats"]["hits"] += 1
+                current["last_access"] = time.time()
+            self._write_index(index)
+        return current is not None
+
+    def put(
+        self, ds: xr.Dataset, bbox, time_start=None, time_end=None, **keys
+    ) -> pathlib.Path:
+        """
+        Add a dataset to the cache and evict old entries if the cache is too large.
+
+        Parameters
+        ----------
+        ds : xr.Dataset
+            The dataset to store. Must contain all data for the given bbox and period.
+        bbox : tuple
+            The bounding box [W, S, E, N] that the dataset covers.
+        time_start, time_end : str or pd.Timestamp, optional
+            The time period that the dataset covers.
+        **keys
+            Any other keys that identify the entry (must be json serializable).
+
+        Returns
+        -------
+        pathlib.Path
+            The path to the zarr store of the entry.
+        """
+        import numcodecs
+
+        name = f"{uuid.uuid4().hex}.zarr"
+        path = self.cache_dir / name
+
+        compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=2)
+        encoding = {k: {"compressor": compressor} for k in ds.data_vars}
+        ds.to_zarr(path, mode="w", encoding=encoding, consolidated=True)
+
+        entry = dict(
+            bbox=self._round_bbox(bbox),
+            time_start=None
+            if time_start is None
+            else pd.Timestamp(time_start).isoformat(),
+            time_end=None if time_end is None else pd.Timestamp(time_end).isoformat(),
+            variables=sorted(ds.data_vars),
+            keys=_jsonable(keys),
+            size_bytes=_get_size_on_disk(path),
+            created=time.time(),
+            last_access=time.time(),
+        )
+
+        with self._lock:
+            index = self._read_index()
+            index["entries"][name] = entry
+            self._write_index(index)
+        logger.debug(f"Added {entry['size_bytes'] / 1e6:.1f} MB to cache: {path}")
+
+        self.evict()
+
+        return path
+
+    def remove(self, name: str):
+        """Remove an entry from the cache index and from disk"""
+        with self._lock:
+            index = self._read_index()
+            index["entries"].pop(name, None)
+            self._write_index(index)
+        shutil.rmtree(self.cache_dir / name, ignore_errors=True)
+
+    def evict(self, max_size_gb: Optional[float] = None) -> list[str]:
+        """
+        Remove the least recently used entries until the cache is smaller than max_size_gb.
+
+        Parameters
+        ----------
+        max_size_gb : float, optional
+            Defaults to the max_size_gb of the cache. Use 0 to clear the cache.
+
+        Returns
+        -------
+        list[str]
+            The names of the removed entries.
+        """
+        if max_size_gb is None:
+            max_size_gb = self.max_size_gb
+        max_size_bytes = max_size_gb * 1e9
+
+        with self._lock:
+            index = self._read_index()
+            entries = sorted(
+                index["entries"].items(), key=lambda e: e[1]["last_access"]
+            )
+            total = sum(e["size_bytes"] for _, e in entries)
+
+            removed = []
+            for name, entry in entries:
+                if total <= max_size_bytes:
+                    break
+                shutil.rmtree(self.cache_dir / name, ignore_errors=True)
+                index["entries"].pop(name)
+                total -= entry["size_bytes"]
+                removed.append(name)
+
+            if removed:
+                index["stats"]["evictions"] += len(removed)
+                self._write_index(index)
+                logger.info(f"Evicted {len(removed)} entries from {self.cache_dir}")
+
+        return removed
+
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        with self._lock:
+            self.evict(max_size_gb=0)
+            self._write_index(
+                dict(entries={}, stats=dict(hits=0, misses=0, evictions=0))
+            )
+
+
+def _get_size_on_disk(path: pathlib.Path) -> int:
+    path = pathlib.Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _jsonable(keys: dict) -> dict:
+    # round trip through json so that tuples become lists and comparisons are fair
+    return json.loads(json.dumps(keys, default=str, sort_keys=True))
@@ -9,44 +9,984 @@ For this to work, we need to:
 5)
 """
 
+import pathlib
+from typing import Optional
+
 import faiss
 import numpy as np
 
 
 class FaissKMeans:
-    def __init__(self, n_clusters=8, n_init=10, max_iter=300):
+    """
+    K-means with faiss that also works on memory-mapped features.
+
+    X is never converted to float32 as a whole: training uses (at most)
+    max_points_per_centroid random rows per cluster, which are the only rows
+    that are read, and labels are assigned chunk_size rows at a time. So X
+    can be a np.memmap that is larger than the memory (see
+    features.make_feature_memmap and cluster_memmap).
+
+    Parameters
+    ----------
+    n_clusters : int, optional
+        The number of clusters, by default 8.
+    n_init : int, optional
+        The number of restarts (faiss nredo), by default 10.
+    max_iter : int, optional
+        The number of iterations, by default 300.
+    max_points_per_centroid : int, optional
+        The training sample size per cluster, by default 256 (as in faiss).
+    chunk_size : int, optional
+        The number of rows per chunk in predict and fit_minibatch, by default 1 000 000.
+    seed : int, optional
+        The seed of the training sample and of faiss, by default 1234.
+
+    Attributes
+    ----------
+    objective_ : np.ndarray
+        The k-means objective after each iteration of the best restart.
+    fit_s_ : float
+        The training time in seconds.
+    """
+
+    def __init__(
+        self,
+        n_clusters=8,
+        n_init=10,
+        max_iter=300,
+        max_points_per_centroid=256,
+        chunk_size=1_000_000,
+        seed=1234,
+    ):
         self.n_clusters = n_clusters
         self.n_init = n_init
         self.max_iter = max_iter
+        self.max_points_per_centroid = max_points_per_centroid
+        self.chunk_size = chunk_size
+        self.seed = seed
         self.kmeans = None
         self.cluster_centers_ = None
         self.inertia_ = None
+        self.objective_ = None
+        self.fit_s_ = None
+        self.warm_start_ = False
+
+    def fit(self, X, *args, init_centroids=None, **kwargs):
+        """
+        Train on a sample of X. With init_centroids (n_clusters, n_features),
+        e.g. from a neighbouring run (see load_kmeans_model), the training
+        starts from them instead of random rows, with a single restart, and
+        cluster i stays the one closest to init_centroids[i].
+        """
+        import time
 
-    def fit(self, X, *args, **kwargs):
-        self._X = X
+        self._X = X  # a reference for score (not a copy)
+        t0 = time.perf_counter()
+        X_train = self._sample_rows(X, self.max_points_per_centroid * self.n_clusters)
+        self.warm_start_ = init_centroids is not None
+        n_init = 1 if self.warm_start_ else self.n_init
         self.kmeans = faiss.Kmeans(
-            d=X.shape[1], k=self.n_clusters, niter=self.max_iter, nredo=self.n_init
+            d=X.shape[1],
+            k=self.n_clusters,
+            niter=self.max_iter,
+            nredo=n_init,
+            max_points_per_centroid=self.max_points_per_centroid,
+            seed=self.seed,
         )
-        self.kmeans.train(X.astype(np.float32))
+        if self.warm_start_:
+            self.kmeans.train(X_train, init_centroids=_as_float32(init_centroids))
+        else:
+            self.kmeans.train(X_train)
+        self.fit_s_ = time.perf_counter() - t0
         self.cluster_centers_ = self.kmeans.centroids
-        self.inertia_ = self.kmeans.obj[-1]
 
-    def predict(self, X, *args, **kwargs):
-        return self.kmeans.index.search(X.astype(np.float32), 1)[1]
+        # faiss concatenates the objectives of the restarts up to the best one
+        # (max_iter per restart), so the best is the one with the lowest end
+        obj = np.asarray(self.kmeans.obj).reshape(-1, self.max_iter)
+        self.objective_ = obj[np.argmin(obj[:, -1])]
+        self.inertia_ = float(self.objective_[-1])
+        return self
+
+    def convergence_report(self, tol=1e-4) -> dict:
+        """
+        How the training converged: the objective at the first and last
+        iteration, the relative change of the last iteration, and the
+        iteration after which the relative change stayed below tol.
+        """
+        obj = self.objective_
+        change = np.abs(np.diff(obj)) / np.maximum(np.abs(obj[1:]), 1e-12)
+        above = np.flatnonzero(change >= tol)
+        return dict(
+            n_clusters=self.n_clusters,
+            warm_start=self.warm_start_,
+            n_init=1 if self.warm_start_ else self.n_init,
+            n_iter=int(obj.size),
+            objective_first=float(obj[0]),
+            objective_last=float(obj[-1]),
+            rel_change_last=float(change[-1]) if change.size else 0.0,
+            converged_iter=int(above[-1] + 2) if above.size else 1,
+            fit_s=self.fit_s_,
+        )
+
+    def fit_minibatch(self, X, batch_size=None, n_epochs=1):
+        """
+        Refine the k-means of a training sample with mini-batches of X.
+
+        The centroids are first trained on a sample (as in fit) and then
+        updated with each batch of rows, with a learning rate of 1 / (the
+        number of points a centroid has been assigned so far) (Sculley, 2010).
+        The batches are read in a random order, one at a time.
+        """
+        from loguru import logger
+
+        batch_size = batch_size or self.chunk_size
+        self.fit(X)
+        centroids = self.kmeans.centroids.copy()
+        # the number of points of each centroid in the training sample
+        X_train = self._sample_rows(X, self.max_points_per_centroid * self.n_clusters)
+        labels = self.predict(X_train)
+        counts = np.bincount(labels.ravel(), minlength=self.n_clusters).astype(float)
+
+        rng = np.random.default_rng(self.seed)
+        starts = np.arange(0, X.shape[0], batch_size)
+        for epoch in range(n_epochs):
+            inertia = 0.0
+            for start in rng.permutation(starts):
+                batch = _as_float32(X[start : start + batch_size])
+                distances, labels = self.kmeans.index.search(batch, 1)
+                labels = labels.ravel()
+                inertia += float(distances.sum())
+
+                n_batch = np.bincount(labels, minlength=self.n_clusters)
+                sums = np.stack(
+                    [
+                        np.bincount(
+                            labels, weights=batch[:, f], minlength=self.n_clusters
+                        )
+                        for f in range(batch.shape[1])
+                    ],
+                    axis=1,
+                )
+                counts += n_batch
+                hit = n_batch > 0
+                centroids[hit] += (
+                    sums[hit] - n_batch[hit, None] * centroids[hit]
+                ) / counts[hit, None]
+                self._set_centroids(centroids)
+
+            self.inertia_ = inertia
+            logger.debug(f"Mini-batch k-means epoch {epoch + 1}: inertia={inertia:.4g}")
+
+        return self
+
+    def predict(self, X, *args, out=None, out_distance=None, **kwargs):
+        """
+        The labels (n_samples, 1), assigned chunk by chunk (into out if given).
+        The squared distances to the centroids are written to out_distance if given.
+        """
+        if out is None:
+            out = np.empty((X.shape[0], 1), dtype=np.int64)
+        for start in range(0, X.shape[0], self.chunk_size):
+            end = start + self.chunk_size
+            distance, out[start:end] = self.kmeans.index.search(
+                _as_float32(X[start:end]), 1
+            )
+            if out_distance is not None:
+                out_distance[start:end] = distance
+        return out
 
     def fit_predict(self, X, *args, **kwargs):
         self.fit(X, *args, **kwargs)
         return self.predict(X, *args, **kwargs)
 
-    def score(self, type="silhouette"):
+    def score(self, type="silhouette", sample_size=None, random_state=0):
+        """
+        The silhouette score (sklearn, O(n^2) - use sample_size for large X)
+        or the inertia of the last training iteration (type="elbow").
+        """
         X = self._X
         if type == "silhouette":
-            return self._score_silhouette(X)
+            return self._score_silhouette(X, sample_size, random_state)
         elif type == "elbow":
-            return self.intertia_
+            return self.inertia_
 
-    def _score_silhouette(self, X):
+    def _score_silhouette(self, X, sample_size=None, random_state=0):
         from sklearn.metrics import silhouette_score
 
-        labels = self.predict(X)
-        return silhouette_score(X, labels)
+        labels = self.predict(X).ravel()
+        return silhouette_score(
+            X, labels, sample_size=sample_size, random_state=random_state
+        )
+
+    def _sample_rows(self, X, n_rows: int) -> np.ndarray:
+        if X.shape[0] <= n_rows:
+            return _as_float32(X)
+        rng = np.random.default_rng(self.seed)
+        # sorted, so that memory-mapped rows are read in order
+        idx = np.sort(rng.choice(X.shape[0], n_rows, replace=False))
+        return _as_float32(X[idx])
+
+    def _set_centroids(self, centroids: np.ndarray):
+        centroids = _as_float32(centroids)
+        self.kmeans.centroids[:] = centroids
+        self.kmeans.index.reset()
+        self.kmeans.index.add(centroids)
+        self.cluster_centers_ = self.kmeans.centroids
+
+
+def _as_float32(X) -> np.ndarray:
+    # no copy if X already is a contiguous float32 array
+    return np.ascontiguousarray(X, dtype=np.float32)
+
+
+def cluster_memmap(
+    fname_features, n_clusters, fname_labels=None, minibatch=False, **kwargs
+):
+    """
+    Cluster memory-mapped features (e.g. from features.make_feature_memmap).
+
+    The features are never loaded as a whole (see FaissKMeans). The labels
+    are written to fname_labels (a memory-mapped .npy, by default
+    labels.npy next to the features).
+
+    Parameters
+    ----------
+    fname_features : Union[str, pathlib.Path]
+        The float32 .npy file with the features (n_pixels, n_features).
+    n_clusters : int
+        The number of clusters.
+    fname_labels : Union[str, pathlib.Path], optional
+        Where the labels (int32) are written.
+    minibatch : bool, optional
+        Refine the centroids with mini-batches of all rows (see
+        FaissKMeans.fit_minibatch), by default False (trained on a sample).
+    **kwargs
+        Passed on to FaissKMeans.
+
+    Returns
+    -------
+    tuple[FaissKMeans, np.memmap]
+        The trained model and the labels (n_pixels,).
+    """
+    from loguru import logger
+
+    fname_features = pathlib.Path(fname_features)
+    if fname_labels is None:
+        fname_labels = fname_features.with_name("labels.npy")
+
+    X = np.load(fname_features, mmap_mode="r")
+    model = FaissKMeans(n_clusters=n_clusters, **kwargs)
+    if minibatch:
+        model.fit_minibatch(X)
+    else:
+        model.fit(X)
+
+    labels = np.lib.format.open_memmap(
+        fname_labels, mode="w+", dtype=np.int32, shape=(X.shape[0], 1)
+    )
+    model.predict(X, out=labels)
+    labels.flush()
+    logger.info(
+        f"Clustered {X.shape[0]} pixels into {n_clusters} clusters, "
+        f"labels saved to {fname_labels}"
+    )
+
+    return model, labels[:, 0]
+
+
+def sweep_n_clusters(
+    X,
+    n_clusters=range(2, 21),
+    sample_size=200_000,
+    silhouette_sample_size=10_000,
+    criterion="silhouette",
+    max_workers=4,
+    n_init=3,
+    max_iter=100,
+    seed=0,
+):
+    """
+    Train k-means for a range of cluster numbers and score each of them.
+
+    The runtime is bounded by the sample budget: each k-means is trained on
+    (at most) sample_size random rows of X, the inertia and Davies-Bouldin
+    index are computed on the same rows, and the silhouette (O(n^2)) on
+    silhouette_sample_size of them. The k are trained concurrently in a
+    thread pool (faiss releases the GIL).
+
+    Parameters
+    ----------
+    X : np.ndarray
+        The features (n_samples, n_features), e.g. standardized.
+    n_clusters : iterable, optional
+        The numbers of clusters to try, by default 2 to 20.
+    sample_size : int, optional
+        The number of rows used for training and scoring, by default 200 000.
+    silhouette_sample_size : int, optional
+        The number of rows for the silhouette, by default 10 000.
+    criterion : str, optional
+        How the recommended k is chosen: "silhouette" (highest),
+        "davies_bouldin" (lowest) or "elbow" (largest distance of the
+        inertia curve to the line between its end points). By default "silhouette".
+    max_workers : int, optional
+        The number of k-means trained at the same time, by default 4.
+    n_init, max_iter : int, optional
+        Passed on to FaissKMeans, by default 3 and 100.
+    seed : int, optional
+        The seed of the subsamples.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, int]
+        One row per k (n_clusters, inertia, silhouette, davies_bouldin,
+        fit_s, score_s) and the recommended k.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
+    from loguru import logger
+    from sklearn.metrics import davies_bouldin_score, silhouette_score
+
+    if criterion not in ("silhouette", "davies_bouldin", "elbow"):
+        raise ValueError(f"Unknown criterion: {criterion}")
+
+    rng = np.random.default_rng(seed)
+    n = X.shape[0]
+    idx = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+    X_sample = np.ascontiguousarray(X[idx], dtype=np.float32)
+    idx_silhouette = rng.choice(
+        X_sample.shape[0], min(X_sample.shape[0], silhouette_sample_size), replace=False
+    )
+
+    def fit_and_score(k):
+        t0 = time.perf_counter()
+        model = FaissKMeans(n_clusters=k, n_init=n_init, max_iter=max_iter)
+        model.fit(X_sample)
+        fit_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        distances, labels = model.kmeans.index.search(X_sample, 1)
+        labels = labels.ravel()
+        row = dict(
+            n_clusters=k,
+            # the mean over the sample, so that it does not depend on sample_size
+            inertia=float(distances.mean()),
+            silhouette=silhouette_score(
+                X_sample[idx_silhouette], labels[idx_silhouette]
+            ),
+            davies_bouldin=davies_bouldin_score(X_sample, labels),
+            fit_s=fit_s,
+            score_s=time.perf_counter() - t0,
+        )
+        logger.debug(f"k-means sweep: {row}")
+        return row
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(fit_and_score, n_clusters))
+    df = pd.DataFrame(rows).set_index("n_clusters")
+
+    if criterion == "silhouette":
+        k_best = int(df["silhouette"].idxmax())
+    elif criterion == "davies_bouldin":
+        k_best = int(df["davies_bouldin"].idxmin())
+    else:
+        k_best = _get_elbow(df.index.values, df["inertia"].values)
+
+    logger.info(
+        f"Swept {len(df)} cluster numbers on {X_sample.shape[0]} samples in "
+        f"{time.perf_counter() - t0:.1f} s - recommended k={k_best} ({criterion})"
+    )
+
+    return df, k_best
+
+
+def cluster_stratified(
+    X,
+    strata,
+    n_clusters: int,
+    min_clusters=1,
+    max_workers=4,
+    out=None,
+    out_distance=None,
+    **kwargs,
+):
+    """
+    Cluster each stratum (e.g. stratigraphy class) of X with its own k-means.
+
+    The cluster budget is split over the strata in proportion to their
+    number of pixels times the standard deviation of their features
+    (Neyman allocation, see `allocate_clusters`), so small but distinct
+    classes (e.g. rock glaciers) get clusters of their own instead of being
+    absorbed by the large classes. The k-means of the strata are trained
+    concurrently on samples of their rows (faiss releases the GIL), and the
+    labels are assigned chunk by chunk, so X can be a np.memmap. The labels
+    of stratum i are offset by the clusters of the strata before it, giving
+    one assignment with n_clusters labels (fewer only if there are fewer
+    pixels than clusters, see the n_clusters column of the returned table).
+
+    Parameters
+    ----------
+    X : np.ndarray
+        The features (n_samples, n_features), e.g. standardized.
+    strata : np.ndarray
+        The stratum of each row (n_samples,), e.g. FeatureMatrix.read("stratigraphy_index").
+    n_clusters : int
+        The total number of clusters (at least min_clusters per stratum).
+    min_clusters : int, optional
+        The minimum number of clusters of a stratum, by default 1.
+    max_workers : int, optional
+        The number of k-means trained at the same time, by default 4.
+    out, out_distance : np.ndarray, optional
+        Written with the labels and squared distances (n_samples, 1) if given.
+    **kwargs
+        Passed on to FaissKMeans (n_init, max_iter, seed, ...).
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, pd.DataFrame]
+        The labels and squared distances (n_samples, 1) and one row per
+        stratum (n_pixels, std, n_clusters, offset, inertia, fit_s).
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
+    from loguru import logger
+
+    strata = np.asarray(strata).ravel()
+    if strata.size != X.shape[0]:
+        raise ValueError(f"strata has {strata.size} values for {X.shape[0]} rows")
+    values, inverse = np.unique(strata, return_inverse=True)
+
+    # a training sample of each stratum (as FaissKMeans.fit would draw it),
+    # also used to estimate the spread of its features
+    chunk_size = kwargs.get("chunk_size", 1_000_000)
+    max_points = kwargs.get("max_points_per_centroid", 256)
+    rng = np.random.default_rng(kwargs.get("seed", 1234))
+    counts = np.bincount(inverse, minlength=values.size)
+    n_sample = max_points * n_clusters
+    samples, std = [], np.zeros(values.size)
+    for i in range(values.size):
+        idx = np.flatnonzero(inverse == i)
+        if idx.size > n_sample:
+            idx = np.sort(rng.choice(idx, n_sample, replace=False))
+        samples.append(_as_float32(X[idx]))
+        std[i] = np.sqrt(samples[i].var(axis=0).sum())
+
+    k = allocate_clusters(counts, std, n_clusters, min_clusters=min_clusters)
+    offsets = np.r_[0, np.cumsum(k)[:-1]]
+
+    def fit(i):
+        t0 = time.perf_counter()
+        model = FaissKMeans(n_clusters=int(k[i]), **kwargs)
+        # the sample has at most max_points_per_centroid * k[i] rows when fitting
+        model.fit(samples[i])
+        return model, time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        models, fit_s = zip(*pool.map(fit, range(values.size)))
+
+    if out is None:
+        out = np.empty((X.shape[0], 1), dtype=np.int64)
+    if out_distance is None:
+        out_distance = np.empty((X.shape[0], 1), dtype=np.float32)
+    inertia = np.zeros(values.size)
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = _as_float32(X[start : start + chunk_size])
+        chunk_strata = inverse[start : start + chunk_size]
+        labels = np.empty((chunk.shape[0], 1), dtype=np.int64)
+        distance = np.empty((chunk.shape[0], 1), dtype=np.float32)
+        for i in np.unique(chunk_strata):
+            rows = chunk_strata == i
+            distance[rows], labels[rows] = models[i].kmeans.index.search(chunk[rows], 1)
+            labels[rows] += offsets[i]
+            inertia[i] += float(distance[rows].sum())
+        out[start : start + chunk_size] = labels
+        out_distance[start : start + chunk_size] = distance
+
+    df = pd.DataFrame(
+        dict(
+            stratum=values,
+            n_pixels=counts,
+            std=std,
+            n_clusters=k,
+            offset=offsets,
+            inertia=inertia,
+            fit_s=fit_s,
+        )
+    ).set_index("stratum")
+    logger.info(
+        f"Clustered {X.shape[0]} pixels in {values.size} strata into "
+        f"{k.sum()} clusters: {dict(zip(values.tolist(), k.tolist()))}"
+    )
+
+    return out, out_distance, df
+
+
+def allocate_clusters(
+    counts: np.ndarray, std: np.ndarray, n_clusters: int, min_clusters=1
+) -> np.ndarray:
+    """
+    Split n_clusters over strata in proportion to counts * std.
+
+    Each stratum gets at least min_clusters (and at most one per pixel); the
+    rest is split by the largest remainder method. Clusters that are left
+    when the strata with spread are full (one cluster per pixel) are split
+    over the other strata in proportion to their counts. The total is only
+    less than n_clusters if there are fewer pixels than clusters.
+    """
+    if min_clusters < 1:
+        raise ValueError("min_clusters must be at least 1")
+    counts = np.asarray(counts, dtype=np.int64)
+    std = np.asarray(std, dtype=float)
+    k_min = np.minimum(min_clusters, counts)
+    if n_clusters < k_min.sum():
+        raise ValueError(
+            f"n_clusters={n_clusters} is less than {min_clusters} per stratum "
+            f"({k_min.sum()} for {counts.size} strata)"
+        )
+    k = k_min.copy()
+    for weights in [counts * std, counts.astype(float)]:
+        k = _allocate_by_weight(k, counts, weights, n_clusters)
+
+    if k.sum() < n_clusters:
+        from loguru import logger
+
+        logger.warning(
+            f"Only {k.sum()} of {n_clusters} clusters: the strata have "
+            f"{counts.sum()} pixels"
+        )
+
+    return k
+
+
+def _allocate_by_weight(k, counts, weights, n_clusters) -> np.ndarray:
+    # hand out the remaining clusters in proportion to the weights, without
+    # exceeding the number of pixels of a stratum
+    k = k.copy()
+    n_left = n_clusters - k.sum()
+    while n_left > 0:
+        open_ = (k < counts) & (weights > 0)
+        if not open_.any():
+            break
+        share = np.where(open_, weights, 0) / weights[open_].sum() * n_left
+        add = np.minimum(np.floor(share).astype(np.int64), counts - k)
+        if add.sum() == 0:
+            # the largest remainders get one more cluster each
+            order = np.argsort(-(share - np.floor(share)), kind="stable")
+            add[order[: min(n_left, open_.sum())]] = 1
+            add[~open_] = 0
+        k += add
+        n_left = n_clusters - k.sum()
+
+    return k
+
+
+def _get_elbow(k: np.ndarray, inertia: np.ndarray) -> int:
+    # the point furthest from the line between the first and last point
+    # (both axes scaled to [0, 1])
+    x = (k - k.min()) / max(k.max() - k.min(), 1)
+    y = (inertia - inertia.min()) / max(inertia.max() - inertia.min(), 1e-12)
+    distance = np.abs(x + y - 1) if y[0] > y[-1] else np.abs(x - y)
+    return int(k[np.argmax(distance)])
+
+
+def save_kmeans_model(
+    run_path, model: FaissKMeans, features, fname="kmeans_model.npz"
+) -> pathlib.Path:
+    """
+    Save the centroids and the scaler of a trained model to
+    <run>/forcing/clustering/<fname>, with the bbox of the run (forcing/bbox.txt)
+    and the convergence report, so that other runs can warm-start from it.
+
+    Parameters
+    ----------
+    run_path : Union[str, pathlib.Path]
+        The run folder.
+    model : FaissKMeans
+        The model trained on the features.
+    features : features.FeatureMatrix
+        The standardized features the model was trained on.
+    """
+    import json
+    import os
+
+    from loguru import logger
+
+    from .data import get_bbox
+
+    run_path = pathlib.Path(run_path)
+    fname = run_path / "forcing" / "clustering" / fname
+    fname.parent.mkdir(parents=True, exist_ok=True)
+
+    centroids = np.asarray(model.cluster_centers_)
+    info = dict(
+        variables=list(features.variables),
+        bbox=get_bbox(run_path / "forcing" / "bbox.txt"),
+        report=model.convergence_report(),
+    )
+    fname_tmp = fname.with_name(f".{fname.name}.{os.getpid()}.npz")
+    np.savez(
+        fname_tmp,
+        centroids=centroids,
+        centroids_raw=features.inverse_transform(centroids),
+        weights=features.weights,
+        mean=features.mean,
+        std=features.std,
+        info=json.dumps(info),
+    )
+    os.replace(fname_tmp, fname)
+    logger.debug(f"Saved the k-means model to {fname}")
+
+    return fname
+
+
+def load_kmeans_model(fname) -> dict:
+    """The arrays and info (variables, bbox, report) saved by save_kmeans_model"""
+    import json
+
+    with np.load(fname) as npz:
+        model = {k: npz[k] for k in npz.files if k != "info"}
+        model.update(json.loads(str(npz["info"])))
+    model["fname"] = fname
+
+    return model
+
+
+def find_closest_model(
+    run_path, variables, n_clusters: int, search_dirs=None, fname="kmeans_model.npz"
+):
+    """
+    The saved model (see save_kmeans_model) of another run that is closest to
+    this run, with the same variables and number of clusters.
+
+    Runs are compared by their bbox (forcing/bbox.txt): the one with the
+    largest overlap (intersection over union), or the nearest center if
+    none overlaps.
+
+    Parameters
+    ----------
+    run_path : Union[str, pathlib.Path]
+        The run folder.
+    variables : list[str]
+        The variables of the features.
+    n_clusters : int
+        The number of clusters.
+    search_dirs : list, optional
+        The folders with the other runs, by default the parent of run_path.
+
+    Returns
+    -------
+    Union[dict, None]
+        The model (see load_kmeans_model) or None if there is none.
+    """
+    from loguru import logger
+
+    from .data import get_bbox
+
+    run_path = pathlib.Path(run_path)
+    if search_dirs is None:
+        search_dirs = [run_path.parent]
+    w, s, e, n = get_bbox(run_path / "forcing" / "bbox.txt")
+
+    candidates = []
+    for search_dir in search_dirs:
+        for fname_model in pathlib.Path(search_dir).glob(
+            f"*/forcing/clustering/{fname}"
+        ):
+            if fname_model.parents[2].resolve() == run_path.resolve():
+                continue
+            model = load_kmeans_model(fname_model)
+            if model["variables"] != list(variables):
+                continue
+            if model["centroids"].shape[0] != n_clusters:
+                continue
+            w2, s2, e2, n2 = model["bbox"]
+            overlap = max(min(e, e2) - max(w, w2), 0) * max(min(n, n2) - max(s, s2), 0)
+            union = (e - w) * (n - s) + (e2 - w2) * (n2 - s2) - overlap
+            distance = np.hypot((w + e - w2 - e2) / 2, (s + n - s2 - n2) / 2)
+            candidates.append((-overlap / union, distance, str(fname_model), model))
+
+    if not candidates:
+        logger.debug(f"No k-means model to warm-start {run_path.name} from")
+        return None
+
+    iou, _, fname_model, model = min(candidates, key=lambda c: c[:3])
+    logger.info(f"Warm-starting from {fname_model} (bbox overlap {-iou:.0%})")
+    return model
+
+
+# the features of geospatial_data.nc for the cluster variable classes of
+# CryoGrid (CLUSTER_RAW_VARIABLES lists its variables in the config)
+CLUSTER_CLASS_FEATURES = dict(
+    CLUSTER_SLOPE_ASPECT=["slope", "aspect_sin", "aspect_cos"]
+)
+CONFIG_VARIABLE_NAMES = dict(altitude="elevation")
+
+
+def get_cluster_config(path_config_xlsx, class_name="K_MEANS_custom") -> dict:
+    """
+    The clustering of K_MEANS_custom in a run config, in terms of geospatial_data.nc.
+
+    Returns
+    -------
+    dict
+        n_clusters, max_iter, variables (the features, see
+        features.DERIVED_VARIABLES), scaling (one factor per variable, as
+        built in K_MEANS_custom.compute_clusters) and signature (the cluster
+        variable classes, with their variables, as K_MEANS_custom.m builds
+        it to check clusters.mat).
+    """
+    from cryogrid_pytools import CryoGridConfigExcel
+
+    config = CryoGridConfigExcel(
+        path_config_xlsx, check_file_paths=False, check_strat_layers=False
+    )
+    para = config.get_class(class_name).iloc[:, 0]
+
+    def as_list(value) -> list:
+        # H_LIST entries are lists, single values strings, missing ones "nan"
+        values = value if isinstance(value, list) else [value]
+        return [v for v in values if str(v) not in ("nan", "")]
+
+    variables, signature = [], ""
+    classes = as_list(para["cluster_variable_class"])
+    indices = as_list(para["cluster_variable_class_index"])
+    for name, index in zip(classes, indices):
+        index = int(float(index))
+        signature += f"{name}_{index}"
+        variable_class = config.get_class(name)[f"{name}_{index}"]
+        if "variables" in variable_class.index:
+            names = as_list(variable_class["variables"])
+            signature += f"({','.join(names)})"
+            variables += [CONFIG_VARIABLE_NAMES.get(v, v) for v in names]
+        elif name in CLUSTER_CLASS_FEATURES:
+            variables += CLUSTER_CLASS_FEATURES[name]
+        else:
+            raise ValueError(
+                f"Unknown cluster variable class in {path_config_xlsx}: {name}"
+            )
+        signature += ";"
+
+    scaling = np.ones(len(variables))
+    factors = as_list(para.get("cluster_variable_scaling", []))
+    scaling_index = as_list(para.get("cluster_variable_scaling_index", []))
+    for index, factor in zip(scaling_index, factors):
+        scaling[int(float(index)) - 1] = float(factor)
+
+    max_iter = as_list(para.get("max_iterations", []))
+    return dict(
+        n_clusters=int(float(para["number_of_clusters"])),
+        max_iter=int(float(max_iter[0])) if max_iter else 1000,
+        variables=variables,
+        scaling=scaling,
+        signature=signature,
+    )
+
+
+def precompute_clusters(
+    run_path,
+    n_clusters: Optional[int] = None,
+    variables=None,
+    scaling=None,
+    max_iter=1000,
+    n_init=1,
+    fname="clusters.mat",
+    exclude=None,
+    stratify_by=None,
+    warm_start=False,
+    search_dirs=None,
+    **kwargs,
+):
+    """
+    Compute the clusters of K_MEANS_custom.m in Python and save them to the run.
+
+    As in K_MEANS_custom.compute_clusters, the variables of the run config
+    (see get_cluster_config) are z-scored (with the population standard
+    deviation), multiplied by their scaling, and clustered with k-means.
+    The cluster number and the squared distance to the centroid of each
+    pixel are saved on the grid of geospatial_data.nc to forcing/<fname>,
+    with the number of clusters, the cluster variable classes, the scaling
+    and the size and modification time of geospatial_data.nc.
+
+    K_MEANS_custom.m loads the file only if its precomputed_clusters_file is
+    set (e.g. to clusters.mat), all of these match its PARA and the current
+    geospatial_data.nc, and each of its gridcells has a cluster (pixels in
+    exclude or with a NaN variable have none) - otherwise it clusters as
+    before. It looks up its gridcells by their coordinates and takes the
+    gridcell closest to each centroid as the sample centroid, so the MATLAB
+    job skips the clustering. Note that the z-scores are computed over all valid pixels
+    (less those in exclude), not only over the gridcells left by the
+    masks of the MATLAB config. The standardized features are taken from
+    (or added to) the FeatureStore of the run.
+
+    Parameters
+    ----------
+    run_path : Union[str, pathlib.Path]
+        The run folder (with forcing/geospatial_data.nc).
+    n_clusters : int, optional
+        The number of clusters, by default number_of_clusters of the config.
+    variables : list, optional
+        The variables of geospatial_data.nc to cluster on, by default those
+        of the config. clusters.mat is then only used by MATLAB if they
+        describe the same cluster variable classes.
+    scaling : list, optional
+        A factor for each standardized variable, by default
+        cluster_variable_scaling of the config (1 for all with variables).
+    max_iter : int, optional
+        The maximum number of k-means iterations, by default 1000.
+    n_init : int, optional
+        The number of k-means restarts, by default 1 (as MATLAB's kmeans).
+    fname : str, optional
+        The name of the file in the forcing folder, by default clusters.mat.
+    exclude : dict, optional
+        Values of variables whose pixels are not clustered (see
+        features.make_feature_memmap), by default None. They are saved to
+        the file, so that K_MEANS_custom.m can report them.
+    stratify_by : str, optional
+        A variable of geospatial_data.nc (e.g. stratigraphy_index) whose
+        classes are clustered separately (see cluster_stratified), by
+        default None (all pixels together).
+    warm_start : bool, optional
+        Start from the centroids of the closest run with a saved model (see
+        find_closest_model), by default False. The centroids are converted
+        to the scaler of this run, so cluster numbers stay the same across
+        neighbouring runs. Cannot be combined with stratify_by.
+    search_dirs : list, optional
+        Where to look for the runs to warm-start from, by default the
+        parent of run_path.
+    **kwargs
+        Passed on to cluster_stratified (min_clusters, max_workers), only
+        with stratify_by.
+
+    Returns
+    -------
+    xr.Dataset
+        cluster_number (1-based, 0 where a pixel is not clustered), distance and
+        the sample centroid of each cluster (sample_centroid_x/y).
+    """
+    import json
+
+    import scipy.io
+    import xarray as xr
+    from loguru import logger
+
+    from .features import FeatureStore, labels_to_grid
+
+    if warm_start and stratify_by is not None:
+        raise ValueError("warm_start cannot be combined with stratify_by")
+    if kwargs and stratify_by is None:
+        raise TypeError(
+            f"{', '.join(kwargs)} can only be given with stratify_by "
+            "(see cluster_stratified)"
+        )
+
+    run_path = pathlib.Path(run_path)
+    forcing_path = run_path / "forcing"
+    fname_geospatial = forcing_path / "geospatial_data.nc"
+
+    cluster_config = get_cluster_config(run_path / f"{run_path.name}.xlsx")
+    signature = cluster_config["signature"]
+    if n_clusters is None:
+        n_clusters = cluster_config["n_clusters"]
+    if variables is None:
+        variables = cluster_config["variables"]
+        if scaling is None:
+            scaling = cluster_config["scaling"]
+    elif list(variables) != cluster_config["variables"]:
+        signature = ""  # MATLAB will not use the clusters
+        logger.warning(
+            f"The variables {list(variables)} are not those of the config "
+            f"{cluster_config['variables']}: K_MEANS_custom.m will not use {fname}"
+        )
+    variables = list(variables)
+    scaling = np.ones(len(variables)) if scaling is None else np.asarray(scaling)
+    if n_clusters != cluster_config["n_clusters"]:
+        logger.warning(
+            f"n_clusters={n_clusters}, but number_of_clusters="
+            f"{cluster_config['n_clusters']} in the config: "
+            f"K_MEANS_custom.m will not use {fname}"
+        )
+
+    features = FeatureStore(run_path).get(
+        dict(zip(variables, scaling)), exclude=exclude
+    )
+    Z, pixel_index = features.X, features.pixel_index
+    mean, std = features.mean, features.std
+
+    if stratify_by is None:
+        init_centroids = None
+        if warm_start:
+            closest = find_closest_model(run_path, variables, n_clusters, search_dirs)
+            if closest is not None:
+                init_centroids = features.transform(closest["centroids_raw"])
+        model = FaissKMeans(n_clusters=n_clusters, n_init=n_init, max_iter=max_iter)
+        model.fit(Z, init_centroids=init_centroids)
+        distance = np.empty((Z.shape[0], 1), dtype=np.float32)
+        labels = model.predict(Z, out_distance=distance)
+        save_kmeans_model(run_path, model, features)
+        logger.info(f"k-means convergence: {model.convergence_report()}")
+    else:
+        labels, distance, df_strata = cluster_stratified(
+            Z,
+            features.read(stratify_by),
+            n_clusters,
+            n_init=n_init,
+            max_iter=max_iter,
+            **kwargs,
+        )
+        logger.debug(f"Clusters per {stratify_by}:\n{df_strata}")
+        # the strata can have fewer pixels than clusters
+        n_clusters = int(df_strata["n_clusters"].sum())
+    labels, distance = labels[:, 0], distance[:, 0]
+
+    with xr.open_dataset(fname_geospatial) as ds:
+        like = ds["elevation"].transpose(ds.rio.y_dim, ds.rio.x_dim).load()
+
+    # the pixel closest to each centroid (the first one if there are several)
+    order = np.lexsort((np.arange(labels.size), distance, labels))
+    first = order[np.r_[0, np.flatnonzero(np.diff(labels[order])) + 1]]
+    y, x = like.dims
+    rows, cols = np.unravel_index(pixel_index[first], like.shape)
+
+    ds_clusters = xr.Dataset()
+    ds_clusters["cluster_number"] = labels_to_grid(
+        labels + 1, pixel_index, like, fill=0
+    )
+    ds_clusters["distance"] = labels_to_grid(
+        distance, pixel_index, like, fill=np.nan, dtype=np.float32
+    )
+    ds_clusters["sample_centroid_x"] = ("cluster", like[x].values[cols])
+    ds_clusters["sample_centroid_y"] = ("cluster", like[y].values[rows])
+    ds_clusters = ds_clusters.assign_coords(cluster=labels[first] + 1)
+
+    scipy.io.savemat(
+        forcing_path / fname,
+        dict(
+            x=like[x].values,
+            y=like[y].values,
+            cluster_number=ds_clusters["cluster_number"].values.astype(np.float64),
+            distance=ds_clusters["distance"].values.astype(np.float64),
+            sample_centroid_x=ds_clusters["sample_centroid_x"].values,
+            sample_centroid_y=ds_clusters["sample_centroid_y"].values,
+            n_clusters=n_clusters,
+            variables=np.array(variables, dtype=object),
+            scaling=scaling,
+            mean=mean,
+            std=std,
+            # checked by K_MEANS_custom.get_precomputed_clusters_file
+            signature=signature,
+            exclude=json.dumps(features.exclude) if features.exclude else "",
+            geospatial_bytes=float(fname_geospatial.stat().st_size),
+            geospatial_mtime=fname_geospatial.stat().st_mtime,
+        ),
+        do_compression=True,
+    )
+    logger.info(
+        f"Saved {n_clusters} clusters of {labels.size} pixels "
+        f"({', '.join(variables)}) to {forcing_path / fname}"
+    )
+
+    return ds_clusters
@@ -1,5 +1,4 @@
 import pathlib
-from functools import lru_cache
 from typing import Union
 
 import xarray as xr
@@ -37,7 +36,35 @@ def make_data_for_ensemble_run(run_path, bbox):
         era5_to_matlab(ds_era5, save_path=str(path_era5_mat))
 
 
-def make_data_for_cluster_run(run_path, res_m=100, sampling="random"):
+# the projection of the DEM (UTM 43N, the get_dem_copernicus30 default) that
+# all other geospatial layers are reprojected to
+DEM_EPSG = 32643
+
+# the geospatial layers that are saved as rasters to the forcing folder (these
+# names work with the template files)
+GEOSPATIAL_RASTER_KEYS = (
+    "elevation",
+    "albedo",
+    "emissivity",
+    "snow_index",
+    "stratigraphy_index",
+    "roughness_length",
+)
+
+
+def make_data_for_cluster_run(
+    run_path,
+    res_m=100,
+    sampling="random",
+    stream_era5=False,
+    extend_era5=False,
+    use_store=False,
+    compact_era5=False,
+    compact_geospatial=False,
+    pyramid_res_m=None,
+    tile_size=None,
+    ds_geo=None,
+):
     """
     Create the geospatial data for the run. This includes the following:
         - bbox.txt
@@ -45,6 +72,42 @@ def make_data_for_cluster_run(run_path, res_m=100, sampling="random"):
         - surface_classes.tif
         - geospatial_data.nc
         - era5.mat
+
+    Set stream_era5=True to write era5.mat one year at a time (see
+    era5.era5_to_matlab_streaming) for long periods or large bboxes.
+
+    Set extend_era5=True to fetch only the years that are missing from an
+    existing era5.mat (e.g. after the end year in the config was changed)
+    instead of skipping it (see era5.extend_era5_mat).
+
+    Set use_store=True to hardlink era5.mat and the geospatial files from the
+    forcing store (see store.ForcingStore) when a run with the same bbox,
+    period, resolution and ground mappings has created them before. New
+    files are added to the store. Existing and extended era5.mat files are not
+    stored, as they may not cover the period of the config.
+
+    Set compact_era5=True to write era5.mat as a MATLAB v7.3 file with float32
+    and chunked, compressed arrays, which loads faster in MATLAB (see
+    era5.save_era5_mat and benchmark.benchmark_era5_mat_formats).
+
+    Set compact_geospatial=True to write geospatial_data.nc with the
+    dtype-aware encoding of `get_geospatial_encoding` (classes and masks as
+    small integers, chunked) and the GeoTIFFs tiled and compressed (see
+    `save_geospatial_rasters` and benchmark.benchmark_geospatial_encoding).
+
+    Set pyramid_res_m (e.g. 30) to fetch the geospatial layers once at that
+    resolution and aggregate them to res_m. The levels are kept in
+    forcing/geospatial_pyramid.zarr, so running this again with another res_m
+    does not fetch the layers again (see `get_geospatial_data`).
+
+    Set tile_size (in pixels) to compute the terrain derivatives and the
+    surface index tile by tile for large domains (see `get_geospatial_data`).
+    The result is the same, so it is not part of the forcing store key.
+
+    ds_geo is the geospatial data of the run if it was computed before (e.g.
+    one variant of `get_geospatial_variants`, see
+    `make_data_for_cluster_run_variants`). It is written instead of being
+    fetched and computed again.
     """
     from cryogrid_pytools import excel_config
     from cryogrid_pytools.forcing import era5_to_matlab
@@ -67,45 +130,412 @@ def make_data_for_cluster_run(run_path, res_m=100, sampling="random"):
     )
     times = config.get_start_end_times()
 
-    if not path_era5_mat.exists():
+    store = None
+    if use_store:
+        from .era5 import get_era5_source
+        from .store import get_forcing_store
+
+        store = get_forcing_store()
+        era5_fnames = [path_era5_mat.name, path_era5_mat.with_suffix(".json").name]
+        era5_params = dict(
+            bbox=bbox,
+            time_start=str(times.time_start),
+            time_end=str(times.time_end),
+            source=get_era5_source().url_template,
+            compact=compact_era5,
+        )
+        era5_key = store.get_key("era5", **era5_params)
+        if not path_era5_mat.exists():
+            store.link(era5_key, forcing_path, era5_fnames)
+
+    # only files written here are added to the store: an existing era5.mat
+    # (e.g. of an older run or another period) may not match era5_params
+    wrote_era5 = not path_era5_mat.exists()
+    if path_era5_mat.exists() and extend_era5:
+        from .era5 import extend_era5_mat
+
+        extend_era5_mat(
+            path_era5_mat, bbox, times.time_start, times.time_end, compact=compact_era5
+        )
+    elif not path_era5_mat.exists() and stream_era5:
+        from .era5 import era5_to_matlab_streaming
+
+        era5_to_matlab_streaming(
+            bbox,
+            times.time_start,
+            times.time_end,
+            save_path=path_era5_mat,
+            compact=compact_era5,
+        )
+    elif not path_era5_mat.exists():
+        from .era5 import save_era5_mat, write_era5_manifest
+
         ds_era5 = data.get_era5_from_s3_bucket(bbox, times.time_start, times.time_end)
-        era5_to_matlab(ds_era5, save_path=str(path_era5_mat))
+        era = era5_to_matlab(ds_era5)["era"]
+        save_era5_mat(era, path_era5_mat, compact=compact_era5)
+        write_era5_manifest(
+            path_era5_mat,
+            bbox,
+            ds_era5.time.values[0],
+            ds_era5.time.values[-1],
+            ds_era5.time.size,
+        )
+
+    if store is not None and wrote_era5:
+        store.add(era5_key, [forcing_path / f for f in era5_fnames], **era5_params)
+
+    geo_fnames = [f"{key}.tif" for key in GEOSPATIAL_RASTER_KEYS]
+    geo_fnames += ["geospatial_data.nc"]
+    # ds_geo is reassigned below, so remember whether this call computes it
+    fetch_geo = ds_geo is None
+    if store is not None and fetch_geo:
+        geo_params = dict(
+            bbox=bbox,
+            res_m=res_m,
+            sampling=sampling,
+            mappings=get_surface_index_mappings(path_config_xlsx, sampling=sampling),
+            compact=compact_geospatial,
+            pyramid_res_m=pyramid_res_m,
+        )
+        geo_key = store.get_key("geospatial", **geo_params)
+        if store.link(geo_key, forcing_path, geo_fnames):
+            return path_bbox_txt, path_config_xlsx
+
+    if ds_geo is None and pyramid_res_m is not None:
+        ds_geo = data.get_geospatial_data(
+            bbox,
+            path_config_xlsx,
+            res_m=res_m,
+            sampling=sampling,
+            pyramid_path=forcing_path / "geospatial_pyramid.zarr",
+            native_res_m=pyramid_res_m,
+            tile_size=tile_size,
+        )
+    elif ds_geo is None:
+        ds_geo = data.get_geospatial_data(
+            bbox, path_config_xlsx, res_m=res_m, sampling=sampling, tile_size=tile_size
+        )
+    # existing files can be links into the forcing store, which must not be overwritten
+    for fname in geo_fnames:
+        (forcing_path / fname).unlink(missing_ok=True)
 
-    ds_geo = data.get_geospatial_data(
-        bbox, path_config_xlsx, res_m=res_m, sampling=sampling
-    )
     # save the geospatial data required for the run to forcing folder
-    # these names work with the template files
-    for key in [
-        "elevation",
-        "albedo",
-        "emissivity",
-        "snow_index",
-        "stratigraphy_index",
-        "roughness_length",
-    ]:
-        ds_geo[key].rio.to_raster(forcing_path / f"{key}.tif")
+    save_geospatial_rasters(ds_geo, forcing_path, compact=compact_geospatial)
 
     # save all spatial data to a netcdf file
     ds_geo = data.make_dataset_netcdf_ready(ds_geo)
-    ds_geo.to_netcdf(
-        forcing_path / "geospatial_data.nc",
-        encoding={k: {"zlib": True} for k in ds_geo.data_vars},
+    save_geospatial_netcdf(
+        ds_geo, forcing_path / "geospatial_data.nc", compact=compact_geospatial
     )
 
+    if store is not None and fetch_geo:
+        store.add(geo_key, [forcing_path / f for f in geo_fnames], **geo_params)
+
     return path_bbox_txt, path_config_xlsx
 
 
+def make_data_for_cluster_run_variants(
+    run_paths: list, samplings: list, res_m=100, **kwargs
+) -> list:
+    """
+    Create the data of several runs that only differ in the sampling of the
+    ground info table (see `make_data_for_cluster_run`).
+
+    The geospatial data are computed once for all samplings (see
+    `get_geospatial_variants`) and era5.mat is created for the first run
+    and linked into the others. All runs must have the same bbox and period.
+
+    Parameters
+    ----------
+    run_paths : list
+        The run folders, one for each sampling.
+    samplings : list
+        The sampling of each run (see surface_index.get_sampling_variants).
+    res_m : int, optional
+        The resolution of the DEM in meters, by default 100.
+    **kwargs
+        Passed on to `make_data_for_cluster_run` (stream_era5, extend_era5,
+        use_store, compact_era5, compact_geospatial, pyramid_res_m, tile_size).
+
+    Returns
+    -------
+    list
+        The (path_bbox_txt, path_config_xlsx) of each run.
+    """
+    from .store import _link_or_copy
+
+    if len(run_paths) != len(samplings):
+        raise ValueError("There must be one run path for each sampling")
+
+    run_paths = [pathlib.Path(p) for p in run_paths]
+    bboxes = [get_bbox(p / "forcing" / "bbox.txt") for p in run_paths]
+    if any(bbox != bboxes[0] for bbox in bboxes):
+        raise ValueError("The sampling variants must all have the same bbox")
+
+    path_config_xlsx = run_paths[0] / f"{run_paths[0].name}.xlsx"
+    pyramid = {}
+    if kwargs.get("pyramid_res_m", None) is not None:
+        pyramid = dict(
+            pyramid_path=run_paths[0] / "forcing" / "geospatial_pyramid.zarr",
+            native_res_m=kwargs["pyramid_res_m"],
+        )
+    ds_variants = get_geospatial_variants(
+        tuple(bboxes[0]),
+        path_config_xlsx,
+        samplings,
+        res_m=res_m,
+        tile_size=kwargs.get("tile_size", None),
+        **pyramid,
+    )
+
+    era5_fnames = ["era5.mat", "era5.json"]
+    paths = []
+    for run_path, sampling in zip(run_paths, samplings):
+        # era5.mat does not depend on the sampling, so it is shared with the first run
+        for fname in era5_fnames:
+            src = run_paths[0] / "forcing" / fname
+            dest = run_path / "forcing" / fname
+            if run_path != run_paths[0] and src.exists() and not dest.exists():
+                _link_or_copy(src, dest)
+
+        ds_geo = ds_variants.sel(variant=str(sampling)).drop_vars("variant")
+        paths += [
+            make_data_for_cluster_run(
+                run_path, res_m=res_m, sampling=sampling, ds_geo=ds_geo, **kwargs
+            )
+        ]
+
+    return paths
+
+
+def make_era5_for_runs(
+    run_paths: list, source=None, overwrite=False, compact=False
+) -> list:
+    """
+    Write forcing/era5.mat for many runs in a single pass over the ERA5 stores.
+
+    The bbox of each run is read from forcing/bbox.txt and the period from
+    the run's excel config. Runs that share (parts of) their bbox read the
+    ERA5 data only once (see era5.era5_to_matlab_for_runs).
+
+    Parameters
+    ----------
+    run_paths : list
+        The run folders (each contains <run_name>.xlsx and forcing/bbox.txt).
+    source : era5.ERA5Source or str, optional
+        Where the ERA5 stores are read from, by default the S3 bucket.
+    overwrite : bool, optional
+        Write era5.mat even if it exists, by default False.
+    compact : bool, optional
+        Store floats as float32 in the (MATLAB v7.3) files (see
+        era5.ERA5MatWriter), by default False.
+
+    Returns
+    -------
+    list
+        The paths to the era5.mat files that were written.
+    """
+    from cryogrid_pytools import excel_config
+
+    from .era5 import era5_to_matlab_for_runs
+
+    requests = []
+    for run_path in run_paths:
+        run_path = pathlib.Path(run_path)
+        forcing_path = run_path / "forcing"
+        path_era5_mat = forcing_path / "era5.mat"
+        if path_era5_mat.exists() and not overwrite:
+            logger.info(f"Skipping {path_era5_mat} (already exists)")
+            continue
+
+        config = excel_config.CryoGridConfigExcel(
+            run_path / f"{run_path.name}.xlsx",
+            check_file_paths=False,
+            check_strat_layers=False,
+        )
+        times = config.get_start_end_times()
+        requests += [
+            dict(
+                bbox=get_bbox(forcing_path / "bbox.txt"),
+                time_start=times.time_start,
+                time_end=times.time_end,
+                save_path=path_era5_mat,
+            )
+        ]
+
+    if len(requests) == 0:
+        return []
+
+    return era5_to_matlab_for_runs(requests, source=source, compact=compact)
+
+
 def get_geospatial_data(
     bbox: tuple,
     path_config_xlsx: Union[pathlib.Path, str],
     res_m=100,
     sampling="random",
+    max_workers=6,
+    use_cache=False,
+    tile_size=None,
+    surface_index_rules=None,
+    fill_method="stepwise",
+    pyramid_path=None,
+    native_res_m=30,
+) -> xr.Dataset:
+    """
+    Get the DEM and all layers that are reprojected to the DEM for the bbox.
+
+    The layers only depend on the DEM, so they are fetched concurrently in a
+    thread pool (the fetches are mostly waiting for downloads). The time of
+    each layer is logged. Use max_workers=1 to fetch one layer at a time.
+
+    With use_cache=True (off by default, as it writes to
+    <project>/data/cache/geospatial), each layer is looked up in the on-disk
+    geospatial cache (see `get_geospatial_cache`) first. A bbox that lies within a cached
+    DEM is clipped from it, and the other layers are then selected on the
+    clipped DEM grid from the cached layers, so nothing is refetched or
+    reprojected. Layers that are fetched are added to the cache.
+
+    The terrain derivatives (slope, aspect, curvature and sky_view_factor) are
+    computed once from the DEM (see terrain.calc_terrain) and the slope is
+    reused for the surface index.
+
+    Set tile_size (in pixels) for large domains: the terrain derivatives and
+    the surface index are then computed tile by tile (see
+    surface_index.calc_surface_index_tiled), which gives the same result with
+    the intermediate arrays of those steps bounded by the tile size. The
+    layers themselves are still fetched for (and held in memory on) the
+    whole DEM grid.
+
+    surface_index_rules is a rule table (or the path to a .csv/.xlsx file)
+    that replaces the default surface index rules (see
+    surface_index.get_surface_index_rules). The rule that set each pixel is
+    saved as surface_index_rule. fill_method sets how the pixels without a
+    matching rule are filled (see surface_index.calc_surface_index).
+
+    Set pyramid_path to a zarr store (e.g. <run>/forcing/geospatial_pyramid.zarr)
+    to get the layers from a resolution pyramid: they are fetched only once
+    at native_res_m (30 m) and aggregated to res_m (see
+    `aggregate_geospatial_data`). Each level is stored in the zarr store, so
+    switching res_m does not fetch anything again.
+
+    Use `get_geospatial_variants` for several samplings of the ground info
+    table from the same layers and surface index.
+    """
+    from .surface_index import remap_values
+
+    ds_out, surface_index = _get_geospatial_layers(
+        bbox,
+        res_m=res_m,
+        max_workers=max_workers,
+        use_cache=use_cache,
+        tile_size=tile_size,
+        surface_index_rules=surface_index_rules,
+        fill_method=fill_method,
+        pyramid_path=pyramid_path,
+        native_res_m=native_res_m,
+    )
+
+    mappings = get_surface_index_mappings(path_config_xlsx, sampling=sampling)
+    ds_out = ds_out.merge(remap_values(surface_index, mappings))
+
+    ds_out = make_dataset_netcdf_ready(ds_out)
+
+    return ds_out
+
+
+def get_geospatial_variants(
+    bbox: tuple,
+    path_config_xlsx: Union[pathlib.Path, str],
+    samplings: list,
+    res_m=100,
+    **kwargs,
 ) -> xr.Dataset:
-    import xrspatial
+    """
+    Get the geospatial data for several samplings of the ground info table.
+
+    The layers and the surface index do not depend on the sampling, so they
+    are fetched and computed only once (as in `get_geospatial_data`). Only the
+    remapping of the surface index to the stratigraphy_index and
+    roughness_length is done for each sampling.
+
+    Parameters
+    ----------
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees.
+    path_config_xlsx : Union[pathlib.Path, str]
+        The excel config with the ground info table (see
+        surface_index.get_ground_info_table).
+    samplings : list
+        The samplings, e.g. [0, 1, 2] or ['random0', 'random1'] (see
+        surface_index.get_sampling_variants).
+    res_m : int, optional
+        The resolution of the DEM in meters, by default 100.
+    **kwargs
+        Passed on to `get_geospatial_data` (max_workers, use_cache, tile_size,
+        surface_index_rules, fill_method, pyramid_path, native_res_m).
+
+    Returns
+    -------
+    xr.Dataset
+        The same variables as `get_geospatial_data`, with the variant
+        dimension (labelled by str(sampling)) on the remapped layers only.
+        Select one with ds.sel(variant=str(sampling)).
+    """
+    import pandas as pd
+
+    from .surface_index import remap_values
+
+    if len(set(map(str, samplings))) != len(samplings):
+        raise ValueError(f"The samplings must be unique: {samplings}")
+
+    ds_out, surface_index = _get_geospatial_layers(bbox, res_m=res_m, **kwargs)
+
+    variants = []
+    for sampling in samplings:
+        mappings = get_surface_index_mappings(path_config_xlsx, sampling=sampling)
+        variants += [remap_values(surface_index, mappings)]
+    variant = pd.Index([str(sampling) for sampling in samplings], name="variant")
+    ds_out = ds_out.merge(xr.concat(variants, dim=variant))
+    logger.info(f"Made {len(samplings)} sampling variants: {', '.join(variant)}")
+
+    ds_out = make_dataset_netcdf_ready(ds_out)
+
+    return ds_out
+
+
+def _get_geospatial_layers(
+    bbox: tuple,
+    res_m=100,
+    max_workers=6,
+    use_cache=False,
+    tile_size=None,
+    surface_index_rules=None,
+    fill_method="stepwise",
+    pyramid_path=None,
+    native_res_m=30,
+) -> tuple[xr.Dataset, xr.DataArray]:
+    # everything in get_geospatial_data that does not depend on the sampling
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
     from cryogrid_pytools import data
 
-    from .surface_index import calc_surface_index, exchage_values
+    from .surface_index import calc_surface_index, calc_surface_index_tiled
+    from .terrain import calc_terrain
+
+    if pyramid_path is not None:
+        return _get_geospatial_pyramid_level(
+            bbox,
+            pyramid_path,
+            res_m=res_m,
+            native_res_m=native_res_m,
+            max_workers=max_workers,
+            use_cache=use_cache,
+            tile_size=tile_size,
+            surface_index_rules=surface_index_rules,
+            fill_method=fill_method,
+        )
 
     ds_out = xr.Dataset()
 
@@ -113,51 +543,340 @@ def get_geospatial_data(
     logger.info(f"Getting geospatial data for bbox [{bbox_str}]")
 
     # all other datasets are reprojected to the DEM
-    dem = data.get_dem_copernicus30(bbox, res_m=res_m).compute()
-    ds_out["elevation"] = dem
-    ds_out["slope"] = xrspatial.slope(dem)
+    cache = get_geospatial_cache() if use_cache else None
 
-    # masks based on shapefile polygons
-    ds_out["glaciers"] = data.get_randolph_glacier_inventory(dem)
-    ds_out["rock_glaciers"] = data.get_TPRoGI_rock_glaciers(dem)
+    t0 = time.perf_counter()
+    dem = None
+    dem_keys = dict(res_m=res_m, crs=f"EPSG:{DEM_EPSG}")
+    if cache is not None:
+        dem = _get_cached_layer(cache, "elevation", bbox, **dem_keys)
+    if dem is None:
+        dem = data.get_dem_copernicus30(bbox, res_m=res_m, epsg=DEM_EPSG).compute()
+        if cache is not None:
+            _put_cached_layer(cache, "elevation", dem, bbox, **dem_keys)
+    timings = dict(elevation=time.perf_counter() - t0)
+    crs = str(dem.rio.crs)
+    ds_out["elevation"] = dem
+    t = time.perf_counter()
+    ds_out = ds_out.merge(calc_terrain(dem, tile_size=tile_size))
+    timings["terrain"] = time.perf_counter() - t
 
-    # ground surface properties - emissivity and albedo to update ground properties
-    ds_out["emissivity"] = data.get_aster_ged_emmis_elev(dem).aster_emissivity.mean(
-        dim="band", keep_attrs=True
+    layers = dict(
+        # masks based on shapefile polygons
+        glaciers=data.get_randolph_glacier_inventory,
+        rock_glaciers=data.get_TPRoGI_rock_glaciers,
+        # ground surface properties - emissivity and albedo to update ground properties
+        emissivity=lambda dem: data.get_aster_ged_emmis_elev(dem)[
+            "aster_emissivity"
+        ].mean(dim="band", keep_attrs=True),
+        albedo=data.get_modis_albedo_500m,
+        # used to adjust the snowfall - have to play around with these values
+        snow_index=lambda dem: data.get_snow_melt_doy(dem).mean("year"),
+        # used to calculate the surface index
+        land_cover=data.get_esri_land_cover,
     )
-    ds_out["albedo"] = data.get_modis_albedo_500m(dem)
 
-    # used to adjust the snowfall - have to play around with these values
-    ds_out["snow_index"] = data.get_snow_melt_doy(dem).mean("year")
+    def fetch(name):
+        t = time.perf_counter()
+        keys = dict(res_m=res_m, crs=crs)
+        da = None
+        if cache is not None:
+            da = _get_cached_layer(cache, name, bbox, dem, **keys)
+        if da is None:
+            # computed here so that lazy (dask) layers are also loaded concurrently
+            da = layers[name](dem).compute()
+            if cache is not None:
+                _put_cached_layer(cache, name, da, bbox, **keys)
+        timings[name] = time.perf_counter() - t
+        logger.debug(f"Got {name} in {timings[name]:.1f} s")
+        return da
+
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = dict(zip(layers, pool.map(fetch, layers)))
+    for name in layers:  # added in a fixed order so that the output is always the same
+        ds_out[name] = results[name]
+
+    timings_str = ", ".join(f"{k}={v:.1f}s" for k, v in timings.items())
+    logger.info(
+        f"Got {len(layers)} layers in {time.perf_counter() - t:.1f} s "
+        f"({max_workers} workers): {timings_str}"
+    )
 
-    # used to calculate the surface index
-    ds_out["land_cover"] = data.get_esri_land_cover(dem).astype("int8")
+    ds_out["land_cover"] = ds_out["land_cover"].astype("int8")
     ds_out["land_cover"].attrs.pop("class_values", None)
 
-    surface_index = calc_surface_index(
+    surface_index_inputs = dict(
         dem=ds_out.elevation,
         land_cover=ds_out.land_cover,
         glaciers=ds_out.glaciers,
         rock_glaciers=ds_out.rock_glaciers,
+        slope=ds_out.slope,
+        rules=surface_index_rules,
+        fill_method=fill_method,
     )
+    if tile_size is None:
+        surface_index, ds_out["surface_index_rule"] = calc_surface_index(
+            **surface_index_inputs, return_provenance=True
+        )
+    else:
+        surface_index, ds_out["surface_index_rule"] = calc_surface_index_tiled(
+            **surface_index_inputs, tile_size=tile_size, return_provenance=True
+        )
 
-    mappings = get_surface_index_mappings(path_config_xlsx, sampling=sampling)
-    for k, values_to_exchange in mappings.items():
-        ds_out[k] = exchage_values(surface_index, values_to_exchange)
+    return ds_out, surface_index
 
-    ds_out = make_dataset_netcdf_ready(ds_out)
+
+# aggregated with the mode (the other layers with the area-weighted mean)
+GEOSPATIAL_CATEGORICAL_KEYS = (
+    "land_cover",
+    "glaciers",
+    "rock_glaciers",
+    "surface_index",
+    "surface_index_rule",
+)
+
+
+def aggregate_geospatial_data(ds: xr.Dataset, res_m: float) -> xr.Dataset:
+    """
+    Aggregate geospatial data to a coarser resolution on the same crs.
+
+    Categorical layers (GEOSPATIAL_CATEGORICAL_KEYS) take the most common
+    value of the fine pixels in each coarse pixel and continuous layers the
+    area-weighted mean (GDAL's mode and average resampling). The coarse grid
+    starts at the top left corner of ds and only contains coarse pixels that
+    are fully covered by ds. The terrain derivatives are computed again from
+    the aggregated elevation (see terrain.calc_terrain), as they would be for
+    a DEM at res_m.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The geospatial data at the native (finer) resolution, with a crs in meters.
+    res_m : float
+        The resolution of the output in meters.
+
+    Returns
+    -------
+    xr.Dataset
+        The aggregated layers.
+    """
+    import numpy as np
+    from affine import Affine
+    from rasterio.enums import Resampling
+
+    from .terrain import TERRAIN_ATTRS, calc_terrain
+
+    left, bottom, right, top = ds.rio.bounds()
+    shape = (int((top - bottom) // res_m), int((right - left) // res_m))
+    transform = Affine(res_m, 0, left, 0, -res_m, top)
+
+    ds_out = xr.Dataset()
+    for key, da in ds.data_vars.items():
+        if key in TERRAIN_ATTRS:
+            continue
+        dtype = da.dtype
+        if key in GEOSPATIAL_CATEGORICAL_KEYS:
+            resampling = Resampling.mode
+            da = da.astype("uint8") if dtype == bool else da
+            nodata = np.nan if da.dtype.kind == "f" else None
+        else:
+            resampling = Resampling.average
+            da = da.astype("float32")
+            nodata = np.nan
+        da = da.rio.write_nodata(nodata, encoded=False) if nodata is not None else da
+        da_coarse = da.rio.reproject(
+            ds.rio.crs, shape=shape, transform=transform, resampling=resampling
+        )
+        if dtype == bool:
+            da_coarse = da_coarse.astype(bool)
+        ds_out[key] = da_coarse.assign_attrs(
+            history=da.attrs.get("history", "")
+            + f"aggregated to {res_m} m ({resampling.name}); "
+        )
+
+    ds_out = ds_out.merge(calc_terrain(ds_out["elevation"]))
+    logger.info(
+        f"Aggregated the geospatial data from {ds.rio.resolution()[0]:g} m "
+        f"to {res_m:g} m ({ds_out.elevation.shape})"
+    )
 
     return ds_out
 
 
+def _get_geospatial_pyramid_level(
+    bbox: tuple, pyramid_path, res_m=100, native_res_m=30, **kwargs
+) -> tuple[xr.Dataset, xr.DataArray]:
+    # the layers and surface index at res_m from the pyramid, aggregated from
+    # native_res_m (which is fetched first if it is not in the pyramid)
+    from .cache import _jsonable
+
+    params = _jsonable(
+        dict(
+            bbox=bbox,
+            native_res_m=native_res_m,
+            surface_index_rules=kwargs.get("surface_index_rules"),
+            fill_method=kwargs.get("fill_method"),
+        )
+    )
+
+    ds = _read_pyramid_level(pyramid_path, res_m, params)
+    if ds is None:
+        ds_native = _read_pyramid_level(pyramid_path, native_res_m, params)
+        if ds_native is None:
+            ds_native, surface_index = _get_geospatial_layers(
+                bbox, res_m=native_res_m, **kwargs
+            )
+            ds_native["surface_index"] = surface_index
+            _write_pyramid_level(ds_native, pyramid_path, native_res_m, params)
+
+        if res_m == native_res_m:
+            ds = ds_native
+        else:
+            ds = aggregate_geospatial_data(ds_native, res_m)
+            _write_pyramid_level(ds, pyramid_path, res_m, params)
+
+    return ds.drop_vars("surface_index"), ds["surface_index"]
+
+
+def _read_pyramid_level(pyramid_path, res_m, params) -> Union[xr.Dataset, None]:
+    import json
+
+    group = f"res_{res_m:g}m"
+    try:
+        ds = xr.open_zarr(pyramid_path, group=group, decode_coords="all")
+    except (FileNotFoundError, KeyError, OSError):
+        return None
+
+    if json.loads(ds.attrs.get("pyramid_params", "null")) != params:
+        logger.debug(f"{pyramid_path}/{group} was made with other parameters")
+        return None
+
+    logger.info(f"Read the geospatial data at {res_m:g} m from {pyramid_path}")
+    return ds.load()
+
+
+def _write_pyramid_level(ds: xr.Dataset, pyramid_path, res_m, params):
+    import json
+
+    group = f"res_{res_m:g}m"
+    ds = ds.assign_attrs(pyramid_params=json.dumps(params))
+    try:
+        ds.to_zarr(pyramid_path, group=group, mode="w")
+    except (TypeError, ValueError) as e:  # e.g. attributes that zarr cannot store
+        logger.warning(f"Could not add {group} to {pyramid_path}: {e}")
+
+
+def get_geospatial_cache(cache_dir=None, max_size_gb=20.0):
+    """
+    The on-disk cache of geospatial layers - defaults to <project>/data/cache/geospatial
+
+    Each layer is cached with the keys layer, res_m and crs (the crs of the
+    DEM that the layer is reprojected to - the DEM itself has no crs key).
+
+    Parameters
+    ----------
+    cache_dir : Union[str, pathlib.Path], optional
+        Location of the cache. Can also be set with the environment variable
+        CRYOGRID_GEOSPATIAL_CACHE_DIR.
+    max_size_gb : float, optional
+        Least recently used layers are removed beyond this size, by default 20 GB.
+
+    Returns
+    -------
+    BboxCache
+        The cache object (see `cache.BboxCache`).
+    """
+    import os
+
+    from .cache import BboxCache, get_default_cache_dir
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("CRYOGRID_GEOSPATIAL_CACHE_DIR", None)
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir("geospatial")
+
+    return BboxCache(cache_dir, max_size_gb=max_size_gb)
+
+
+def _get_cached_layer(
+    cache, name: str, bbox: tuple, dem: xr.DataArray = None, **keys
+) -> Union[xr.DataArray, None]:
+    # a hit is only counted once the layer is known to be usable
+    entry = cache.lookup(bbox, layer=name, **keys)
+    if entry is None:
+        cache.record_access(None)
+        return None
+    ds = cache.open(entry)
+
+    if dem is None:  # the DEM defines the grid, so it is clipped to the bbox
+        da = _clip_dem_to_bbox(ds[name], bbox, keys["res_m"])
+        if da is None:
+            logger.debug(f"Cached {name} does not cover the DEM grid of the bbox")
+            cache.record_access(None)
+            return None
+    else:  # all other layers are on the (cached) DEM grid
+        x, y = dem.rio.x_dim, dem.rio.y_dim
+        try:
+            da = ds[name].sel({x: dem[x].values, y: dem[y].values})
+        except KeyError:
+            # the layer was cached for a DEM with a different grid
+            logger.debug(f"Cached {name} is not on the DEM grid, fetching it again")
+            cache.record_access(None)
+            return None
+
+    if not cache.record_access(entry):  # evicted since the lookup
+        return None
+    logger.debug(f"Read {name} for bbox {list(bbox)} from {cache.cache_dir}")
+    return da.load()
+
+
+def _clip_dem_to_bbox(
+    dem: xr.DataArray, bbox: tuple, res_m: float
+) -> Union[xr.DataArray, None]:
+    # the pixels that get_dem_copernicus30 (stackstac) returns for the bbox: the
+    # four corners reprojected and snapped outwards to multiples of res_m. So all
+    # fetches are on the same lattice and a clip has the extent of a fresh fetch.
+    # Only the pixels next to the edge differ, as they were smoothed with their
+    # neighbours in the larger DEM.
+    from stackstac.geom_utils import reproject_bounds, snapped_bounds
+
+    epsg = dem.rio.crs.to_epsg()
+    xmin, ymin, xmax, ymax = snapped_bounds(
+        reproject_bounds(bbox, 4326, epsg), (res_m, res_m)
+    )
+    x, y = dem.rio.x_dim, dem.rio.y_dim
+    # the coordinates are the top-left corners of the pixels (half a pixel
+    # margin, so this also holds for centers)
+    da = dem.sel({x: slice(xmin, xmax - res_m / 2), y: slice(ymax, ymin + res_m / 2)})
+
+    shape = (round((ymax - ymin) / res_m), round((xmax - xmin) / res_m))
+    if da.shape != shape:
+        return None
+    return da.assign_attrs(bbox_request=list(bbox))
+
+
+def _put_cached_layer(cache, name: str, da: xr.DataArray, bbox: tuple, **keys):
+    try:
+        cache.put(da.to_dataset(name=name), bbox, layer=name, **keys)
+    except (TypeError, ValueError) as e:  # e.g. attributes that zarr cannot store
+        logger.warning(f"Could not add {name} to {cache.cache_dir}: {e}")
+
+
 def get_surface_index_mappings(
     path_config_xlsx: str,
     mapping_names=["stratigraphy_index", "roughness_length"],
     sampling="random",
 ) -> dict:
+    """
+    The mappings {surface_index: value} of the columns of the ground info sheet.
+    Use mapping_names=None for all numeric columns (see surface_index.remap_values).
+    """
     from .surface_index import get_ground_info_table
 
     ds_ground_info = get_ground_info_table(path_config_xlsx, sampling=sampling)
+    if mapping_names is None:
+        mapping_names = ds_ground_info.select_dtypes("number").columns
     mappings = {k: ds_ground_info[k].to_dict() for k in mapping_names}
 
     return mappings
@@ -180,59 +899,116 @@ def get_bbox(fpath: pathlib.Path) -> list[str]:
     return bbox
 
 
-@lru_cache
-def get_era5_from_s3_bucket(bbox: tuple, time_start: str, time_end: str):
+ERA5_S3_URL = "s3://spi-pamir-c7-sdsc/era5_data/central_asia/central_asia-{year}.zarr"
+
+
+def get_era5_from_s3_bucket(
+    bbox: tuple,
+    time_start: str,
+    time_end: str,
+    use_cache: bool = False,
+    source=None,
+    chunked_reads: bool = False,
+):
+    """
+    Get hourly ERA5 data for the bbox and period from the Central Asia zarr
+    stores on the S3 bucket (credentials in .env).
+
+    Parameters
+    ----------
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees.
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    use_cache : bool, optional
+        Serve the request from the on-disk ERA5 cache (see `get_era5_cache`)
+        if a cached extract covers the bbox and period, and add downloaded
+        data to the cache otherwise. By default False, as the cache is
+        written to <project>/data/cache/era5.
+    source : era5.ERA5Source or str, optional
+        Read the yearly zarr stores from somewhere else than the S3 bucket,
+        e.g. a local directory (see `era5.get_era5_source`).
+    chunked_reads : bool, optional
+        Fetch only the zarr chunks that intersect the bbox, concurrently, and
+        log the read amplification (see `era5.read_era5_extract`). By default
+        False (dask reads through open_mfdataset).
+
+    Returns
+    -------
+    xr.Dataset
+        The ERA5 data clipped to the bbox and loaded into memory, with z_surf
+        renamed to Zs, ready for `cryogrid_pytools.forcing.era5_to_matlab`.
+    """
     from copy import deepcopy
 
-    import dotenv
-    import pandas as pd
-    import xarray as xr
+    from .era5 import get_era5_source, open_era5_mfdataset, read_era5_extract
 
     bbox = list(deepcopy(bbox))
+    source = get_era5_source(source)
 
-    if not dotenv.load_dotenv():
-        raise FileNotFoundError("Could not find .env file with S3 credentials")
+    if use_cache:
+        ds_bbox = _get_era5_from_cache(bbox, time_start, time_end, source)
+        if ds_bbox is not None:
+            return ds_bbox
 
-    t0 = pd.Timestamp(time_start)
-    t1 = pd.Timestamp(time_end)
-    year0 = t0.year
-    year1 = t1.year
-
-    fname_era5_s3 = (
-        "s3://spi-pamir-c7-sdsc/era5_data/central_asia/central_asia-{year}.zarr"
-    )
-    flist_era5_zarr = [
-        fname_era5_s3.format(year=year) for year in range(year0, year1 + 1)
-    ]
-
-    ds_central_asia = xr.open_mfdataset(
-        flist_era5_zarr,
-        parallel=True,
-        engine="zarr",
-        combine="by_coords",  # combines by time dime
-        compat="override",  # fastest option
-        coords="all",  # keep all coordinates
-    )  # make sure that .env is set up correctly
+    ds = open_era5_mfdataset(time_start, time_end, source)
 
     logger.info(
         f"Downloading ERA5 data for bbox {bbox} from {time_start} to {time_end}"
     )
 
-    ds = (
-        ds_central_asia.sel(  # contains all central asia data from 1940 to 2024-10-01
-            time=slice(time_start, time_end)
-        )  # there are some values in 1959-01-01 that are nans
-        .rio.write_crs(4326)  # set the crs to epsg:4326 so we can clip using rioxarray
-        .rename(z_surf="Zs")  # prepare for the cg.era5_to_matlab function
-    )
+    ds_bbox, bbox_used = clip_era5_to_bbox(ds, bbox)
+
+    if chunked_reads:
+        # the extract of bbox_used contains the same points as ds_bbox
+        ds_extract, _ = read_era5_extract(bbox_used, time_start, time_end, source)
+        ds_bbox, _ = clip_era5_to_bbox(ds_extract, bbox)
+
+    if use_cache:
+        # cache everything inside the (possibly expanded) bbox so that any
+        # request within bbox_used can be clipped from the cached extract
+        if not chunked_reads:
+            ds_extract = ds.rio.clip_box(
+                *bbox_used, crs="epsg:4326", allow_one_dimensional_raster=True
+            ).load()
+        get_era5_cache().put(
+            ds_extract, bbox_used, time_start, time_end, source=source.url_template
+        )
+        ds_bbox, _ = clip_era5_to_bbox(ds_extract, bbox)
+
+    # load the data into memory (takes ~20 secs with fast connection)
+    ds_bbox = ds_bbox.load()
+
+    return ds_bbox
+
+
+def clip_era5_to_bbox(ds: xr.Dataset, bbox: list) -> tuple[xr.Dataset, list]:
+    """
+    Clip ERA5 data to the bbox, making sure that there are at least two
+    points in latitude and longitude (bbox is expanded by 0.2 deg otherwise).
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        ERA5 data with latitude and longitude and a crs written (epsg:4326)
+    bbox : list
+        The bounding box [W, S, E, N] in degrees.
+
+    Returns
+    -------
+    tuple[xr.Dataset, list]
+        The clipped data and the bbox that was used to clip the data
+        (differs from the given bbox when it had to be expanded).
+    """
+    bbox = list(bbox)
 
     # clip to our bbox
     ds_bbox = ds.rio.clip_box(*bbox, crs="epsg:4326", allow_one_dimensional_raster=True)
 
     if ds_bbox.latitude.size == 0 or ds_bbox.longitude.size == 0:
-        raise ValueError(
-            f"Could not find any data for bbox {bbox} from {time_start} to {time_end}"
-        )
+        raise ValueError(f"Could not find any data for bbox {bbox}")
 
     if ds_bbox.latitude.size <= 1 or ds_bbox.longitude.size <= 1:
         logger.warning(
@@ -250,10 +1026,61 @@ def get_era5_from_s3_bucket(bbox: tuple, time_start: str, time_end: str):
             latitude=slice(0, 2), longitude=slice(0, 2)
         )
 
-    # load the data into memory (takes ~20 secs with fast connection)
-    ds_bbox = ds_bbox.load()
+    return ds_bbox, bbox
+
+
+def get_era5_cache(cache_dir=None, max_size_gb=20.0):
+    """
+    The on-disk cache of ERA5 extracts - defaults to <project>/data/cache/era5
+
+    Parameters
+    ----------
+    cache_dir : Union[str, pathlib.Path], optional
+        Location of the cache. Can also be set with the environment variable
+        CRYOGRID_ERA5_CACHE_DIR.
+    max_size_gb : float, optional
+        Least recently used extracts are removed beyond this size, by default 20 GB.
+
+    Returns
+    -------
+    BboxCache
+        The cache object (see `cache.BboxCache`).
+    """
+    import os
+
+    from .cache import BboxCache, get_default_cache_dir
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("CRYOGRID_ERA5_CACHE_DIR", None)
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir("era5")
+
+    return BboxCache(cache_dir, max_size_gb=max_size_gb)
 
-    return ds_bbox
+
+def _get_era5_from_cache(bbox, time_start, time_end, source) -> Union[xr.Dataset, None]:
+    cache = get_era5_cache()
+    url = source.url_template
+
+    entry = cache.lookup(bbox, time_start, time_end, source=url)
+    if entry is not None:
+        ds = cache.open(entry, time_start, time_end).rio.write_crs(4326)
+        ds_bbox, bbox_used = clip_era5_to_bbox(ds, bbox)
+        if bbox_used != bbox:
+            # the bbox had to be expanded, so the expanded bbox must be cached too
+            entry = cache.lookup(bbox_used, time_start, time_end, source=url)
+            if entry is not None:
+                ds = cache.open(entry, time_start, time_end).rio.write_crs(4326)
+                ds_bbox, _ = clip_era5_to_bbox(ds, bbox)
+
+    if cache.record_access(entry):
+        logger.info(
+            f"Reading ERA5 data for bbox {bbox} from {time_start} to {time_end} "
+            f"from the cache ({cache.cache_dir})"
+        )
+        return ds_bbox.load()
+
+    return None
 
 
 def make_dataset_netcdf_ready(ds):
@@ -277,3 +1104,153 @@ def make_dataset_netcdf_ready(ds):
     ds = ds.rio.write_crs(crs)
 
     return ds
+
+
+def get_geospatial_encoding(
+    ds: xr.Dataset,
+    continuous="float32",
+    compression="zlib",
+    complevel=4,
+    chunk_size=512,
+) -> dict:
+    """
+    A compact netcdf encoding for each variable of the geospatial data.
+
+    Layers with only integer values (classes such as land_cover and
+    stratigraphy_index, and the glacier masks) are stored in the smallest
+    integer type, e.g. uint8, with the largest value as _FillValue if they
+    contain NaNs. The shuffle filter packs the 0/1 masks almost as well as
+    bits would. Continuous layers are stored as float32 or, with
+    continuous="int16", as int16 scaled to their range (lossy, the maximum
+    error is logged). All variables are chunked in chunk_size tiles.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The geospatial data (e.g. from `get_geospatial_data`).
+    continuous : str, optional
+        "float32" (lossless for the float32 data) or "int16", by default "float32".
+    compression : str, optional
+        "zlib", or a compression of netCDF4 >= 1.6 (e.g. "zstd" or "blosc_lz4")
+        if the netcdf-c library was built with it. By default "zlib".
+    complevel : int, optional
+        The compression level, by default 4.
+    chunk_size : int, optional
+        The size of the chunks along x and y in pixels, by default 512.
+
+    Returns
+    -------
+    dict
+        The encoding for ds.to_netcdf.
+    """
+    import numpy as np
+
+    if continuous not in ("float32", "int16"):
+        raise ValueError(f"continuous must be 'float32' or 'int16', got {continuous}")
+
+    if compression == "zlib":
+        compressor = dict(zlib=True, complevel=complevel, shuffle=True)
+    else:
+        compressor = dict(compression=compression, complevel=complevel, shuffle=True)
+
+    encoding = {}
+    for key, da in ds.data_vars.items():
+        values = np.asarray(da.values)
+        enc = dict(compressor)
+        enc["chunksizes"] = tuple(
+            min(size, chunk_size) if dim in (ds.rio.x_dim, ds.rio.y_dim) else 1
+            for dim, size in zip(da.dims, da.shape)
+        )
+
+        finite = values[np.isfinite(values)] if values.dtype.kind == "f" else values
+        has_nan = finite.size < values.size
+        if values.dtype.kind == "b":
+            enc["dtype"] = "uint8"
+        elif finite.size == 0:
+            enc["dtype"] = "float32"
+        elif (finite == np.round(finite)).all():
+            vmin, vmax = int(finite.min()), int(finite.max())
+            dtype = np.promote_types(
+                np.min_scalar_type(vmin), np.min_scalar_type(vmax + has_nan)
+            )
+            enc["dtype"] = dtype.name
+            if has_nan:
+                enc["_FillValue"] = np.iinfo(dtype).max
+        elif continuous == "int16":
+            vmin, vmax = float(finite.min()), float(finite.max())
+            # -32768 is kept for the fill value
+            scale = (vmax - vmin) / 65534 or 1.0
+            enc.update(
+                dtype="int16",
+                scale_factor=scale,
+                add_offset=vmin + 32767 * scale,
+                _FillValue=np.int16(-32768),
+            )
+            logger.debug(
+                f"Encoding {key} as int16 with a maximum error of {scale / 2:.3g}"
+            )
+        else:
+            enc["dtype"] = "float32"
+
+        encoding[key] = enc
+
+    return encoding
+
+
+def save_geospatial_netcdf(
+    ds: xr.Dataset, fname: Union[str, pathlib.Path], compact=False, **kwargs
+) -> pathlib.Path:
+    """
+    Save the geospatial data to netcdf - with zlib only (compact=False) or with
+    the compact, dtype-aware encoding of `get_geospatial_encoding` (kwargs are
+    passed on to it).
+    """
+    if compact:
+        encoding = get_geospatial_encoding(ds, **kwargs)
+    else:
+        encoding = {k: {"zlib": True} for k in ds.data_vars}
+
+    ds.to_netcdf(fname, encoding=encoding)
+
+    return pathlib.Path(fname)
+
+
+def save_geospatial_rasters(
+    ds: xr.Dataset,
+    forcing_path: Union[str, pathlib.Path],
+    keys=GEOSPATIAL_RASTER_KEYS,
+    compact=False,
+    max_workers=6,
+) -> list[pathlib.Path]:
+    """
+    Save the layers that the run needs as GeoTIFFs (<forcing_path>/<key>.tif).
+
+    The files are written concurrently in a thread pool. With compact=True,
+    they are tiled (256 x 256) and compressed with deflate and a predictor.
+    The dtypes are kept as they are (float32), since those are what the
+    MATLAB templates read.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    forcing_path = pathlib.Path(forcing_path)
+
+    def save(key):
+        da = ds[key]
+        kwargs = {}
+        if compact:
+            predictor = 3 if da.dtype.kind == "f" else 2
+            kwargs = dict(
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                compress="deflate",
+                predictor=predictor,
+            )
+        fname = forcing_path / f"{key}.tif"
+        da.rio.to_raster(fname, **kwargs)
+        return fname
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        fnames = list(pool.map(save, keys))
+
+    return fnames
@@ -0,0 +1,1403 @@
+"""
+Extraction of ERA5 forcing from the yearly Central Asia zarr stores.
+
+The stores are read through an `ERA5Source`, which defaults to the S3 bucket
+but can also point to a local directory or an fsspec memory filesystem (e.g.
+with synthetic stores from `make_synthetic_era5_stores` for benchmarking).
+
+`get_era5_from_s3_bucket` (in data.py) loads the whole period into memory
+before it is written to era5.mat. The streaming functions here walk through
+the yearly stores one chunk (year, month, ...) at a time instead, so that the
+peak memory is bounded by the size of a single chunk rather than the length
+of the period. `era5_to_matlab_for_runs` does the same for many runs at once,
+reading the data that the runs share only once per year. Each era5.mat gets
+a json manifest with its coverage so that `extend_era5_mat` can append the
+missing years when the period of a run is extended.
+
+`read_era5_extract` bypasses dask and fetches only the zarr chunks that
+intersect the bbox, concurrently, and reports the read amplification (bytes
+decoded per byte used) of the chunk layout.
+"""
+
+import pathlib
+from typing import Callable, Optional, Union
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from loguru import logger
+
+from .data import ERA5_S3_URL, clip_era5_to_bbox
+
+# keys in the dictionary from cryogrid_pytools.forcing.era5_to_matlab that
+# have time as the last dimension - all other keys are static. Zs only has
+# a time dimension when the period spans more than one yearly store
+ERA5_MAT_TIME_KEYS = (
+    "t",
+    "Zs",
+    "u10",
+    "v10",
+    "ps",
+    "Td2",
+    "T2",
+    "SW",
+    "LW",
+    "S_TOA",
+    "P",
+    "T",
+    "Z",
+    "q",
+    "u",
+    "v",
+)
+
+ERA5_FNAME_TEMPLATE = "central_asia-{year}.zarr"
+
+
+class ERA5Source:
+    """
+    The location of the yearly ERA5 zarr stores.
+
+    Parameters
+    ----------
+    url_template : str, optional
+        Path or URL of the yearly zarr stores with a {year} placeholder. Any
+        fsspec protocol is supported (s3://, memory://, local paths, ...).
+        By default the Central Asia stores on the S3 bucket.
+    storage_options : dict, optional
+        Passed on to fsspec (e.g. S3 credentials). If not given for s3:// URLs,
+        the credentials are read from the .env file.
+    """
+
+    def __init__(
+        self, url_template: str = ERA5_S3_URL, storage_options: Optional[dict] = None
+    ):
+        self.url_template = str(url_template)
+        self.storage_options = storage_options
+
+    def __repr__(self):
+        return f"ERA5Source('{self.url_template}')"
+
+    def __eq__(self, other):
+        if not isinstance(other, ERA5Source):
+            return False
+        return (self.url_template, self.storage_options) == (
+            other.url_template,
+            other.storage_options,
+        )
+
+    def __hash__(self):
+        # needed for lru_cache in get_era5_from_s3_bucket
+        return hash((self.url_template, repr(self.storage_options)))
+
+    @classmethod
+    def from_directory(
+        cls, directory: Union[str, pathlib.Path], fname_template=ERA5_FNAME_TEMPLATE
+    ):
+        """Yearly zarr stores in a local directory"""
+        directory = pathlib.Path(directory).expanduser().resolve()
+        return cls(str(directory / fname_template))
+
+    @classmethod
+    def in_memory(cls, name: str = "era5", fname_template=ERA5_FNAME_TEMPLATE):
+        """Yearly zarr stores on the fsspec memory filesystem (lost on exit)"""
+        return cls(f"memory://{name}/{fname_template}")
+
+    @property
+    def protocol(self) -> str:
+        if "://" in self.url_template:
+            return self.url_template.split("://")[0]
+        return "file"
+
+    def get_url(self, year: int) -> str:
+        return self.url_template.format(year=year)
+
+    def check_credentials(self):
+        import dotenv
+
+        if self.protocol != "s3" or self.storage_options is not None:
+            return
+        if not dotenv.load_dotenv():
+            raise FileNotFoundError("Could not find .env file with S3 credentials")
+
+    def list_years(self) -> list[int]:
+        """The years for which a store exists"""
+        import re
+
+        import fsspec
+
+        self.check_credentials()
+        fs, path = fsspec.core.url_to_fs(
+            self.url_template.replace("{year}", "*"), **(self.storage_options or {})
+        )
+        regex = re.escape(path.split("/")[-1]).replace(r"\*", r"(\d{4})")
+        years = [re.search(regex, p) for p in fs.glob(path)]
+        return sorted(int(m.group(1)) for m in years if m is not None)
+
+    def get_mapper(self, year: int):
+        """The fsspec mapper of the store of a single year (for reading raw chunks)"""
+        import fsspec
+
+        self.check_credentials()
+        return fsspec.get_mapper(self.get_url(year), **(self.storage_options or {}))
+
+    def open_year(self, year: int, **kwargs) -> xr.Dataset:
+        """Lazily open the store of a single year"""
+        self.check_credentials()
+        if self.storage_options is not None:
+            kwargs.setdefault("backend_kwargs", {})
+            kwargs["backend_kwargs"]["storage_options"] = self.storage_options
+        return xr.open_dataset(self.get_url(year), engine="zarr", chunks={}, **kwargs)
+
+
+def get_era5_source(source: Union[ERA5Source, str, None] = None) -> ERA5Source:
+    """
+    Returns an ERA5Source from a source, a url template or a directory. If
+    None, then the environment variable CRYOGRID_ERA5_SOURCE is used if set,
+    otherwise the S3 bucket.
+    """
+    import os
+
+    if isinstance(source, ERA5Source):
+        return source
+
+    if source is None:
+        source = os.environ.get("CRYOGRID_ERA5_SOURCE", ERA5_S3_URL)
+
+    source = str(source)
+    if "{year}" in source:
+        return ERA5Source(source)
+    elif pathlib.Path(source).expanduser().is_dir():
+        return ERA5Source.from_directory(source)
+    else:
+        raise ValueError(
+            f"ERA5 source must be a directory or contain a {{year}} placeholder: {source}"
+        )
+
+
+def open_era5_mfdataset(
+    time_start: str, time_end: str, source: Union[ERA5Source, str] = None
+) -> xr.Dataset:
+    """
+    Lazily open all yearly ERA5 stores for the period as one dataset.
+
+    Parameters
+    ----------
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+
+    Returns
+    -------
+    xr.Dataset
+        The period of ERA5 data with the crs written and z_surf renamed to Zs.
+    """
+    source = get_era5_source(source)
+    source.check_credentials()
+
+    t0 = pd.Timestamp(time_start)
+    t1 = pd.Timestamp(time_end)
+    flist_era5_zarr = [source.get_url(year) for year in range(t0.year, t1.year + 1)]
+
+    kwargs = {}
+    if source.storage_options is not None:
+        kwargs["backend_kwargs"] = dict(storage_options=source.storage_options)
+
+    ds_central_asia = xr.open_mfdataset(
+        flist_era5_zarr,
+        parallel=True,
+        engine="zarr",
+        combine="by_coords",  # combines by time dime
+        compat="override",  # fastest option
+        coords="all",  # keep all coordinates
+        **kwargs,
+    )  # make sure that .env is set up correctly
+
+    ds = (
+        ds_central_asia.sel(  # contains all central asia data from 1940 to 2024-10-01
+            time=slice(time_start, time_end)
+        )  # there are some values in 1959-01-01 that are nans
+        .rio.write_crs(4326)  # set the crs to epsg:4326 so we can clip using rioxarray
+        .rename(z_surf="Zs")  # prepare for the cg.era5_to_matlab function
+    )
+
+    return ds
+
+
+def read_era5_extract(
+    bbox: tuple,
+    time_start: str,
+    time_end: str,
+    source: Union[ERA5Source, str] = None,
+    max_workers: int = 16,
+) -> tuple[xr.Dataset, dict]:
+    """
+    Read all ERA5 grid cells within the bbox by fetching only the zarr chunks that intersect it.
+
+    The chunks that intersect the bbox and period are found from the store
+    metadata and are fetched and decompressed concurrently in a thread pool.
+    The result is identical to loading
+    `open_era5_mfdataset(...).rio.clip_box(*bbox)`, but the number of bytes
+    that are read, decompressed and used are reported so that the read
+    amplification of the chunk layout can be seen.
+
+    Parameters
+    ----------
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees. Note that this is not
+        expanded (use clip_era5_to_bbox to get the bbox that is used).
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+    max_workers : int, optional
+        The maximum number of chunks that are fetched at the same time, by default 16.
+
+    Returns
+    -------
+    tuple[xr.Dataset, dict]
+        The data loaded into memory (with the crs written and z_surf renamed
+        to Zs) and the read statistics: n_chunks, mb_requested (compressed
+        chunks that were fetched), mb_decoded (decompressed chunks), mb_used
+        (the data within the bbox) and amplification (mb_decoded / mb_used).
+    """
+    source = get_era5_source(source)
+
+    t0 = pd.Timestamp(time_start)
+    t1 = pd.Timestamp(time_end)
+    years = range(t0.year, t1.year + 1)
+
+    datasets = []
+    stats = dict(n_chunks=0, mb_requested=0.0, mb_decoded=0.0, mb_used=0.0)
+    for year in years:
+        ds_year = _open_era5_year(source, year)
+
+        time = ds_year.time.to_index()
+        i0, i1 = time.slice_indexer(time_start, time_end).indices(time.size)[:2]
+        if i1 <= i0:
+            logger.warning(f"No ERA5 data in {year} for {time_start} to {time_end}")
+            continue
+
+        isel = _get_bbox_isel(ds_year, bbox)
+        isel["time"] = slice(i0, i1)
+
+        ds, stats_year = _read_zarr_subset(
+            ds_year, source.get_mapper(year), isel, max_workers
+        )
+        for key in stats:
+            stats[key] += stats_year[key]
+
+        if len(years) > 1:
+            ds = _broadcast_static_variables(ds)
+        datasets += [ds]
+
+    if len(datasets) == 0:
+        raise ValueError(
+            f"Could not find any ERA5 data from {time_start} to {time_end}"
+        )
+
+    ds = xr.concat(datasets, dim="time", coords="minimal", compat="override")
+    stats["amplification"] = stats["mb_decoded"] / max(stats["mb_used"], 1e-12)
+
+    logger.info(
+        f"Read {stats['n_chunks']} ERA5 chunks for bbox {list(bbox)}: "
+        f"{stats['mb_requested']:.1f} MB requested, {stats['mb_decoded']:.1f} MB "
+        f"decoded, {stats['mb_used']:.1f} MB used ({stats['amplification']:.1f}x)"
+    )
+
+    return ds, stats
+
+
+def _get_bbox_isel(ds: xr.Dataset, bbox: tuple) -> dict:
+    """The positions of the grid cells that rio.clip_box selects as slices"""
+    ds_clip = ds.rio.clip_box(*bbox, crs="epsg:4326", allow_one_dimensional_raster=True)
+
+    isel = {}
+    for dim in ["latitude", "longitude"]:
+        idx = ds.indexes[dim].get_indexer(ds_clip[dim].values)
+        if idx.size == 0 or (idx < 0).any() or not (np.diff(idx) == 1).all():
+            raise ValueError(f"Could not find a contiguous {dim} range for bbox {bbox}")
+        isel[dim] = slice(int(idx[0]), int(idx[-1]) + 1)
+
+    return isel
+
+
+def _read_zarr_subset(
+    ds: xr.Dataset, mapper, isel: dict, max_workers: int = 16
+) -> tuple[xr.Dataset, dict]:
+    """
+    Read the data variables of ds (lazily opened from mapper) for the slices in isel.
+
+    Only the chunks that intersect the slices are fetched (concurrently) and
+    each chunk is copied into the output arrays, which are then CF decoded
+    the same way as xarray does when opening the store.
+    """
+    import itertools
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    import zarr
+
+    group = zarr.open_consolidated(mapper, mode="r")
+
+    tasks = []
+    variables = {}
+    for name in ds.data_vars:
+        arr = group[name]
+        dims = ds[name].dims
+        zarray = json.loads(group.store[f"{arr.path}/.zarray"])
+        sep = zarray.get("dimension_separator") or "."
+
+        bounds = [
+            isel.get(dim, slice(None)).indices(n)[:2] for dim, n in zip(dims, arr.shape)
+        ]
+        out = np.empty([b - a for a, b in bounds], dtype=arr.dtype)
+
+        chunk_ranges = [
+            range(a // c, (b - 1) // c + 1) for (a, b), c in zip(bounds, arr.chunks)
+        ]
+        for chunk_idx in itertools.product(*chunk_ranges):
+            key = f"{arr.path}/{sep.join(map(str, chunk_idx)) or '0'}"
+            tasks += [(arr, key, chunk_idx, bounds, out)]
+
+        attrs = {k: v for k, v in arr.attrs.items() if k != "_ARRAY_DIMENSIONS"}
+        if arr.fill_value is not None:
+            attrs["_FillValue"] = arr.fill_value  # as done by xarray's zarr backend
+        variables[name] = xr.Variable(dims, out, attrs)
+
+    def read_chunk(task):
+        arr, key, chunk_idx, bounds, out = task
+        try:
+            raw = mapper[key]
+        except KeyError:  # chunks that were never written are not stored
+            raw = None
+        chunk = _decode_zarr_chunk(arr, raw)
+
+        src, dst = [], []
+        for i, (a, b), c in zip(chunk_idx, bounds, arr.chunks):
+            lo, hi = max(a, i * c), min(b, (i + 1) * c)
+            src += [slice(lo - i * c, hi - i * c)]
+            dst += [slice(lo - a, hi - a)]
+        # chunks do not overlap, so the threads write to different parts of out
+        out[tuple(dst)] = chunk[tuple(src)]
+
+        return 0 if raw is None else len(raw), chunk.nbytes
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        nbytes = list(pool.map(read_chunk, tasks))
+
+    data_vars = {
+        name: xr.conventions.decode_cf_variable(name, var)
+        for name, var in variables.items()
+    }
+    ds_subset = xr.Dataset(data_vars, coords=ds.isel(isel).coords, attrs=ds.attrs)
+
+    stats = dict(
+        n_chunks=len(tasks),
+        mb_requested=sum(n for n, _ in nbytes) / 1e6,
+        mb_decoded=sum(n for _, n in nbytes) / 1e6,
+        mb_used=sum(var.data.nbytes for var in variables.values()) / 1e6,
+    )
+
+    return ds_subset, stats
+
+
+def _decode_zarr_chunk(arr, raw: Union[bytes, None]) -> np.ndarray:
+    from numcodecs.compat import ensure_ndarray
+
+    if raw is None:
+        return np.full(arr.chunks, arr.fill_value, dtype=arr.dtype)
+
+    chunk = arr.compressor.decode(raw) if arr.compressor is not None else raw
+    for codec in reversed(arr.filters or []):
+        chunk = codec.decode(chunk)
+
+    chunk = ensure_ndarray(chunk).view(arr.dtype)
+    return chunk.reshape(arr.chunks, order=arr.order)
+
+
+def make_synthetic_era5_stores(
+    source: Union[ERA5Source, str],
+    years: list[int],
+    bbox: tuple = (69.0, 36.0, 75.0, 41.0),
+    res: float = 0.25,
+    levels: tuple = (500, 600, 700),
+    chunks: Optional[dict] = None,
+    seed: int = 0,
+) -> ERA5Source:
+    """
+    Write yearly zarr stores with ERA5-like hourly data for offline testing
+    and benchmarking of the extraction. The variables, dimensions, units and
+    value ranges match the Central Asia stores, but the values are synthetic
+    (a diurnal cycle, a spatial gradient and noise).
+
+    Parameters
+    ----------
+    source : Union[ERA5Source, str]
+        Where to write the stores, e.g. ERA5Source.in_memory() or a directory.
+    years : list[int]
+        The years to create a store for.
+    bbox : tuple, optional
+        The domain [W, S, E, N] of the stores, by default a region in the Pamirs.
+    res : float, optional
+        The grid spacing in degrees, by default 0.25 (as ERA5).
+    levels : tuple, optional
+        The pressure levels in hPa, by default (500, 600, 700).
+    chunks : dict, optional
+        The chunks of the stores, by default one month of time steps and the
+        full latitude/longitude extent. Since the data are written month by
+        month, smaller time chunks must be a divisor of 24 (one day).
+    seed : int, optional
+        The seed of the random noise.
+
+    Returns
+    -------
+    ERA5Source
+        The source that the stores were written to.
+    """
+    source = get_era5_source(source)
+    rng = np.random.default_rng(seed)
+
+    W, S, E, N = bbox
+    lat = np.arange(N, S - res / 2, -res)  # ERA5 latitudes are decreasing
+    lon = np.arange(W, E + res / 2, res)
+    if chunks is None:
+        chunks = dict(time=24 * 31, level=-1, latitude=-1, longitude=-1)
+
+    # (low, high) of each variable - single level and pressure level variables
+    single_levels = dict(
+        u10=(-8, 8),
+        v10=(-8, 8),
+        sp=(45_000, 80_000),
+        d2m=(235, 285),
+        t2m=(240, 300),
+        ssrd=(0, 3.5e6),
+        strd=(0.6e6, 1.4e6),
+        tisr=(0, 4.5e6),
+        tp=(0, 2e-3),
+    )
+    pressure_levels = dict(
+        t=(220, 295), z=(30_000, 60_000), q=(0, 1e-2), u=(-25, 25), v=(-25, 25)
+    )
+
+    gradient = np.linspace(0, 1, lat.size)[:, None] * np.linspace(1, 0, lon.size)
+    z_surf = (1_000 + 5_000 * gradient) * 9.81
+
+    def synthetic(time, low, high, shape):
+        diurnal = np.sin(2 * np.pi * time.hour.values / 24)
+        diurnal = diurnal.reshape((-1,) + (1,) * (len(shape) - 1))
+        noise = rng.random(shape, dtype=np.float32)
+        frac = 0.4 + 0.2 * diurnal + 0.2 * gradient + 0.2 * noise
+        return (low + (high - low) * frac).astype(np.float32)
+
+    for year in years:
+        url = source.get_url(year)
+        storage_options = source.storage_options
+        time_year = pd.date_range(f"{year}-01-01", f"{year}-12-31 23:00", freq="h")
+
+        # written month by month so that large domains fit in memory
+        for month, time in time_year.to_series().groupby(time_year.month):
+            time = pd.DatetimeIndex(time.values)
+            shape_sl = (time.size, lat.size, lon.size)
+            shape_pl = (time.size, len(levels), lat.size, lon.size)
+            dims_sl = ("time", "latitude", "longitude")
+            dims_pl = ("time", "level", "latitude", "longitude")
+
+            ds = xr.Dataset(
+                coords=dict(time=time, level=list(levels), latitude=lat, longitude=lon)
+            )
+            for key, (low, high) in single_levels.items():
+                ds[key] = dims_sl, synthetic(time, low, high, shape_sl)
+            for key, (low, high) in pressure_levels.items():
+                ds[key] = dims_pl, synthetic(time, low, high, shape_pl)
+            ds["z_surf"] = ("latitude", "longitude"), z_surf.astype(np.float32)
+            ds = ds.chunk({k: v for k, v in chunks.items() if k in ds.dims})
+
+            if month == 1:
+                ds.to_zarr(url, mode="w", storage_options=storage_options)
+            else:
+                ds.drop_vars("z_surf").to_zarr(
+                    url, append_dim="time", storage_options=storage_options
+                )
+
+        _consolidate_zarr(url, storage_options)
+        logger.debug(f"Wrote synthetic ERA5 data for {year} to {url}")
+
+    return source
+
+
+def _consolidate_zarr(url: str, storage_options: Optional[dict] = None):
+    import fsspec
+    import zarr
+
+    zarr.consolidate_metadata(fsspec.get_mapper(url, **(storage_options or {})))
+
+
+def open_era5_years(
+    time_start: str, time_end: str, source: Union[ERA5Source, str] = None
+) -> dict[int, xr.Dataset]:
+    """
+    Lazily open the yearly ERA5 zarr stores that overlap with the period.
+
+    Parameters
+    ----------
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+
+    Returns
+    -------
+    dict[int, xr.Dataset]
+        The lazy datasets of each year, subset to the period, with the crs
+        written and z_surf renamed to Zs. Years without data are dropped.
+    """
+    source = get_era5_source(source)
+
+    t0 = pd.Timestamp(time_start)
+    t1 = pd.Timestamp(time_end)
+
+    years = range(t0.year, t1.year + 1)
+    datasets = {}
+    for year in years:
+        ds = _open_era5_year(source, year).sel(time=slice(time_start, time_end))
+        if ds.time.size == 0:
+            logger.warning(f"No ERA5 data in {year} for {time_start} to {time_end}")
+            continue
+        if len(years) > 1:
+            ds = _broadcast_static_variables(ds)
+        datasets[year] = ds
+
+    if len(datasets) == 0:
+        raise ValueError(
+            f"Could not find any ERA5 data from {time_start} to {time_end}"
+        )
+
+    return datasets
+
+
+def get_chunk_periods(ds: xr.Dataset, chunk_freq: str = "Y") -> pd.PeriodIndex:
+    """The period (e.g. year or month) that each time step of ds belongs to"""
+    return ds.time.to_index().to_period(chunk_freq)
+
+
+def iter_era5_chunks(
+    datasets: dict[int, xr.Dataset], bbox: tuple, chunk_freq: str = "Y"
+):
+    """
+    Clip, load and validate the ERA5 data one chunk at a time.
+
+    Parameters
+    ----------
+    datasets : dict[int, xr.Dataset]
+        Lazy yearly datasets from `open_era5_years`.
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees.
+    chunk_freq : str, optional
+        The pandas period frequency of the chunks, by default "Y" (one year).
+        Use "M" or "Q" for smaller chunks when the bbox is large.
+
+    Yields
+    ------
+    tuple[pd.Period, xr.Dataset]
+        The period of the chunk and the clipped data loaded into memory.
+    """
+    grid = None
+    time_last = None
+    for year, ds_year in datasets.items():
+        ds_clip, _ = clip_era5_to_bbox(ds_year, bbox)
+
+        periods = get_chunk_periods(ds_clip, chunk_freq)
+        for period in periods.unique():
+            ds_chunk = ds_clip.isel(time=np.where(periods == period)[0]).load()
+
+            grid = _validate_era5_chunk(ds_chunk, period, grid, time_last)
+            time_last = ds_chunk.time.values[-1]
+
+            yield period, ds_chunk
+
+
+def era5_to_matlab_streaming(
+    bbox: tuple,
+    time_start: str,
+    time_end: str,
+    save_path: Union[str, pathlib.Path],
+    chunk_freq: str = "Y",
+    progress_callback: Optional[Callable] = None,
+    source: Union[ERA5Source, str] = None,
+    compact: bool = False,
+) -> pathlib.Path:
+    """
+    Write era5.mat for the bbox and period without loading the full period.
+
+    Each chunk is converted with cryogrid_pytools.forcing.era5_to_matlab and
+    the (scaled integer) arrays are written to memory-mapped files on disk.
+    These are then saved to the .mat file one time slab at a time (see
+    `ERA5MatWriter`), which is a MATLAB v7.3 file, as scipy's v5 writer
+    would hold the whole period in memory. The era struct is identical to
+    `era5_to_matlab(get_era5_from_s3_bucket(...))`.
+
+    Parameters
+    ----------
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees.
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    save_path : Union[str, pathlib.Path]
+        The path of the .mat file.
+    chunk_freq : str, optional
+        The pandas period frequency of the chunks, by default "Y" (one year).
+    progress_callback : Callable, optional
+        Called after each chunk as progress_callback(n_done, n_chunks, period).
+        Defaults to logging the progress.
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+    compact : bool, optional
+        Store floats as float32 (see `save_era5_mat`), by default False.
+
+    Returns
+    -------
+    pathlib.Path
+        The path to the .mat file.
+    """
+    if progress_callback is None:
+        progress_callback = _log_progress
+
+    datasets = open_era5_years(time_start, time_end, source)
+    n_times = sum(ds.time.size for ds in datasets.values())
+    n_chunks = sum(
+        get_chunk_periods(ds, chunk_freq).unique().size for ds in datasets.values()
+    )
+
+    logger.info(
+        f"Streaming ERA5 data for bbox {list(bbox)} from {time_start} to {time_end} "
+        f"in {n_chunks} chunks to {save_path}"
+    )
+
+    times = []
+    with ERA5MatWriter(save_path, n_times, compact) as writer:
+        chunks = iter_era5_chunks(datasets, bbox, chunk_freq)
+        for n_done, (period, ds_chunk) in enumerate(chunks, start=1):
+            writer.write(ds_chunk)
+            times += [ds_chunk.time.values[0], ds_chunk.time.values[-1]]
+            progress_callback(n_done, n_chunks, period)
+        writer.save()
+
+    write_era5_manifest(
+        save_path, bbox, times[0], times[-1], n_times, get_era5_source(source)
+    )
+
+    return writer.save_path
+
+
+def extend_era5_mat(
+    save_path: Union[str, pathlib.Path],
+    bbox: tuple,
+    time_start: str,
+    time_end: str,
+    chunk_freq: str = "Y",
+    progress_callback: Optional[Callable] = None,
+    source: Union[ERA5Source, str] = None,
+    compact: Optional[bool] = None,
+) -> pathlib.Path:
+    """
+    Extend an existing era5.mat to the period by fetching only the missing time steps.
+
+    The coverage of the existing file is read from its manifest (see
+    `read_era5_coverage`). The time steps before and after the coverage are
+    streamed from the yearly stores and written around the existing data with
+    an `ERA5MatWriter`, so the result is identical to writing the whole
+    period with `era5_to_matlab_streaming`. If the file does not exist, the
+    whole period is written. Existing time steps outside of the period are kept.
+
+    The existing file is loaded into memory as a whole (see `load_era5_mat`),
+    so unlike the streamed new time steps, extending needs memory for the
+    existing period.
+
+    Parameters
+    ----------
+    save_path : Union[str, pathlib.Path]
+        The path of the existing .mat file, which is replaced by the extended file.
+    bbox : tuple
+        The bounding box [W, S, E, N] in degrees. Must be the bbox of the existing file.
+    time_start : str
+        The start of the period (inclusive).
+    time_end : str
+        The end of the period (inclusive).
+    chunk_freq : str, optional
+        The pandas period frequency of the chunks, by default "Y" (one year).
+    progress_callback : Callable, optional
+        Called after each chunk as progress_callback(n_done, n_chunks, period).
+        Defaults to logging the progress.
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+    compact : bool, optional
+        Store floats as float32 (see `save_era5_mat`). By default as in the
+        existing file. The extended file is always a MATLAB v7.3 file (see
+        `ERA5MatWriter`).
+
+    Returns
+    -------
+    pathlib.Path
+        The path to the .mat file.
+    """
+    import os
+
+    save_path = pathlib.Path(save_path)
+    if not save_path.exists():
+        return era5_to_matlab_streaming(
+            bbox,
+            time_start,
+            time_end,
+            save_path,
+            chunk_freq,
+            progress_callback,
+            source,
+            compact=bool(compact),
+        )
+    if compact is None:
+        compact = _is_compact_mat(save_path)
+
+    if progress_callback is None:
+        progress_callback = _log_progress
+
+    coverage = read_era5_coverage(save_path)
+    cov_start = pd.Timestamp(coverage["time_start"])
+    cov_end = pd.Timestamp(coverage["time_end"])
+    if coverage["bbox"] is not None and list(coverage["bbox"]) != list(bbox):
+        raise ValueError(
+            f"The bbox of {save_path} ({coverage['bbox']}) differs from {list(bbox)}"
+        )
+
+    # the periods that are missing before and after the existing time steps -
+    # time_start and time_end are passed on as given, so that a date as the
+    # end includes the whole day (as in era5_to_matlab_streaming). A period
+    # is only missing if it holds at least one time step (ERA5 is hourly)
+    if coverage["n_times"] > 1:
+        dt = (cov_end - cov_start) / (coverage["n_times"] - 1)
+    else:
+        dt = pd.Timedelta(1, "h")
+    missing = dict(
+        before=(time_start, str(cov_start - dt)),
+        after=(str(cov_end + dt), time_end),
+    )
+    missing = {
+        k: (t0, t1)
+        for k, (t0, t1) in missing.items()
+        if pd.Timestamp(t0) <= _get_period_end(t1)
+    }
+    if len(missing) == 0:
+        logger.info(f"{save_path} already covers {time_start} to {time_end}")
+        return save_path
+
+    datasets = {k: open_era5_years(t0, t1, source) for k, (t0, t1) in missing.items()}
+    n_new = {k: sum(ds.time.size for ds in d.values()) for k, d in datasets.items()}
+    n_chunks = sum(
+        get_chunk_periods(ds, chunk_freq).unique().size
+        for d in datasets.values()
+        for ds in d.values()
+    )
+    n_times = coverage["n_times"] + sum(n_new.values())
+
+    era = load_era5_mat(save_path)
+
+    # Zs only has a time dimension when the period spans more than one year
+    time_first = min(cov_start, *[pd.Timestamp(t0) for t0, _ in missing.values()])
+    time_last = max(cov_end, *[_get_period_end(t1) for _, t1 in missing.values()])
+    multi_year = time_first.year != time_last.year
+    if multi_year and era["Zs"].ndim == 2:
+        era["Zs"] = np.repeat(era["Zs"][..., None], coverage["n_times"], axis=-1)
+    if multi_year:
+        datasets = {
+            k: {y: _broadcast_static_variables(ds) for y, ds in d.items()}
+            for k, d in datasets.items()
+        }
+
+    logger.info(
+        f"Extending {save_path} ({cov_start} to {cov_end}) with "
+        + ", ".join(f"{t0} to {t1}" for t0, t1 in missing.values())
+        + f" in {n_chunks} chunks"
+    )
+
+    # written next to the existing file and swapped in once complete
+    fname_tmp = save_path.with_name(f".{save_path.stem}.extend.mat")
+    n_done = 0
+    times = []
+    with ERA5MatWriter(fname_tmp, n_times, compact) as writer:
+        for key in ["before", "existing", "after"]:
+            if key == "existing":
+                writer.write_era(era)
+                times += [cov_start, cov_end]
+                continue
+            if key not in datasets:
+                continue
+            for period, ds_chunk in iter_era5_chunks(datasets[key], bbox, chunk_freq):
+                # the grid is checked by write_era (the shapes must match)
+                if len(times) and ds_chunk.time.values[0] <= pd.Timestamp(times[-1]):
+                    raise ValueError(f"ERA5 chunk {period} overlaps with {save_path}")
+                writer.write(ds_chunk)
+                times += [ds_chunk.time.values[0], ds_chunk.time.values[-1]]
+                n_done += 1
+                progress_callback(n_done, n_chunks, period)
+        writer.save()
+
+    os.replace(fname_tmp, save_path)
+    write_era5_manifest(
+        save_path, bbox, times[0], times[-1], n_times, get_era5_source(source)
+    )
+
+    return save_path
+
+
+def write_era5_manifest(
+    save_path: Union[str, pathlib.Path],
+    bbox: tuple,
+    time_start,
+    time_end,
+    n_times: int,
+    source: Union[ERA5Source, str] = None,
+) -> pathlib.Path:
+    """Write the coverage of an era5.mat file to a json file next to it (era5.json)"""
+    import json
+    import os
+    import time
+
+    manifest = dict(
+        bbox=None if bbox is None else [float(c) for c in bbox],
+        time_start=pd.Timestamp(time_start).isoformat(),
+        time_end=pd.Timestamp(time_end).isoformat(),
+        n_times=int(n_times),
+        source=None if source is None else get_era5_source(source).url_template,
+        created=time.time(),
+    )
+
+    # replaced rather than overwritten, since era5.mat and era5.json can be
+    # hardlinks into the forcing store (see store.ForcingStore)
+    path = pathlib.Path(save_path).with_suffix(".json")
+    path_tmp = path.with_name(f".{path.name}.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path_tmp, path)
+
+    return path
+
+
+def read_era5_coverage(save_path: Union[str, pathlib.Path]) -> dict:
+    """
+    The bbox, time_start, time_end and n_times of an era5.mat file.
+
+    Read from the manifest (era5.json) next to the file. Files that were
+    written without a manifest are parsed once (era.t is a MATLAB datenum)
+    and the manifest is written with an unknown (None) bbox.
+    """
+    import json
+
+    save_path = pathlib.Path(save_path)
+    path_manifest = save_path.with_suffix(".json")
+    if path_manifest.exists():
+        with open(path_manifest) as f:
+            return json.load(f)
+
+    logger.debug(f"No manifest for {save_path}, reading the time steps from the file")
+    datenum = np.ravel(load_era5_mat(save_path)["t"])
+    # MATLAB datenum counts days from year 0, 719529 is 1970-01-01
+    time = pd.to_datetime((datenum - 719529) * 86400, unit="s").round("s")
+
+    write_era5_manifest(save_path, None, time[0], time[-1], time.size)
+    with open(path_manifest) as f:
+        return json.load(f)
+
+
+def era5_to_matlab_for_runs(
+    requests: list[dict],
+    source: Union[ERA5Source, str] = None,
+    gap_deg: float = 0.5,
+    compact: bool = False,
+) -> list[pathlib.Path]:
+    """
+    Write era5.mat for many bboxes and periods in a single pass over the yearly stores.
+
+    Requests whose bboxes overlap (or are less than gap_deg apart) are grouped
+    and the union of their bboxes and periods is loaded once per year. Each
+    request is then clipped from the loaded data and written with an
+    `ERA5MatWriter`, so the amount of data that is read scales with the area
+    that is covered rather than with the number of requests. The files are
+    identical to those of `era5_to_matlab_streaming` for each request.
+
+    Parameters
+    ----------
+    requests : list[dict]
+        Each request has the keys bbox [W, S, E, N], time_start, time_end
+        and save_path (the .mat file).
+    source : Union[ERA5Source, str], optional
+        Where the stores are read from, by default the S3 bucket.
+    gap_deg : float, optional
+        Bboxes that are closer than this are loaded together, by default 0.5.
+        Use 0 to only group overlapping bboxes.
+    compact : bool, optional
+        Store floats as float32 in the (MATLAB v7.3) files (see
+        `ERA5MatWriter`), by default False.
+
+    Returns
+    -------
+    list[pathlib.Path]
+        The paths to the .mat files in the order of the requests.
+    """
+    import contextlib
+
+    source = get_era5_source(source)
+    requests = [dict(r, bbox=list(r["bbox"])) for r in requests]
+
+    t0 = min(pd.Timestamp(r["time_start"]) for r in requests)
+    t1 = max(pd.Timestamp(r["time_end"]) for r in requests)
+    available = set(source.list_years())
+    years = [y for y in range(t0.year, t1.year + 1) if y in available]
+    if len(years) == 0:
+        raise ValueError(f"Could not find any ERA5 data from {t0} to {t1} in {source}")
+
+    # the bbox that is actually used (after expansion) and the time steps of each request
+    ds_first = _open_era5_year(source, years[0])
+    for r in requests:
+        r["bbox_used"] = clip_era5_to_bbox(ds_first, r["bbox"])[1]
+        r["n_times"] = 0
+        r["grid"] = r["time_first"] = r["time_last"] = None
+    datasets = {}
+    for year in years:
+        ds_year = _open_era5_year(source, year)
+        time = ds_year.time.to_index()
+        for r in requests:
+            i0, i1 = time.slice_indexer(r["time_start"], r["time_end"]).indices(
+                time.size
+            )[:2]
+            r[year] = slice(i0, i1) if i1 > i0 else None
+            r["n_times"] += max(i1 - i0, 0)
+        datasets[year] = ds_year
+
+    for r in requests:
+        if r["n_times"] == 0:
+            raise ValueError(
+                f"Could not find any ERA5 data from {r['time_start']} to {r['time_end']}"
+            )
+
+    groups = _group_bboxes([r["bbox_used"] for r in requests], gap_deg)
+    logger.info(
+        f"Extracting ERA5 data for {len(requests)} requests in {len(groups)} "
+        f"groups from {len(years)} yearly stores"
+    )
+
+    mb_loaded = 0
+    mb_requested = 0
+    with contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(ERA5MatWriter(r["save_path"], r["n_times"], compact))
+            for r in requests
+        ]
+        for year, ds_year in datasets.items():
+            for group_bbox, members in groups:
+                members = [i for i in members if requests[i][year] is not None]
+                if len(members) == 0:
+                    continue
+
+                i0 = min(requests[i][year].start for i in members)
+                i1 = max(requests[i][year].stop for i in members)
+                ds_group = (
+                    ds_year.isel(time=slice(i0, i1))
+                    .rio.clip_box(
+                        *group_bbox, crs="epsg:4326", allow_one_dimensional_raster=True
+                    )
+                    .load()
+                )
+                mb_loaded += ds_group.nbytes / 1e6
+
+                for i in members:
+                    r = requests[i]
+                    ds_chunk = ds_group.isel(
+                        time=slice(r[year].start - i0, r[year].stop - i0)
+                    )
+                    ds_chunk, _ = clip_era5_to_bbox(ds_chunk, r["bbox"])
+                    if (
+                        pd.Timestamp(r["time_start"]).year
+                        != pd.Timestamp(r["time_end"]).year
+                    ):
+                        ds_chunk = _broadcast_static_variables(ds_chunk)
+
+                    period = pd.Period(year, "Y")
+                    r["grid"] = _validate_era5_chunk(
+                        ds_chunk, period, r["grid"], r["time_last"]
+                    )
+                    if r["time_first"] is None:
+                        r["time_first"] = ds_chunk.time.values[0]
+                    r["time_last"] = ds_chunk.time.values[-1]
+
+                    writers[i].write(ds_chunk)
+                    mb_requested += ds_chunk.nbytes / 1e6
+
+            logger.info(f"ERA5 {year} done for {len(requests)} requests")
+
+        paths = [writer.save() for writer in writers]
+
+    for r in requests:
+        write_era5_manifest(
+            r["save_path"],
+            r["bbox"],
+            r["time_first"],
+            r["time_last"],
+            r["n_times"],
+            source,
+        )
+
+    logger.info(
+        f"Loaded {mb_loaded:.1f} MB of ERA5 data for {mb_requested:.1f} MB "
+        f"of requested data ({len(requests)} requests)"
+    )
+
+    return paths
+
+
+def _group_bboxes(bboxes: list, gap_deg: float = 0.5) -> list[tuple[list, list]]:
+    """Greedily merge bboxes that are closer than gap_deg into (union_bbox, indices)"""
+    groups = [(list(bbox), [i]) for i, bbox in enumerate(bboxes)]
+
+    merged = True
+    while merged:
+        merged = False
+        for a in range(len(groups)):
+            for b in range(a + 1, len(groups)):
+                (wa, sa, ea, na), ia = groups[a]
+                (wb, sb, eb, nb), ib = groups[b]
+                close_lon = (wb - ea <= gap_deg) and (wa - eb <= gap_deg)
+                close_lat = (sb - na <= gap_deg) and (sa - nb <= gap_deg)
+                if close_lon and close_lat:
+                    union = [min(wa, wb), min(sa, sb), max(ea, eb), max(na, nb)]
+                    groups[a] = (union, ia + ib)
+                    groups.pop(b)
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return groups
+
+
+class ERA5MatWriter:
+    """
+    Writes era5.mat from consecutive time chunks of clipped ERA5 data.
+
+    Each chunk is converted with cryogrid_pytools.forcing.era5_to_matlab and
+    the scaled integer arrays are copied into memory-mapped .npy files in a
+    temporary folder next to save_path. `save` writes these to a MATLAB v7.3
+    .mat file one time slab at a time, so the memory needed does not grow
+    with the period (scipy's v5 writer serialises and compresses the whole
+    struct in memory). Use as a context manager so that the temporary files
+    are always removed.
+
+    Parameters
+    ----------
+    save_path : Union[str, pathlib.Path]
+        The path of the .mat file.
+    n_times : int
+        The total number of time steps that will be written.
+    compact : bool, optional
+        Store floats (except t) as float32 (see `save_era5_mat`), by default False.
+    """
+
+    def __init__(
+        self, save_path: Union[str, pathlib.Path], n_times: int, compact: bool = False
+    ):
+        import tempfile
+
+        self.save_path = pathlib.Path(save_path)
+        self.n_times = n_times
+        self.compact = compact
+        self.n_written = 0
+        self.era = {}
+
+        # temporary files are kept next to the output so that they are on the same disk
+        self.tmp_dir = pathlib.Path(
+            tempfile.mkdtemp(dir=self.save_path.parent, prefix=".era5-")
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, ds_chunk: xr.Dataset):
+        """Convert a chunk and write it after the previously written time steps"""
+        from cryogrid_pytools.forcing import era5_to_matlab
+
+        self.write_era(era5_to_matlab(ds_chunk)["era"])
+
+    def write_era(self, era_chunk: dict):
+        """Write an already converted chunk (e.g. the era struct of an existing era5.mat)"""
+        if not self.era:
+            self.era = self._allocate(era_chunk)
+
+        i0 = self.n_written
+        i1 = i0 + np.size(era_chunk["t"])
+        if i1 > self.n_times:
+            raise ValueError(
+                f"More than {self.n_times} time steps for {self.save_path}"
+            )
+
+        for key in _get_time_keys(era_chunk):
+            shape = self.era[key].shape[:-1]
+            if np.size(era_chunk[key]) != np.prod(shape) * (i1 - i0):
+                raise ValueError(f"The shape of {key} differs from the previous chunks")
+            # .mat files store 1-D arrays as rows, so reshape to the allocated layout
+            self.era[key][..., i0:i1] = np.reshape(era_chunk[key], (*shape, i1 - i0))
+        self.n_written = i1
+
+    def save(self) -> pathlib.Path:
+        if self.n_written != self.n_times:
+            raise ValueError(
+                f"Only {self.n_written} of {self.n_times} time steps were written "
+                f"for {self.save_path}"
+            )
+
+        _save_mat_v73(self.save_path, "era", self.era, single=self.compact)
+        return self.save_path
+
+    def close(self):
+        import shutil
+
+        self.era.clear()  # release the memory maps before removing the files
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _allocate(self, era_chunk: dict) -> dict:
+        era = {}
+        for key, value in era_chunk.items():
+            if key in _get_time_keys(era_chunk):
+                value = np.asarray(value)
+                shape = value.shape[:-1] + (self.n_times,)
+                era[key] = np.lib.format.open_memmap(
+                    self.tmp_dir / f"{key}.npy",
+                    mode="w+",
+                    dtype=value.dtype,
+                    shape=shape,
+                )
+            else:
+                era[key] = value
+        return era
+
+
+def save_era5_mat(
+    era: dict, save_path: Union[str, pathlib.Path], compact: bool = False
+) -> pathlib.Path:
+    """
+    Save the era struct from cryogrid_pytools.forcing.era5_to_matlab to a .mat file.
+
+    By default, the file is written with scipy.io.savemat (MATLAB v5, zlib
+    compressed) as era5_to_matlab does. scipy serialises the whole struct in
+    memory and then compresses it, so this needs about twice the memory of
+    era - for long periods use `era5_to_matlab_streaming`. With
+    compact=True, the file is a MATLAB v7.3 (HDF5) file where float arrays
+    (except the time vector t) are stored as float32 and all larger arrays
+    are chunked along time and compressed (gzip + shuffle), which MATLAB can
+    load partially and faster. It is written one time slab at a time.
+
+    Parameters
+    ----------
+    era : dict
+        The era struct (arrays in MATLAB dimension order).
+    save_path : Union[str, pathlib.Path]
+        The path of the .mat file.
+    compact : bool, optional
+        Write the compact v7.3 file, by default False.
+
+    Returns
+    -------
+    pathlib.Path
+        The path to the .mat file.
+    """
+    from scipy.io import savemat
+
+    save_path = pathlib.Path(save_path)
+    if compact:
+        _save_mat_v73(save_path, "era", era)
+    else:
+        savemat(str(save_path), {"era": era}, appendmat=True, do_compression=True)
+
+    return save_path
+
+
+def load_era5_mat(save_path: Union[str, pathlib.Path]) -> dict:
+    """
+    Load the era struct of a .mat file written by `save_era5_mat` (either format).
+
+    The arrays are in MATLAB dimension order with 1-D arrays as (1, n) rows,
+    the same as scipy.io.loadmat. Char arrays (e.g. dims) are returned as str.
+    """
+    import h5py
+    from scipy.io import loadmat
+
+    if not h5py.is_hdf5(save_path):
+        mat = loadmat(str(save_path), struct_as_record=False)["era"][0, 0]
+        era = {key: getattr(mat, key) for key in mat._fieldnames}
+        # loadmat returns char arrays as arrays of str
+        for key, value in era.items():
+            if isinstance(value, np.ndarray) and value.dtype.kind == "U":
+                era[key] = "".join(value.ravel())
+        return era
+
+    era = {}
+    with h5py.File(save_path, "r") as f:
+        for key, dset in f["era"].items():
+            value = np.transpose(dset[()])  # HDF5 is row-major, MATLAB column-major
+            if dset.attrs.get("MATLAB_class") == b"char":
+                value = "".join(map(chr, value.ravel()))
+            era[key] = value
+    return era
+
+
+def _is_compact_mat(save_path: Union[str, pathlib.Path]) -> bool:
+    # a v7.3 file where all floats except t are float32 (MATLAB single) - Zs
+    # is float32 in every file, so single arrays alone do not make it compact
+    import h5py
+
+    if not h5py.is_hdf5(save_path):
+        return False
+    with h5py.File(save_path, "r") as f:
+        return all(
+            dset.attrs.get("MATLAB_class") != b"double"
+            for key, dset in f["era"].items()
+            if key != "t"
+        )
+
+
+def _save_mat_v73(save_path: pathlib.Path, name: str, struct: dict, single=True):
+    # single=True stores floats (except t) as float32. The arrays (e.g.
+    # memory maps) are written in slabs along time, so they are never copied
+    # to memory as a whole
+    import time
+
+    import h5py
+
+    # arrays smaller than this are not chunked/compressed
+    min_compress_size = 4096
+    # the number of time steps written at a time (~1 year of hourly data)
+    slab_size = 24 * 366
+    matlab_classes = dict(float64="double", float32="single", bool="logical")
+
+    with h5py.File(save_path, "w", userblock_size=512, libver="earliest") as f:
+        group = f.create_group(name)
+        group.attrs["MATLAB_class"] = np.bytes_("struct")
+        group.attrs["MATLAB_fields"] = np.array(
+            [np.array(list(key), dtype="S1") for key in struct],
+            dtype=h5py.vlen_dtype(np.dtype("S1")),
+        )
+        for key, value in struct.items():
+            if isinstance(value, np.ndarray) and value.dtype.kind == "U":
+                value = "".join(value.ravel())  # a char array from scipy.io.loadmat
+            if isinstance(value, str):
+                data = np.array([[ord(c) for c in value]], dtype=np.uint16)
+                dset = group.create_dataset(key, data=np.transpose(data))
+                dset.attrs["MATLAB_class"] = np.bytes_("char")
+                dset.attrs["MATLAB_int_decode"] = np.int32(2)
+                continue
+
+            data = np.asarray(value)  # no copy of memory maps
+            dtype = data.dtype
+            if single and dtype.kind == "f" and key != "t":  # t is a datenum (float64)
+                dtype = np.dtype(np.float32)
+            # scalars are 1x1 and 1-D arrays are rows in MATLAB (as with savemat)
+            data = data.reshape((1,) * max(2 - data.ndim, 0) + data.shape)
+
+            kwargs = {}
+            if data.size >= min_compress_size:
+                # the last MATLAB dimension (time) is the first HDF5 dimension,
+                # so a chunk holds ~1 month of hourly time steps for all points
+                chunks = (min(data.shape[-1], 24 * 31),) + data.shape[-2::-1]
+                kwargs = dict(
+                    chunks=chunks, compression="gzip", compression_opts=4, shuffle=True
+                )
+
+            # HDF5 is row-major and MATLAB column-major, so the dimensions are reversed
+            dset = group.create_dataset(
+                key, shape=data.shape[::-1], dtype=dtype, **kwargs
+            )
+            for t0 in range(0, max(data.shape[-1], 1), slab_size):
+                slab = data[..., t0 : t0 + slab_size]
+                dset[t0 : t0 + slab.shape[-1]] = np.transpose(slab).astype(dtype)
+            dset.attrs["MATLAB_class"] = np.bytes_(
+                matlab_classes.get(dtype.name, dtype.name)
+            )
+
+    # MATLAB only recognises v7.3 files with this header in the userblock
+    header = (
+        f"MATLAB 7.3 MAT-file, Platform: GLNXA64, "
+        f"Created on: {time.strftime('%a %b %d %H:%M:%S %Y')} HDF5 schema 1.00 ."
+    )
+    header = header.encode().ljust(116, b" ") + b"\x00" * 8 + b"\x00\x02" + b"IM"
+    with open(save_path, "r+b") as f:
+        f.write(header.ljust(512, b"\x00"))
+
+
+def _get_period_end(time) -> pd.Timestamp:
+    # the last time that .sel(time=slice(..., time)) includes: the end of the
+    # day for "2020-12-31" and of the year for "2020" (partial string indexing)
+    if isinstance(time, str):
+        return pd.Period(time).end_time
+    return pd.Timestamp(time)
+
+
+def _open_era5_year(source: ERA5Source, year: int) -> xr.Dataset:
+    return source.open_year(year).rio.write_crs(4326).rename(z_surf="Zs")
+
+
+def _broadcast_static_variables(ds: xr.Dataset) -> xr.Dataset:
+    # open_mfdataset concatenates all variables along time (incl. Zs) when
+    # there is more than one store, so we do the same to get output that is
+    # identical to get_era5_from_s3_bucket
+    for key in ds.data_vars:
+        if "time" not in ds[key].dims:
+            ds[key] = ds[key].expand_dims(time=ds.time)
+    return ds
+
+
+def _get_time_keys(era: dict) -> list[str]:
+    time_keys = [k for k in ERA5_MAT_TIME_KEYS if k != "Zs"]
+    if era["Zs"].ndim == 3:  # lon x lat x time
+        time_keys.append("Zs")
+    return time_keys
+
+
+def _validate_era5_chunk(ds_chunk, period, grid=None, time_last=None):
+    time = ds_chunk.time.to_index()
+    if not time.is_monotonic_increasing or time.has_duplicates:
+        raise ValueError(f"ERA5 time steps are not increasing in {period}")
+    if time_last is not None and time[0] <= time_last:
+        raise ValueError(f"ERA5 chunk {period} overlaps with the previous chunk")
+
+    step = time.to_series().diff().dropna()
+    if step.nunique() > 1:
+        logger.warning(f"ERA5 time steps are irregular in {period}: {step.unique()}")
+
+    n_nans = {k: int(ds_chunk[k].isnull().sum()) for k in ds_chunk.data_vars}
+    n_nans = {k: n for k, n in n_nans.items() if n > 0}
+    if n_nans:
+        logger.warning(f"ERA5 chunk {period} contains NaNs: {n_nans}")
+
+    chunk_grid = (ds_chunk.latitude.values, ds_chunk.longitude.values)
+    if grid is None:
+        return chunk_grid
+    if not all(np.array_equal(a, b) for a, b in zip(grid, chunk_grid)):
+        raise ValueError(
+            f"The ERA5 grid of chunk {period} differs from the first chunk"
+        )
+
+    return grid
+
+
+def _log_progress(n_done, n_chunks, period):
+    logger.info(f"ERA5 chunk {n_done}/{n_chunks} ({period}) done")
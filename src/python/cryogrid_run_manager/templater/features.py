@@ -0,0 +1,360 @@
+"""
+Feature matrices for the clustering of the gridcells of a run, built from
+forcing/geospatial_data.nc. The matrices are written as memory-mapped
+float32 .npy files, so that large domains can be clustered without loading
+all features into memory (see clustering.cluster_memmap).
+
+`FeatureStore` keeps the standardized and weighted matrices of a run in
+forcing/features/<key>, with the scaler and the pixel index, so repeated
+clustering experiments with the same variables reuse them.
+"""
+
+import hashlib
+import json
+import pathlib
+import shutil
+import uuid
+from typing import Optional, Union
+
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+# the clustering variables and their default weights (the aspect as its
+# sine and cosine, see DERIVED_VARIABLES)
+CLUSTER_VARIABLES = dict(
+    elevation=1.0,
+    slope=1.0,
+    aspect_sin=1.0,
+    aspect_cos=1.0,
+    albedo=1.0,
+    emissivity=1.0,
+    snow_index=1.0,
+    stratigraphy_index=1.0,
+)
+
+# features computed from a variable of geospatial_data.nc when they are read
+# (the aspect as in CLUSTER_SLOPE_ASPECT of CryoGrid: sine and cosine, so
+# that north-facing slopes of 1 and 359 degrees are close)
+DERIVED_VARIABLES = dict(
+    aspect_sin=("aspect", lambda aspect: np.sin(np.deg2rad(aspect))),
+    aspect_cos=("aspect", lambda aspect: np.cos(np.deg2rad(aspect))),
+)
+
+
+def make_feature_memmap(
+    fname_geospatial: Union[str, pathlib.Path],
+    variables: list[str],
+    save_dir: Union[str, pathlib.Path],
+    chunk_rows=256,
+    exclude: Optional[dict] = None,
+) -> tuple[np.memmap, np.ndarray]:
+    """
+    Write the variables of the valid pixels to a memory-mapped feature matrix.
+
+    The netcdf file is read chunk_rows rows at a time, so neither the
+    variables nor the matrix are ever fully in memory. Pixels where any of
+    the variables is NaN are left out.
+
+    Parameters
+    ----------
+    fname_geospatial : Union[str, pathlib.Path]
+        The geospatial data of the run (forcing/geospatial_data.nc).
+    variables : list[str]
+        The variables (columns) of the feature matrix: variables of the file
+        or of DERIVED_VARIABLES (e.g. aspect_sin).
+    save_dir : Union[str, pathlib.Path]
+        Where features.npy (float32, n_pixels x n_variables) and
+        pixel_index.npy (the flat index of each row in the (y, x) grid) are written.
+    chunk_rows : int, optional
+        The number of grid rows read at a time, by default 256.
+    exclude : dict, optional
+        Values of variables whose pixels are left out, e.g.
+        {"stratigraphy_index": [0]}. The variables do not have to be features.
+
+    Returns
+    -------
+    tuple[np.memmap, np.ndarray]
+        The feature matrix (opened read-only) and the pixel index.
+    """
+    save_dir = pathlib.Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+
+    exclude = exclude or {}
+
+    with xr.open_dataset(fname_geospatial) as ds:
+        sources = [DERIVED_VARIABLES.get(v, (v,))[0] for v in variables]
+        ds = ds[list(dict.fromkeys(sources + list(exclude)))]
+        y, x = ds.rio.y_dim, ds.rio.x_dim
+        ny, nx = ds.sizes[y], ds.sizes[x]
+        row_chunks = [
+            slice(i, min(i + chunk_rows, ny)) for i in range(0, ny, chunk_rows)
+        ]
+
+        def read_column(chunk: xr.Dataset, name: str) -> np.ndarray:
+            if name in DERIVED_VARIABLES:
+                source, func = DERIVED_VARIABLES[name]
+                return func(chunk[source].values.ravel())
+            return chunk[name].values.ravel()
+
+        def read_chunk(rows: slice, names=variables) -> np.ndarray:
+            chunk = ds.isel({y: rows}).transpose(y, x)
+            return np.stack([read_column(chunk, v) for v in names], axis=1)
+
+        def is_valid(rows: slice) -> np.ndarray:
+            valid = np.isfinite(read_chunk(rows)).all(axis=1)
+            for name, values in exclude.items():
+                valid &= ~np.isin(read_chunk(rows, [name])[:, 0], values)
+            return valid
+
+        # first pass: the valid pixels (to know the size of the matrix)
+        valid = np.concatenate([is_valid(rows) for rows in row_chunks])
+        pixel_index = np.flatnonzero(valid)
+        np.save(save_dir / "pixel_index.npy", pixel_index)
+
+        # second pass: the features of the valid pixels
+        features = np.lib.format.open_memmap(
+            save_dir / "features.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(pixel_index.size, len(variables)),
+        )
+        n = 0
+        for rows in row_chunks:
+            chunk = read_chunk(rows)
+            chunk = chunk[valid[rows.start * nx : rows.stop * nx]]
+            features[n : n + chunk.shape[0]] = chunk
+            n += chunk.shape[0]
+        features.flush()
+        del features
+
+    logger.info(
+        f"Wrote {pixel_index.size} of {ny * nx} pixels x {len(variables)} "
+        f"features to {save_dir / 'features.npy'}"
+    )
+
+    return np.load(save_dir / "features.npy", mmap_mode="r"), pixel_index
+
+
+def labels_to_grid(
+    labels: np.ndarray,
+    pixel_index: np.ndarray,
+    like: xr.DataArray,
+    fill=-1,
+    dtype=np.int32,
+) -> xr.DataArray:
+    """The labels (or any value) of the rows of a feature matrix on the (y, x) grid of like"""
+    grid = np.full(like.shape, fill, dtype=dtype)
+    grid.ravel()[pixel_index] = np.asarray(labels).ravel()
+
+    return xr.DataArray(
+        grid,
+        coords={k: like.coords[k] for k in like.dims},
+        dims=like.dims,
+        name="cluster_number",
+    )
+
+
+class FeatureStore:
+    """
+    The memoized clustering features of a run (in <run>/forcing/features).
+
+    Each set of variables, weights and excluded values is stored in its own
+    folder (named after a hash of them) with:
+        - features.npy: the standardized and weighted features (float32,
+          memory-mapped, one row per valid pixel)
+        - pixel_index.npy: the flat (y, x) index of each row
+        - scaler.json: the variables, weights, means and standard deviations
+
+    A folder is reused as long as geospatial_data.nc has not changed.
+
+    Parameters
+    ----------
+    run_path : Union[str, pathlib.Path]
+        The run folder (with forcing/geospatial_data.nc).
+    """
+
+    scaler_name = "scaler.json"
+
+    def __init__(self, run_path: Union[str, pathlib.Path]):
+        self.run_path = pathlib.Path(run_path)
+        self.fname_geospatial = self.run_path / "forcing" / "geospatial_data.nc"
+        self.store_dir = self.run_path / "forcing" / "features"
+
+    def __repr__(self):
+        n = len(list(self.store_dir.glob(f"*/{self.scaler_name}")))
+        return f"{self.__class__.__name__}('{self.store_dir}', entries={n})"
+
+    def get(
+        self,
+        variables: Optional[Union[dict, list]] = None,
+        exclude: Optional[dict] = None,
+        rebuild=False,
+    ) -> "FeatureMatrix":
+        """
+        The feature matrix for the variables - from the store or built.
+
+        Parameters
+        ----------
+        variables : Union[dict, list], optional
+            The variables of geospatial_data.nc and their weights (a list
+            has weights of 1), by default CLUSTER_VARIABLES. The weights
+            multiply the standardized variables (as cluster_variable_scaling
+            in K_MEANS_custom.m).
+        exclude : dict, optional
+            Values of variables whose pixels are left out (see make_feature_memmap).
+        rebuild : bool, optional
+            Build the matrix even if it is stored, by default False.
+        """
+        if variables is None:
+            variables = CLUSTER_VARIABLES
+        if not isinstance(variables, dict):
+            variables = {name: 1.0 for name in variables}
+        variables = {str(k): float(v) for k, v in variables.items()}
+        exclude = {str(k): np.ravel(v).tolist() for k, v in (exclude or {}).items()}
+
+        key = self.get_key(variables, exclude)
+        path = self.store_dir / key
+        scaler = self._read_scaler(path)
+        if (
+            scaler is not None
+            and scaler["source"] == self._get_source()
+            and not rebuild
+        ):
+            logger.debug(f"Reading the features from {path}")
+            return FeatureMatrix(path)
+
+        self._build(path, variables, exclude)
+        return FeatureMatrix(path)
+
+    def get_key(self, variables: dict, exclude: dict) -> str:
+        params = json.dumps(dict(variables=variables, exclude=exclude), sort_keys=True)
+        return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+    def clear(self):
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def _get_source(self) -> dict:
+        # geospatial_data.nc is rewritten (not modified) when the data change
+        stat = self.fname_geospatial.stat()
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    def _read_scaler(self, path: pathlib.Path) -> Union[dict, None]:
+        try:
+            with open(path / self.scaler_name) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _build(self, path: pathlib.Path, variables: dict, exclude: dict):
+        # built in a temporary folder so that a stored entry is always complete
+        path_tmp = self.store_dir / f".tmp-{uuid.uuid4().hex[:8]}"
+        names = list(variables)
+        make_feature_memmap(self.fname_geospatial, names, path_tmp, exclude=exclude)
+
+        X = np.load(path_tmp / "features.npy", mmap_mode="r+")
+        mean, std = _get_column_stats(X)
+        weights = np.array(list(variables.values()))
+        chunk_size = 1_000_000
+        for start in range(0, X.shape[0], chunk_size):
+            chunk = X[start : start + chunk_size]
+            X[start : start + chunk_size] = (chunk - mean) / std * weights
+        X.flush()
+        del X
+
+        scaler = dict(
+            variables=names,
+            weights=weights.tolist(),
+            mean=mean.tolist(),
+            std=std.tolist(),
+            exclude=exclude,
+            source=self._get_source(),
+        )
+        with open(path_tmp / self.scaler_name, "w") as f:
+            json.dump(scaler, f, indent=2)
+
+        shutil.rmtree(path, ignore_errors=True)
+        path_tmp.rename(path)
+        logger.info(f"Stored the features ({', '.join(names)}) in {path}")
+
+
+class FeatureMatrix:
+    """
+    A standardized feature matrix of a FeatureStore.
+
+    Attributes
+    ----------
+    X : np.memmap
+        The features (n_pixels, n_variables), read-only.
+    pixel_index : np.ndarray
+        The flat (y, x) index in geospatial_data.nc of each row.
+    variables, weights, mean, std : list / np.ndarray
+        The scaler: X = (x - mean) / std * weights.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], fname_geospatial=None):
+        self.path = pathlib.Path(path)
+        if fname_geospatial is None:
+            # <run>/forcing/features/<key> -> <run>/forcing/geospatial_data.nc
+            fname_geospatial = self.path.parents[1] / "geospatial_data.nc"
+        self.fname_geospatial = pathlib.Path(fname_geospatial)
+        with open(self.path / FeatureStore.scaler_name) as f:
+            scaler = json.load(f)
+        self.variables = scaler["variables"]
+        self.weights = np.array(scaler["weights"])
+        self.mean = np.array(scaler["mean"])
+        self.std = np.array(scaler["std"])
+        self.exclude = scaler["exclude"]
+        self.X = np.load(self.path / "features.npy", mmap_mode="r")
+        self.pixel_index = np.load(self.path / "pixel_index.npy")
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(n_pixels={self.X.shape[0]}, "
+            f"variables={self.variables})"
+        )
+
+    def read(self, name: str) -> np.ndarray:
+        """The raw values of a variable of geospatial_data.nc for each row (e.g. strata)"""
+        with xr.open_dataset(self.fname_geospatial) as ds:
+            da = ds[name].transpose(ds.rio.y_dim, ds.rio.x_dim)
+            return da.values.ravel()[self.pixel_index]
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        """Standardize and weight raw values (n, n_variables) with the stored scaler"""
+        return ((np.asarray(x) - self.mean) / self.std * self.weights).astype(
+            np.float32
+        )
+
+    def inverse_transform(self, X: np.ndarray) -> np.ndarray:
+        """The raw values of standardized features (e.g. cluster centroids)"""
+        return np.asarray(X) / self.weights * self.std + self.mean
+
+    def to_grid(self, values: np.ndarray, like: xr.DataArray, **kwargs) -> xr.DataArray:
+        """The values of the rows on the grid of like (see labels_to_grid)"""
+        return labels_to_grid(values, self.pixel_index, like, **kwargs)
+
+
+def _get_column_stats(
+    X: np.ndarray, chunk_size=1_000_000
+) -> tuple[np.ndarray, np.ndarray]:
+    # the mean and the population standard deviation (as MATLAB's zscore(X, 1))
+    # of each column, chunk by chunk with Welford/Chan's parallel update
+    n = 0
+    mean = np.zeros(X.shape[1])
+    m2 = np.zeros(X.shape[1])
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = np.asarray(X[start : start + chunk_size], dtype=np.float64)
+        n_chunk = chunk.shape[0]
+        mean_chunk = chunk.mean(axis=0)
+        delta = mean_chunk - mean
+        m2 += ((chunk - mean_chunk) ** 2).sum(axis=0) + delta**2 * n * n_chunk / (
+            n + n_chunk
+        )
+        mean += delta * n_chunk / (n + n_chunk)
+        n += n_chunk
+
+    std = np.sqrt(m2 / max(n, 1))
+    std[std == 0] = 1.0  # constant variables
+
+    return mean, std
@@ -32,6 +32,10 @@ def plot_geospatial_data(ds: xr.Dataset):
         google_earth_image=dict(long_name="RGB Image (Google Earth)"),
         elevation=dict(long_name="DEM (Copernicus 30m)", cmap="terrain"),
         slope=dict(long_name="Slope from DEM", cmap="viridis", vmin=0.00, vmax=50.0),
+        aspect=dict(long_name="Aspect from DEM", cmap="twilight", vmin=0, vmax=360),
+        sky_view_factor=dict(
+            long_name="Sky-view factor from DEM", cmap="cividis", vmin=0.6, vmax=1.0
+        ),
         snow_index=dict(long_name="Snow melt DOY (Sentinel-2)", cmap="pink"),
         albedo=dict(
             long_name="Albedo (MODIS black-sky)", cmap="bone", vmin=0.10, vmax=0.40
@@ -180,6 +184,7 @@ def plot_dataarrays(
 
 def get_google_scene(ds):
     from ..viz.google_maps_getter import GoogleScene
+    from .reproject import reproject_with_plan
 
     if isinstance(ds, xr.Dataset):
         da = ds[list(ds.data_vars)[0]]
@@ -191,7 +196,8 @@ def get_google_scene(ds):
     bbox = tuple([float(f) for f in da.rv.get_bbox_latlon()])
     scene = GoogleScene(bbox)
     da = scene.xr
-    da_crs = da.rio.reproject(dst_crs=ds.rio.crs)
+    # one plan for all three bands (and cached for the next plot of the bbox)
+    da_crs = reproject_with_plan(da, dst_crs=ds.rio.crs)
 
     return da_crs
 
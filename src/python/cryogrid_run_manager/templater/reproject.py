@@ -0,0 +1,292 @@
+"""
+Reprojection plans: the mapping from a destination grid to a source grid is
+computed once for a (source grid, destination grid) pair and reused for all
+layers and bands on those grids. Plans are cached in memory and on disk
+(<project>/data/cache/reprojection), keyed by a hash of the grid definitions,
+so repeated runs and plots over the same area skip the coordinate transforms.
+
+A plan stores the fractional (row, col) position in the source grid of the
+center of each destination pixel. Applying it is then a gather (nearest) or
+a weighted gather of the four surrounding pixels (bilinear).
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+from functools import lru_cache
+from typing import Union
+
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+RESAMPLING_METHODS = ("nearest", "bilinear")
+
+
+def get_grid(da: xr.DataArray) -> dict:
+    """The definition of the grid of da: crs (wkt), affine transform and (ny, nx)"""
+    if da.rio.crs is None:
+        raise ValueError("The data array must have a crs (see rio.write_crs)")
+
+    return dict(
+        crs=da.rio.crs.to_wkt(),
+        transform=[float(v) for v in tuple(da.rio.transform())[:6]],
+        shape=[int(da.rio.height), int(da.rio.width)],
+    )
+
+
+def get_target_grid(da: xr.DataArray, dst_crs, resolution=None) -> dict:
+    """
+    The grid that da.rio.reproject(dst_crs) would create (same extent, with
+    the resolution estimated by GDAL unless given).
+    """
+    from rasterio.crs import CRS
+    from rasterio.warp import calculate_default_transform
+
+    dst_crs = CRS.from_user_input(dst_crs)
+    transform, width, height = calculate_default_transform(
+        da.rio.crs,
+        dst_crs,
+        da.rio.width,
+        da.rio.height,
+        *da.rio.bounds(),
+        resolution=resolution,
+    )
+
+    return dict(
+        crs=dst_crs.to_wkt(),
+        transform=[float(v) for v in tuple(transform)[:6]],
+        shape=[int(height), int(width)],
+    )
+
+
+class ReprojectionPlan:
+    """
+    The position in the source grid of each pixel of the destination grid.
+
+    Parameters
+    ----------
+    src_grid, dst_grid : dict
+        The grid definitions (see `get_grid` and `get_target_grid`).
+    rows, cols : np.ndarray
+        The fractional row and column in the source grid of the center of
+        each destination pixel, shape of the destination grid (pixel i
+        covers [i, i + 1), so the center of source pixel i is at i + 0.5).
+    """
+
+    def __init__(
+        self, src_grid: dict, dst_grid: dict, rows: np.ndarray, cols: np.ndarray
+    ):
+        self.src_grid = src_grid
+        self.dst_grid = dst_grid
+        self.rows = rows
+        self.cols = cols
+
+    def __repr__(self):
+        src, dst = self.src_grid["shape"], self.dst_grid["shape"]
+        return f"{self.__class__.__name__}(src_shape={src}, dst_shape={dst})"
+
+    @classmethod
+    def from_grids(cls, src_grid: dict, dst_grid: dict) -> "ReprojectionPlan":
+        """Compute the plan by transforming the destination pixel centers to the source crs"""
+        from affine import Affine
+        from pyproj import Transformer
+
+        ny, nx = dst_grid["shape"]
+        dst_transform = Affine(*dst_grid["transform"])
+        src_transform = Affine(*src_grid["transform"])
+
+        cols, rows = np.meshgrid(np.arange(nx) + 0.5, np.arange(ny) + 0.5)
+        x, y = dst_transform * (cols, rows)
+        transformer = Transformer.from_crs(
+            dst_grid["crs"], src_grid["crs"], always_xy=True
+        )
+        x, y = transformer.transform(x, y)
+        src_cols, src_rows = ~src_transform * (x, y)
+
+        return cls(
+            src_grid,
+            dst_grid,
+            np.asarray(src_rows, dtype=np.float32),
+            np.asarray(src_cols, dtype=np.float32),
+        )
+
+    @classmethod
+    def load(cls, fname: Union[str, pathlib.Path]) -> "ReprojectionPlan":
+        with np.load(fname) as npz:
+            grids = json.loads(str(npz["grids"]))
+            return cls(grids["src"], grids["dst"], npz["rows"], npz["cols"])
+
+    def save(self, fname: Union[str, pathlib.Path]):
+        grids = json.dumps(dict(src=self.src_grid, dst=self.dst_grid))
+        np.savez_compressed(fname, rows=self.rows, cols=self.cols, grids=grids)
+
+    def apply(
+        self, da: xr.DataArray, resampling="nearest", nodata=None
+    ) -> xr.DataArray:
+        """
+        Reproject da (on the source grid) to the destination grid.
+
+        All leading dimensions (e.g. band) are reprojected with the same
+        gather. Pixels outside the source grid are set to nodata (by default
+        da.rio.nodata, or NaN for floats). "bilinear" returns floats and
+        ignores NaN source pixels.
+        """
+        if resampling not in RESAMPLING_METHODS:
+            raise ValueError(f"resampling must be one of {RESAMPLING_METHODS}")
+        if [da.rio.height, da.rio.width] != list(self.src_grid["shape"]):
+            raise ValueError(
+                f"da {da.shape} is not on the source grid {self.src_grid['shape']}"
+            )
+
+        y_dim, x_dim = da.rio.y_dim, da.rio.x_dim
+        da = da.transpose(..., y_dim, x_dim)
+        values = da.values
+        ny, nx = values.shape[-2:]
+
+        if resampling == "nearest":
+            if nodata is None:
+                nodata = da.rio.nodata
+            if nodata is None:
+                nodata = np.nan if values.dtype.kind == "f" else 0
+            rows = np.floor(self.rows).astype(np.int64)
+            cols = np.floor(self.cols).astype(np.int64)
+            inside = (rows >= 0) & (rows < ny) & (cols >= 0) & (cols < nx)
+            out = values[..., rows.clip(0, ny - 1), cols.clip(0, nx - 1)]
+            out = np.where(inside, out, np.array(nodata, dtype=out.dtype))
+        else:
+            nodata = np.nan if nodata is None else nodata
+            values = values.astype(np.float32)
+            rows, cols = self.rows - 0.5, self.cols - 0.5
+            row0 = np.floor(rows).astype(np.int64)
+            col0 = np.floor(cols).astype(np.int64)
+            fr, fc = rows - row0, cols - col0
+            total = np.zeros(values.shape[:-2] + rows.shape, dtype=np.float32)
+            weights = np.zeros_like(total)
+            for dr, dc, w in [
+                (0, 0, (1 - fr) * (1 - fc)),
+                (0, 1, (1 - fr) * fc),
+                (1, 0, fr * (1 - fc)),
+                (1, 1, fr * fc),
+            ]:
+                r, c = row0 + dr, col0 + dc
+                inside = (r >= 0) & (r < ny) & (c >= 0) & (c < nx)
+                v = values[..., r.clip(0, ny - 1), c.clip(0, nx - 1)]
+                valid = inside & np.isfinite(v)
+                total += np.where(valid, v * w, 0)
+                weights += np.where(valid, w, 0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out = np.where(weights > 0, total / weights, nodata).astype(np.float32)
+
+        dst_ny, dst_nx = self.dst_grid["shape"]
+        a, _, c, _, e, f = self.dst_grid["transform"]
+        coords = {k: da.coords[k] for k in da.dims[:-2] if k in da.coords}
+        coords[y_dim] = f + (np.arange(dst_ny) + 0.5) * e
+        coords[x_dim] = c + (np.arange(dst_nx) + 0.5) * a
+
+        da_out = xr.DataArray(
+            out, coords=coords, dims=da.dims, name=da.name, attrs=da.attrs
+        )
+        da_out = da_out.rio.write_crs(self.dst_grid["crs"])
+        da_out = da_out.rio.write_nodata(nodata, encoded=False)
+
+        return da_out
+
+
+def get_reprojection_cache_dir(cache_dir=None) -> pathlib.Path:
+    """
+    The directory of the cached plans - defaults to <project>/data/cache/reprojection
+
+    Can also be set with the environment variable CRYOGRID_REPROJECTION_CACHE_DIR.
+    """
+    from .cache import get_default_cache_dir
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("CRYOGRID_REPROJECTION_CACHE_DIR", None)
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir("reprojection")
+
+    return pathlib.Path(cache_dir)
+
+
+def get_reprojection_plan(
+    src_grid: dict, dst_grid: dict, cache_dir=None, use_cache=True
+) -> ReprojectionPlan:
+    """
+    The plan for a pair of grids - from memory, the disk cache, or computed
+    (and then saved to the disk cache).
+    """
+    if not use_cache:
+        return ReprojectionPlan.from_grids(src_grid, dst_grid)
+
+    key = json.dumps(dict(src=src_grid, dst=dst_grid), sort_keys=True)
+    key = hashlib.sha256(key.encode()).hexdigest()[:24]
+    cache_dir = str(get_reprojection_cache_dir(cache_dir))
+
+    return _get_cached_plan(key, json.dumps(src_grid), json.dumps(dst_grid), cache_dir)
+
+
+@lru_cache(maxsize=32)
+def _get_cached_plan(key: str, src_grid: str, dst_grid: str, cache_dir: str):
+    # the grids are passed as json strings so that they are hashable
+    fname = pathlib.Path(cache_dir) / f"plan-{key}.npz"
+    if fname.exists():
+        logger.debug(f"Read the reprojection plan from {fname}")
+        return ReprojectionPlan.load(fname)
+
+    plan = ReprojectionPlan.from_grids(json.loads(src_grid), json.loads(dst_grid))
+    try:
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        fname_tmp = fname.with_name(f".{fname.name}.{os.getpid()}.npz")
+        plan.save(fname_tmp)
+        os.replace(fname_tmp, fname)
+        logger.debug(f"Saved the reprojection plan to {fname}")
+    except OSError as e:  # e.g. a read-only project directory
+        logger.warning(f"Could not save the reprojection plan to {fname}: {e}")
+
+    return plan
+
+
+def reproject_with_plan(
+    da: xr.DataArray,
+    dst_crs=None,
+    match: xr.DataArray = None,
+    resolution=None,
+    resampling="nearest",
+    nodata=None,
+    **kwargs,
+) -> xr.DataArray:
+    """
+    Reproject da to dst_crs (like da.rio.reproject) or to the grid of match
+    (like da.rio.reproject_match) with a cached plan (see `get_reprojection_plan`).
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data with a crs, optionally with leading (e.g. band) dimensions.
+    dst_crs : optional
+        The destination crs (the extent and resolution are estimated as in
+        rio.reproject unless resolution is given).
+    match : xr.DataArray, optional
+        Reproject to the grid of match instead.
+    resolution : float, optional
+        The resolution of the destination grid (only with dst_crs).
+    resampling : str, optional
+        "nearest" or "bilinear", by default "nearest".
+    nodata : optional
+        The value of the pixels outside da (see `ReprojectionPlan.apply`).
+    **kwargs
+        Passed on to `get_reprojection_plan` (cache_dir, use_cache).
+    """
+    if (dst_crs is None) == (match is None):
+        raise ValueError("Either dst_crs or match must be given")
+
+    src_grid = get_grid(da)
+    if match is not None:
+        dst_grid = get_grid(match)
+    else:
+        dst_grid = get_target_grid(da, dst_crs, resolution=resolution)
+
+    plan = get_reprojection_plan(src_grid, dst_grid, **kwargs)
+    return plan.apply(da, resampling=resampling, nodata=nodata)
@@ -0,0 +1,212 @@
+"""
+A content-addressed store for the forcing files of runs (era5.mat and the
+geospatial rasters). Files are kept under <project>/data/forcing_store in a
+folder that is named after a hash of the parameters that were used to create
+them, so runs with the same bbox, period, resolution, ... share the files.
+
+The files in a run's forcing folder are hardlinks into the store, which makes
+the hardlink count of a file its reference count: `ForcingStore.gc` removes
+the entries whose files are no longer linked from any run.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+import uuid
+from typing import Union
+
+from loguru import logger
+
+from .cache import _get_size_on_disk, _jsonable
+
+
+def get_forcing_store(store_dir=None) -> "ForcingStore":
+    """
+    The forcing store of the project - defaults to <project>/data/forcing_store
+
+    Parameters
+    ----------
+    store_dir : Union[str, pathlib.Path], optional
+        Location of the store. Can also be set with the environment variable
+        CRYOGRID_FORCING_STORE_DIR.
+    """
+    import dotenv
+
+    if store_dir is None:
+        store_dir = os.environ.get("CRYOGRID_FORCING_STORE_DIR", None)
+    if store_dir is None:
+        base = pathlib.Path(dotenv.find_dotenv("pyproject.toml")).parent
+        store_dir = base / "data" / "forcing_store"
+
+    return ForcingStore(store_dir)
+
+
+class ForcingStore:
+    """
+    Forcing files stored by a hash of the parameters that created them.
+
+    Parameters
+    ----------
+    store_dir : Union[str, pathlib.Path]
+        Directory that contains one folder per entry. Must be on the same
+        file system as the runs, otherwise files are copied instead of linked.
+    """
+
+    params_name = "params.json"
+
+    def __init__(self, store_dir: Union[str, pathlib.Path]):
+        self.store_dir = pathlib.Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}('{self.store_dir}', entries={len(self.list_keys())})"
+
+    def get_key(self, kind: str, **params) -> str:
+        """The hash of the parameters (must be json serializable), prefixed by kind"""
+        params = json.dumps(_jsonable(params), sort_keys=True)
+        return f"{kind}-{hashlib.sha256(params.encode()).hexdigest()[:24]}"
+
+    def get_path(self, key: str) -> pathlib.Path:
+        return self.store_dir / key
+
+    def list_keys(self) -> list[str]:
+        return sorted(p.name for p in self.store_dir.iterdir() if _is_entry(p))
+
+    def has(self, key: str, fnames: list[str]) -> bool:
+        path = self.get_path(key)
+        return all((path / fname).is_file() for fname in fnames)
+
+    def link(
+        self, key: str, dest_dir: Union[str, pathlib.Path], fnames: list[str]
+    ) -> bool:
+        """
+        Link the files of an entry into dest_dir (existing files are replaced).
+
+        Returns
+        -------
+        bool
+            False if the entry does not have all the files (nothing is linked).
+        """
+        if not self.has(key, fnames):
+            return False
+
+        for fname in fnames:
+            _replace_with_link(
+                self.get_path(key) / fname, pathlib.Path(dest_dir) / fname
+            )
+        logger.info(f"Linked {', '.join(fnames)} from {self.get_path(key)}")
+
+        return True
+
+    def add(
+        self, key: str, files: list[Union[str, pathlib.Path]], **params
+    ) -> pathlib.Path:
+        """
+        Move files into the store and replace them with links to the stored files.
+
+        If the entry already exists, the files are replaced with links to the
+        existing entry instead (the contents are assumed to be identical since
+        they were created with the same parameters).
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry from `get_key`.
+        files : list[Union[str, pathlib.Path]]
+            The files of the entry, all in the same folder.
+        **params
+            The parameters of the key, saved in params.json for reference.
+
+        Returns
+        -------
+        pathlib.Path
+            The folder of the entry.
+        """
+        files = [pathlib.Path(f) for f in files]
+        fnames = [f.name for f in files]
+        path = self.get_path(key)
+
+        if not self.has(key, fnames):
+            # assembled in a temporary folder so that an entry is never incomplete
+            path_tmp = self.store_dir / f".tmp-{uuid.uuid4().hex[:8]}"
+            path_tmp.mkdir()
+            for f in files:
+                _link_or_copy(f, path_tmp / f.name)
+            with open(path_tmp / self.params_name, "w") as fobj:
+                json.dump(dict(params=_jsonable(params), created=time.time()), fobj)
+
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(path_tmp, path)
+            except OSError:  # another process added the entry in the meantime
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            logger.debug(f"Added {', '.join(fnames)} to {path}")
+
+        self.link(key, files[0].parent, fnames)
+
+        return path
+
+    def gc(self, dry_run: bool = False) -> list[str]:
+        """
+        Remove the entries whose files are not linked from anywhere else.
+
+        Parameters
+        ----------
+        dry_run : bool, optional
+            Only return the keys that would be removed, by default False.
+
+        Returns
+        -------
+        list[str]
+            The keys of the (to be) removed entries.
+        """
+        removed = []
+        size = 0
+        for path in self.store_dir.iterdir():
+            if path.name.startswith(".tmp-"):  # left behind by an interrupted add
+                if not dry_run:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not _is_entry(path):
+                continue
+
+            files = [f for f in path.iterdir() if f.name != self.params_name]
+            if any(f.stat().st_nlink > 1 for f in files):
+                continue
+
+            removed.append(path.name)
+            size += _get_size_on_disk(path)
+            if not dry_run:
+                shutil.rmtree(path, ignore_errors=True)
+
+        verb = "Would remove" if dry_run else "Removed"
+        logger.info(
+            f"{verb} {len(removed)} unreferenced entries ({size / 1e6:.1f} MB) "
+            f"from {self.store_dir}"
+        )
+
+        return sorted(removed)
+
+
+def _is_entry(path: pathlib.Path) -> bool:
+    return path.is_dir() and not path.name.startswith(".")
+
+
+def _link_or_copy(src: pathlib.Path, dest: pathlib.Path):
+    try:
+        os.link(src, dest)
+    except OSError:  # e.g. the store is on a different file system
+        logger.warning(f"Could not hardlink {src} to {dest}, copying instead")
+        shutil.copy2(src, dest)
+
+
+def _replace_with_link(src: pathlib.Path, dest: pathlib.Path):
+    if dest.exists() and os.path.samefile(src, dest):
+        return
+    # link to a temporary name first so that dest is replaced atomically
+    dest_tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}")
+    _link_or_copy(src, dest_tmp)
+    os.replace(dest_tmp, dest)
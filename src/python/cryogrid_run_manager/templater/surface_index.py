@@ -1,5 +1,7 @@
-from typing import Union
+import pathlib
+from typing import Optional, Union
 
+import numba
 import numpy as np
 import xarray as xr
 import xrspatial as xrs
@@ -160,6 +162,224 @@ def calc_masked_land_types(
     return masked
 
 
+# the priority rules of the surface index - the first rule that matches a
+# pixel sets its value, pixels without a matching rule are gap filled.
+# land_cover: ESRI LULC codes (empty = any), slope_min: slope > slope_min,
+# slope_max: not slope > slope_max (so NaN slopes match), mask: a boolean layer
+SURFACE_INDEX_RULES_COLUMNS = (
+    "surface_index",
+    "name",
+    "land_cover",
+    "slope_min",
+    "slope_max",
+    "mask",
+    "description",
+)
+
+
+def get_surface_index_rules(
+    rules=None,
+    land_cover_vegetation_values=(11,),
+    land_cover_bare_soil_values=(8,),
+    land_cover_masked_values=(0, 1, 2, 4, 5, 7),
+    slope_threshold=30,
+):
+    """
+    The rule table of the surface index as a pandas.DataFrame (one rule per row).
+
+    Parameters
+    ----------
+    rules : pd.DataFrame or str, optional
+        A table with the columns in SURFACE_INDEX_RULES_COLUMNS (or a path to
+        a .csv or .xlsx file with the table) in order of priority. The
+        land_cover column can hold comma-separated codes. If None, the default
+        rules are built from the other arguments.
+    land_cover_vegetation_values : tuple, optional
+        ESRI LULC values of vegetation (rangelands), by default (11,).
+    land_cover_bare_soil_values : tuple, optional
+        ESRI LULC values of bare ground, by default (8,).
+    land_cover_masked_values : tuple, optional
+        ESRI LULC values that are not modelled, by default (0, 1, 2, 4, 5, 7).
+    slope_threshold : float, optional
+        Bare ground steeper than this is bedrock, otherwise soil, by default 30.
+
+    Returns
+    -------
+    pd.DataFrame
+        The rules with land_cover as tuples of ints and NaN for unused limits.
+    """
+    import pandas as pd
+
+    if rules is None:
+        masked = "These masked values will not be run in the CryoGrid model"
+        rules = pd.DataFrame(
+            [
+                (0, "Masked areas", land_cover_masked_values, None, None, None, masked),
+                (0, "Masked areas", (), None, None, "glaciers", masked),
+                (2, "rock_glaciers", (), None, None, "rock_glaciers", ""),
+                (
+                    4,
+                    "Vegetation mask",
+                    land_cover_vegetation_values,
+                    None,
+                    None,
+                    None,
+                    "Vegetation mask based on land cover (grassland and moss/lichen)",
+                ),
+                (
+                    3,
+                    "Bare soil mask",
+                    land_cover_bare_soil_values,
+                    None,
+                    slope_threshold,
+                    None,
+                    f"Bare soil mask based on slope (<= {slope_threshold}) "
+                    "and Bare rock/soil from land cover",
+                ),
+                (
+                    1,
+                    "Bedrock mask",
+                    land_cover_bare_soil_values,
+                    slope_threshold,
+                    None,
+                    None,
+                    f"Bedrock mask based on slope (> {slope_threshold}) "
+                    "and Bare rock/soil from land cover",
+                ),
+            ],
+            columns=SURFACE_INDEX_RULES_COLUMNS,
+        )
+    elif isinstance(rules, (str, pathlib.Path)) and str(rules).endswith(".csv"):
+        rules = pd.read_csv(rules)
+    elif isinstance(rules, (str, pathlib.Path)):
+        rules = pd.read_excel(rules)
+
+    rules = pd.DataFrame(rules).reset_index(drop=True)
+    missing = set(SURFACE_INDEX_RULES_COLUMNS) - set(rules.columns)
+    if missing:
+        raise ValueError(f"The surface index rules are missing the columns {missing}")
+
+    def parse_codes(codes) -> tuple:
+        if isinstance(codes, str):
+            codes = [c for c in codes.split(",") if c.strip()]
+        elif codes is None or (np.ndim(codes) == 0 and pd.isnull(codes)):
+            codes = []
+        return tuple(int(c) for c in np.ravel(codes))
+
+    rules["land_cover"] = rules["land_cover"].apply(parse_codes)
+    for key in ["slope_min", "slope_max"]:
+        rules[key] = rules[key].astype(float)
+    rules["mask"] = [m if isinstance(m, str) and m else None for m in rules["mask"]]
+    rules["description"] = rules["description"].fillna("")
+
+    if (rules["surface_index"] < 0).any() or (rules["surface_index"] > 254).any():
+        raise ValueError("The surface index values must be between 0 and 254")
+
+    return rules
+
+
+def apply_surface_index_rules(
+    rules,
+    land_cover: np.ndarray,
+    slope: np.ndarray,
+    masks: dict[str, np.ndarray],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Apply the rules to every pixel in a single (numba) pass.
+
+    Parameters
+    ----------
+    rules : pd.DataFrame
+        The rules from get_surface_index_rules.
+    land_cover : np.ndarray
+        The land cover codes (integers, codes outside 0-255 never match).
+    slope : np.ndarray
+        The slope in degrees (NaN at the edges).
+    masks : dict[str, np.ndarray]
+        The boolean layers referred to by the mask column of the rules.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The surface index and the number of the rule that set it (both uint8,
+        255 where no rule matched).
+    """
+    mask_names = sorted({m for m in rules["mask"] if m is not None})
+    missing = set(mask_names) - set(masks)
+    if missing:
+        raise ValueError(f"The surface index rules need the masks {missing}")
+
+    n_rules = len(rules)
+    lc_lut = np.zeros((n_rules, 256), dtype=np.bool_)
+    use_lc = np.zeros(n_rules, dtype=np.bool_)
+    for r, codes in enumerate(rules["land_cover"]):
+        codes = [c for c in codes if 0 <= c < 256]
+        use_lc[r] = len(rules["land_cover"][r]) > 0
+        lc_lut[r, codes] = True
+
+    shape = np.shape(land_cover)
+    mask_stack = np.zeros((max(len(mask_names), 1), *shape), dtype=np.bool_)
+    for i, name in enumerate(mask_names):
+        mask_stack[i] = np.asarray(masks[name], dtype=bool)
+    mask_idx = np.array(
+        [-1 if m is None else mask_names.index(m) for m in rules["mask"]],
+        dtype=np.int64,
+    )
+
+    index = np.empty(shape, dtype=np.uint8)
+    rule = np.empty(shape, dtype=np.uint8)
+    _apply_rules(
+        np.asarray(land_cover).astype(np.int64),
+        np.asarray(slope, dtype=np.float64),
+        mask_stack,
+        lc_lut,
+        use_lc,
+        rules["slope_min"].to_numpy(np.float64),
+        rules["slope_max"].to_numpy(np.float64),
+        mask_idx,
+        rules["surface_index"].to_numpy(np.uint8),
+        index,
+        rule,
+    )
+
+    return index, rule
+
+
+@numba.njit(parallel=True, cache=True)
+def _apply_rules(
+    land_cover,
+    slope,
+    masks,
+    lc_lut,
+    use_lc,
+    slope_min,
+    slope_max,
+    mask_idx,
+    values,
+    out_index,
+    out_rule,
+):
+    ny, nx = land_cover.shape
+    for i in numba.prange(ny):
+        for j in range(nx):
+            out_index[i, j] = 255
+            out_rule[i, j] = 255
+            lc = land_cover[i, j]
+            s = slope[i, j]
+            for r in range(values.size):
+                if use_lc[r] and not (0 <= lc < 256 and lc_lut[r, lc]):
+                    continue
+                if not np.isnan(slope_min[r]) and not (s > slope_min[r]):
+                    continue
+                if not np.isnan(slope_max[r]) and s > slope_max[r]:
+                    continue
+                if mask_idx[r] >= 0 and not masks[mask_idx[r], i, j]:
+                    continue
+                out_index[i, j] = values[r]
+                out_rule[i, j] = r
+                break
+
+
 def calc_surface_index(
     dem: xr.DataArray,
     land_cover: xr.DataArray,
@@ -168,64 +388,248 @@ def calc_surface_index(
     land_cover_vegetation_values=(11,),
     land_cover_bare_soil_values=(8,),
     land_cover_masked_values=(0, 1, 2, 4, 5, 7),
-) -> xr.DataArray:
+    rules=None,
+    return_provenance=False,
+    fill_method="stepwise",
+    slope=None,
+) -> Union[xr.DataArray, tuple[xr.DataArray, xr.DataArray]]:
     """
     Compute stratigraphy from a DEM
-    """
-    from collections import defaultdict
 
-    slope = xrs.slope(dem)
+    The surface index is set by the first matching rule of the rule table
+    (see get_surface_index_rules, by default: masked land cover/glaciers = 0,
+    rock glaciers = 2, vegetation = 4, bare soil = 3, bedrock = 1) in a
+    single pass over the pixels. Pixels without a matching rule are filled
+    with the nearest neighbour.
 
-    masked_land_types = calc_masked_land_types(
-        land_cover=land_cover,
-        glacier_mask=glaciers,
-        land_cover_masked_values=land_cover_masked_values,
-    )
+    Parameters
+    ----------
+    dem, land_cover, glaciers, rock_glaciers : xr.DataArray
+        The DEM and the layers on the same grid (glaciers and rock_glaciers
+        are boolean masks that can be referred to by the rules).
+    land_cover_vegetation_values, land_cover_bare_soil_values, land_cover_masked_values : tuple
+        Used to build the default rules (ignored if rules are given).
+    rules : pd.DataFrame or str, optional
+        A custom rule table or the path to one (see get_surface_index_rules).
+    return_provenance : bool, optional
+        Also return the number of the rule that set each pixel (255 where
+        the value was gap filled), by default False.
+    fill_method : str, optional
+        "stepwise" (stepwise_nearest_neighbour_filling, the default) or
+        "nearest" (nearest_neighbour_filling - exact for any gap size and
+        done on the uint8 index without NaNs).
+    slope : xr.DataArray, optional
+        The slope of the DEM in degrees if it was computed before (e.g. with
+        terrain.calc_terrain), otherwise it is computed with xrspatial.slope.
+    """
+    if slope is None:
+        slope = xrs.slope(dem)
 
-    bedrock, bare_soil = calc_bedrock_soil_masks(
-        slope=slope,
-        land_cover=land_cover,
-        slope_threshold=30,
+    rules = get_surface_index_rules(
+        rules,
+        land_cover_vegetation_values=land_cover_vegetation_values,
         land_cover_bare_soil_values=land_cover_bare_soil_values,
+        land_cover_masked_values=land_cover_masked_values,
     )
-
-    vegetated = calc_vegetation_mask(
-        land_cover=land_cover, vegetation_values=land_cover_vegetation_values
+    index, rule = apply_surface_index_rules(
+        rules,
+        land_cover=land_cover.values,
+        slope=slope.values,
+        masks=dict(glaciers=glaciers.values, rock_glaciers=rock_glaciers.values),
     )
 
-    mask_values = {
-        1: bedrock,
-        3: bare_soil,
-        4: vegetated,
-        2: rock_glaciers,
-        0: masked_land_types,
-    }
-
-    # pre-define the surface classes as ones
+    coords = {k: dem.coords[k] for k in dem.dims}
+    if fill_method == "stepwise":
+        data = np.where(rule == 255, np.nan, index.astype(np.float32))
+    elif fill_method == "nearest":
+        data = index  # 255 where no rule matched
+    else:
+        raise ValueError(f"Unknown fill_method: {fill_method}")
     strat_index = xr.DataArray(
-        data=np.zeros_like(dem) * np.nan,
-        coords={k: dem.coords[k] for k in dem.dims},
+        data=data,
+        coords=coords,
         dims=dem.dims,
         attrs={
             "long_name": "Surface index",
             "description": "Surface index based on land cover and slope",
+            "index_values": rules["surface_index"].tolist(),
+            "index_names": rules["name"].tolist(),
+            "index_descriptions": rules["description"].tolist(),
         },
     )
 
-    attrs = defaultdict(list)
-    for value, mask in mask_values.items():
-        strat_index = strat_index.where(~mask, value)
+    # fill in the gaps with the nearest neighbour
+    if fill_method == "stepwise":
+        strat_index = stepwise_nearest_neighbour_filling(strat_index)
+    else:
+        strat_index = nearest_neighbour_filling(strat_index, nodata=255)
+
+    if not return_provenance:
+        return strat_index
+
+    provenance = xr.DataArray(
+        data=rule,
+        coords=coords,
+        dims=dem.dims,
+        name="surface_index_rule",
+        attrs={
+            "long_name": "Surface index rule",
+            "description": (
+                "The rule that set the surface index (see index_names), "
+                "255 where the value was filled from the nearest neighbour"
+            ),
+            "index_names": rules["name"].tolist(),
+        },
+    )
+    return strat_index, provenance
+
+
+def calc_surface_index_tiled(
+    dem: xr.DataArray,
+    land_cover: xr.DataArray,
+    glaciers: xr.DataArray,
+    rock_glaciers: xr.DataArray,
+    tile_size=1024,
+    halo=7,
+    use_dask=False,
+    return_provenance=False,
+    **kwargs,
+) -> Union[xr.DataArray, tuple[xr.DataArray, xr.DataArray]]:
+    """
+    Compute the surface index tile by tile to bound its intermediate arrays.
+
+    Each tile is extended by a halo on all sides, so that the slope (3x3
+    window) and the stepwise nearest neighbour filling (1 pixel per iteration,
+    5 iterations) see the same neighbourhood as on the full array. The halo
+    is then cropped and the tiles are stitched, which gives a result that is
+    identical to calc_surface_index. The masks, rule matches and fills are
+    only ever allocated for one tile, and only the tiles of the inputs are
+    loaded, so lazy (e.g. dask or memory-mapped) inputs are never fully
+    loaded here. The output (and provenance) arrays are full size. Note that
+    data.get_geospatial_data passes inputs that are already in memory (the
+    layers are fetched onto the whole DEM), so there only the intermediate
+    arrays are bounded.
+
+    Parameters
+    ----------
+    dem, land_cover, glaciers, rock_glaciers : xr.DataArray
+        The inputs of calc_surface_index, all on the same (y, x) grid.
+    tile_size : int, optional
+        The size of the tiles (without halo) in pixels, by default 1024.
+    halo : int, optional
+        The number of pixels the tiles are extended by, by default 7. Must be
+        at least 7 (slope + mask edge + 5 filling iterations) for identical results.
+        With fill_method="nearest", it must also be larger than the distance
+        to the nearest valid pixel of the widest gap - a warning is logged
+        for the tiles with gap pixels that are further away.
+    use_dask : bool, optional
+        Return a dask-backed array with one delayed task per tile instead of
+        computing the tiles one after another, by default False.
+    return_provenance : bool, optional
+        Also return the rule that set each pixel (see calc_surface_index).
+    **kwargs
+        Passed on to calc_surface_index (e.g. land_cover_masked_values).
+
+    Returns
+    -------
+    xr.DataArray
+        The surface index (uint8) on the grid of the DEM (and the provenance).
+    """
+    inputs = dict(
+        dem=dem, land_cover=land_cover, glaciers=glaciers, rock_glaciers=rock_glaciers
+    )
+    if kwargs.get("slope", None) is not None:  # a precomputed slope is tiled too
+        inputs["slope"] = kwargs.pop("slope")
+    for name, da in inputs.items():
+        if da.shape != dem.shape:
+            raise ValueError(f"{name} {da.shape} is not on the DEM grid {dem.shape}")
+
+    y, x = dem.dims
+    ny, nx = dem.shape
+    rows = [slice(i, min(i + tile_size, ny)) for i in range(0, ny, tile_size)]
+    cols = [slice(j, min(j + tile_size, nx)) for j in range(0, nx, tile_size)]
+
+    def calc_tile(row: slice, col: slice) -> np.ndarray:
+        # the tile with the halo (clipped at the edges of the domain)
+        rows_halo = slice(max(row.start - halo, 0), min(row.stop + halo, ny))
+        cols_halo = slice(max(col.start - halo, 0), min(col.stop + halo, nx))
+        tiles = {
+            k: da.isel({y: rows_halo, x: cols_halo}).load() for k, da in inputs.items()
+        }
+        tile_index, tile_rule = calc_surface_index(
+            **tiles, return_provenance=True, **kwargs
+        )
+
+        core = (
+            slice(row.start - rows_halo.start, row.stop - rows_halo.start),
+            slice(col.start - cols_halo.start, col.stop - cols_halo.start),
+        )
+        if kwargs.get("fill_method") == "nearest" and (len(rows), len(cols)) != (1, 1):
+            n_inexact = _count_inexact_nearest_fill(tile_rule.values == 255, core, halo)
+            if n_inexact > 0:
+                logger.warning(
+                    f"{n_inexact} pixels of the tile at ({row.start}, {col.start}) "
+                    f"are more than {halo} pixels from a valid pixel and may differ "
+                    "from calc_surface_index (increase the halo)"
+                )
+        return np.stack([tile_index.values[core], tile_rule.values[core]])
+
+    logger.debug(
+        f"Calculating the surface index in {len(rows) * len(cols)} tiles of "
+        f"{tile_size}x{tile_size} pixels (halo={halo})"
+    )
 
-        attrs["index_values"] += (value,)
-        attrs["index_names"] += (mask.attrs.get("long_name", mask.name),)
-        attrs["index_descriptions"] += (mask.attrs.get("description", ""),)
+    if use_dask:
+        import dask
+        import dask.array
+
+        blocks = [
+            [
+                dask.array.from_delayed(
+                    dask.delayed(calc_tile)(row, col),
+                    shape=(2, row.stop - row.start, col.stop - col.start),
+                    dtype=np.uint8,
+                )
+                for col in cols
+            ]
+            for row in rows
+        ]
+        data = dask.array.block(blocks)  # along the last two (y, x) dimensions
+    else:
+        data = np.empty((2, *dem.shape), dtype=np.uint8)
+        for row in rows:
+            for col in cols:
+                data[:, row, col] = calc_tile(row, col)
+
+    # the attributes only depend on the inputs' attributes, so a small tile is enough
+    corner = {
+        k: da.isel({y: slice(0, 3), x: slice(0, 3)}).load() for k, da in inputs.items()
+    }
+    corner_index, corner_rule = calc_surface_index(
+        **corner, return_provenance=True, **kwargs
+    )
+    attrs = dict(corner_index.attrs)
+    attrs.pop("history", None)
 
-    strat_index.attrs.update(attrs)
+    coords = {k: dem.coords[k] for k in dem.dims}
+    strat_index = xr.DataArray(
+        data=data[0], coords=coords, dims=dem.dims, name="surface_classes", attrs=attrs
+    )
+    strat_index.attrs["history"] = (
+        f"calc_surface_index_tiled with tile_size={tile_size} and halo={halo}; "
+    )
 
-    # fill in the gaps using stepwise nearest neighbour filling
-    strat_index = stepwise_nearest_neighbour_filling(strat_index)
+    if not return_provenance:
+        return strat_index
 
-    return strat_index
+    provenance = xr.DataArray(
+        data=data[1],
+        coords=coords,
+        dims=dem.dims,
+        name=corner_rule.name,
+        attrs=corner_rule.attrs,
+    )
+    return strat_index, provenance
 
 
 def stepwise_nearest_neighbour_filling(da: xr.DataArray, max_iter=5):
@@ -286,6 +690,139 @@ def stepwise_nearest_neighbour_filling(da: xr.DataArray, max_iter=5):
     return da
 
 
+def nearest_neighbour_filling(
+    da: xr.DataArray, nodata=None, tile_size=None, halo=64
+) -> xr.DataArray:
+    """
+    Fill gaps with the value of the nearest valid pixel in a single pass.
+
+    The nearest valid pixel of every gap pixel is found with a Euclidean
+    distance transform (scipy.ndimage.distance_transform_edt), so all gaps
+    are filled exactly, whatever their size. Integer (e.g. uint8) data are
+    filled in their own dtype with nodata marking the gaps; float data use
+    NaN and are returned as uint8 (as stepwise_nearest_neighbour_filling).
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        The categorical (y, x) data with gaps.
+    nodata : int, optional
+        The value of the gaps in integer data, by default da.rio.nodata or 255.
+    tile_size : int, optional
+        Fill tile by tile, each tile extended by halo pixels on all sides.
+        The result is exact for pixels whose nearest valid pixel is at most
+        halo pixels away - a warning is logged for those that are further.
+    halo : int, optional
+        The halo of the tiles in pixels, by default 64.
+
+    Returns
+    -------
+    xarray.DataArray
+        The filled data. The attributes fill_values and fill_max_distance_px
+        give the largest fill distance (in pixels) of each filled value.
+    """
+    if da.dtype.kind == "f":
+        invalid = da.isnull().values
+        values = np.where(invalid, 0, da.values).astype(np.uint8)
+    else:
+        if nodata is None:
+            nodata = da.rio.nodata if da.rio.nodata is not None else 255
+        invalid = (da == nodata).values
+        values = da.values
+
+    if not invalid.any():
+        return da.copy(data=values)
+    if invalid.all():
+        raise ValueError(f"{da.name} has no valid values to fill the gaps with")
+
+    logger.debug(
+        f"Filling {invalid.sum()} gap pixels in {da.name} with the nearest neighbour"
+    )
+
+    filled = values.copy()
+    distance = np.zeros(values.shape, dtype=np.float32)
+    ny, nx = values.shape
+    tile_size = tile_size or max(ny, nx)
+    n_inexact = 0
+    for i in range(0, ny, tile_size):
+        for j in range(0, nx, tile_size):
+            core = (slice(i, min(i + tile_size, ny)), slice(j, min(j + tile_size, nx)))
+            window = (
+                slice(max(i - halo, 0), min(i + tile_size + halo, ny)),
+                slice(max(j - halo, 0), min(j + tile_size + halo, nx)),
+            )
+            tile_filled, tile_distance = _fill_nearest(values[window], invalid[window])
+
+            offset = (core[0].start - window[0].start, core[1].start - window[1].start)
+            crop = tuple(slice(o, o + (c.stop - c.start)) for o, c in zip(offset, core))
+            filled[core] = tile_filled[crop]
+            distance[core] = tile_distance[crop]
+            if tile_size < max(ny, nx):
+                n_inexact += int((tile_distance[crop] > halo).sum())
+
+    if n_inexact > 0:
+        logger.warning(
+            f"{n_inexact} pixels of {da.name} were filled from more than {halo} "
+            "pixels away and may differ from an untiled fill (increase the halo)"
+        )
+
+    fill_values = np.unique(filled[invalid])
+    max_distance = [float(distance[invalid & (filled == v)].max()) for v in fill_values]
+    logger.debug(
+        "Maximum fill distance (px) per value: "
+        + ", ".join(f"{v}={d:.1f}" for v, d in zip(fill_values, max_distance))
+    )
+
+    da = (
+        da.copy(data=filled)
+        .rename("surface_classes")
+        .assign_attrs(
+            fill_values=fill_values.tolist(),
+            fill_max_distance_px=max_distance,
+            history=(
+                da.attrs.get("history", "") + "nearest_neighbour_filling "
+                f"filled {int(invalid.sum())} pixels; "
+            ),
+        )
+    )
+
+    return da
+
+
+def _fill_nearest(values: np.ndarray, invalid: np.ndarray):
+    from scipy.ndimage import distance_transform_edt
+
+    if invalid.all():  # no valid pixels in the tile - left for the warning
+        return values, np.full(values.shape, np.inf, dtype=np.float32)
+
+    iy, ix = distance_transform_edt(
+        invalid, return_distances=False, return_indices=True
+    )
+    filled = values[iy, ix]
+
+    # the distances are only needed for the gap pixels
+    yy, xx = np.nonzero(invalid)
+    distance = np.zeros(values.shape, dtype=np.float32)
+    distance[yy, xx] = np.hypot(iy[yy, xx] - yy, ix[yy, xx] - xx)
+
+    return filled, distance
+
+
+def _count_inexact_nearest_fill(
+    invalid: np.ndarray, core: tuple[slice, slice], halo: int
+) -> int:
+    # a gap pixel of the core is filled as on the full array if its nearest
+    # valid pixel (in the tile) is at most halo pixels away
+    from scipy.ndimage import distance_transform_edt
+
+    if not invalid[core].any():
+        return 0
+    if invalid.all():
+        return int(invalid[core].sum())
+    distance = distance_transform_edt(invalid)
+    return int((distance[core] > halo).sum())
+
+
 def exchage_values(
     da: xr.DataArray,
     values_to_change: dict[Union[int, float], Union[int, float]],
@@ -354,6 +891,93 @@ def exchage_values(
     return da_out
 
 
+def make_lookup_table(
+    mapping: dict[int, Union[int, float]], n_values: int = 256, dtype=None
+) -> np.ndarray:
+    """
+    A lookup table where lut[value] is the mapped value (unmapped values are kept).
+
+    Parameters
+    ----------
+    mapping : dict[int, Union[int, float]]
+        The values to change (integer keys) and their new values.
+    n_values : int, optional
+        The length of the table (the maximum value + 1), by default 256 (uint8).
+    dtype : np.dtype, optional
+        The dtype of the table. By default uint8 if all values fit in a uint8
+        (i.e. indices), otherwise float32 (i.e. parameters).
+
+    Returns
+    -------
+    np.ndarray
+        The lookup table.
+    """
+    keys = np.array([int(k) for k in mapping], dtype=np.int64)
+    values = np.array(list(mapping.values()), dtype=np.float64)
+    if ((keys < 0) | (keys >= n_values)).any():
+        raise ValueError(f"The mapping keys must be between 0 and {n_values - 1}")
+
+    lut = np.arange(n_values, dtype=np.float64)
+    lut[keys] = values
+
+    if dtype is None:
+        is_index = np.isfinite(lut).all() and (lut == np.round(lut)).all()
+        is_index = is_index and lut.min() >= 0 and lut.max() <= 255
+        dtype = np.uint8 if is_index else np.float32
+
+    return lut.astype(dtype)
+
+
+def remap_values(
+    da: xr.DataArray,
+    mappings: dict[str, dict[int, Union[int, float]]],
+    dtypes: Optional[dict] = None,
+) -> xr.Dataset:
+    """
+    Remap the values of an integer array with several mappings using lookup tables.
+
+    Each output is a single indexed read (lut[da]) over the integer values,
+    instead of one where() pass per unique value as in exchage_values.
+    Values that are not in a mapping are kept (as in exchage_values).
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The integer input (e.g. the surface index, uint8).
+    mappings : dict[str, dict]
+        The name of each output and its mapping {old_value: new_value}, e.g.
+        from data.get_surface_index_mappings.
+    dtypes : dict, optional
+        The dtype of each output. By default uint8 for mappings to indices
+        and float32 for mappings to parameters (see make_lookup_table).
+
+    Returns
+    -------
+    xr.Dataset
+        One variable per mapping on the grid of da.
+    """
+    if da.dtype.kind not in "ui":
+        raise TypeError(f"remap_values needs an integer array, got {da.dtype}")
+
+    values = da.values
+    if values.size and values.min() < 0:
+        raise ValueError("remap_values needs non-negative values")
+    n_values = max(int(values.max()) + 1 if values.size else 0, 256)
+    # the smallest unsigned type keeps the index array (and the gathers) compact
+    values = values.astype(np.min_scalar_type(n_values - 1), copy=False)
+
+    dtypes = dtypes or {}
+    history = da.attrs.get("history", "")
+    ds = xr.Dataset()
+    for name, mapping in mappings.items():
+        lut = make_lookup_table(mapping, n_values, dtypes.get(name))
+        ds[name] = da.copy(data=lut[values]).assign_attrs(
+            history=history + f"remapped values {mapping}; "
+        )
+
+    return ds
+
+
 def get_ground_info_table(
     excel_config_fname: str,
     sheet_name=1,
@@ -381,8 +1005,10 @@ def get_ground_info_table(
         The name or index of the sheet to read, by default 1 (the second sheet)
     sampling : str or int, optional
         The sampling method to use. If 'random', a random sample is taken from each group.
+        'random<seed>' (e.g. 'random3') uses another random seed ('random' is 'random0').
         If an integer is provided, it specifies the index of the sample to take from each group.
         If the index is larger than the number of samples in the group, it will wrap around.
+        See get_sampling_variants for lists of samplings.
     grouping_col : str, optional
         The column name to group by, by default 'surface_index' - i.e., the column that
         defines the spatial index of which the stratigraphy_index and roughness_length are
@@ -404,14 +1030,49 @@ def get_ground_info_table(
         ]  # use one of roughness_length or stratigraphy_index
     )
 
-    if sampling == "random":
-        idx = grouped.sample(1, random_state=0)
+    if isinstance(sampling, str) and sampling.startswith("random"):
+        seed = int(sampling[len("random") :] or 0)
+        idx = grouped.sample(1, random_state=seed)
     elif isinstance(sampling, int):
         i = sampling
         idx = [int(g.index[i % g.size]) for k, g in grouped]
+    else:
+        raise ValueError(f"Unknown sampling: {sampling}")
 
     df = (
         df.loc[idx].set_index(grouping_col).copy(deep=True)
     )  # copy the dataframe so that we can modify it
 
     return df
+
+
+def get_sampling_variants(n_variants: int, method="index") -> list:
+    """
+    The samplings of n_variants realizations for get_ground_info_table.
+
+    Parameters
+    ----------
+    n_variants : int
+        The number of variants.
+    method : str, optional
+        'index' for the samples 0, 1, ..., n_variants - 1 of each group (the
+        indices wrap around for groups with fewer samples), or 'random' for
+        random samples with the seeds 0, 1, ..., n_variants - 1. By default 'index'.
+
+    Returns
+    -------
+    list
+        The samplings, e.g. [0, 1, 2] or ['random0', 'random1', 'random2'].
+    """
+    if method == "index":
+        return list(range(n_variants))
+    elif method == "random":
+        return [f"random{seed}" for seed in range(n_variants)]
+    else:
+        raise ValueError(f"method must be 'index' or 'random', got {method}")
+
+
+def parse_sampling(sampling: str) -> Union[int, str]:
+    """A sampling from a string (e.g. the command line): '2' -> 2, 'random2' -> 'random2'"""
+    sampling = str(sampling).strip()
+    return int(sampling) if sampling.isdigit() else sampling
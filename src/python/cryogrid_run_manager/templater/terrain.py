@@ -0,0 +1,200 @@
+"""
+Terrain derivatives of the DEM (slope, aspect, curvature and sky-view factor)
+computed in a single pass over the pixels with a parallel numba kernel.
+
+The derivatives are added to the geospatial data of the run (see
+data.get_geospatial_data), so that the surface index, the clustering
+features and the plots reuse them instead of computing them again.
+"""
+
+import math
+
+import numba
+import numpy as np
+import xarray as xr
+from loguru import logger
+
+TERRAIN_ATTRS = dict(
+    slope=dict(long_name="Slope from DEM", units="degrees"),
+    aspect=dict(
+        long_name="Aspect from DEM",
+        units="degrees",
+        description="Downslope direction clockwise from north, -1 where flat",
+    ),
+    curvature=dict(
+        long_name="Curvature from DEM",
+        units="1/100 m",
+        description="Positive for convex (e.g. ridges), negative for concave surfaces",
+    ),
+    sky_view_factor=dict(
+        long_name="Sky-view factor from DEM",
+        units="1",
+        description="Fraction of the sky that is visible (1 - mean sine of the horizon angles)",
+    ),
+)
+
+
+def calc_terrain(
+    dem: xr.DataArray,
+    n_directions=16,
+    svf_radius_m=1000.0,
+    tile_size=None,
+) -> xr.Dataset:
+    """
+    Compute slope, aspect, curvature and sky-view factor from a DEM.
+
+    Slope and curvature use the same 3x3 windows as xrspatial.slope and
+    xrspatial.curvature (Horn's method), with NaN along the edges of the
+    DEM. The aspect is the downslope direction in degrees clockwise from
+    north (taking the direction of the coordinates into account), -1 where
+    the surface is flat. The sky-view factor is 1 - mean(sin(horizon angle))
+    over n_directions, where the horizon angle in each direction is the
+    largest elevation angle to the pixels within svf_radius_m (Zakšek et al.,
+    2011). Near the edges of the DEM, the horizon is searched only within it.
+
+    Parameters
+    ----------
+    dem : xr.DataArray
+        The DEM with (y, x) dimensions in meters (a projected crs).
+    n_directions : int, optional
+        The number of horizon directions for the sky-view factor, by default 16.
+        Use 0 to skip the sky-view factor (it is then NaN).
+    svf_radius_m : float, optional
+        The search radius of the horizon in meters, by default 1000.
+    tile_size : int, optional
+        Compute the derivatives tile by tile (with a halo of the search radius)
+        so that only one tile of a lazy DEM is loaded at a time, by default
+        None (all at once). Gives the same result.
+
+    Returns
+    -------
+    xr.Dataset
+        slope, aspect, curvature and sky_view_factor (float32) on the DEM grid.
+    """
+    y, x = dem.dims
+    dx = float(dem[x].values[1] - dem[x].values[0])
+    dy = float(dem[y].values[1] - dem[y].values[0])
+    n_steps = int(math.ceil(svf_radius_m / min(abs(dx), abs(dy))))
+    offsets, distances = _get_horizon_offsets(n_directions, n_steps, dx, dy)
+
+    ny, nx = dem.shape
+    tile_size = tile_size or max(ny, nx)
+    halo = max(n_steps, 1) if n_directions > 0 else 1
+
+    out = np.full((4, ny, nx), np.nan, dtype=np.float32)
+    n_tiles = 0
+    for i0 in range(0, ny, tile_size):
+        for j0 in range(0, nx, tile_size):
+            rows = slice(max(i0 - halo, 0), min(i0 + tile_size + halo, ny))
+            cols = slice(max(j0 - halo, 0), min(j0 + tile_size + halo, nx))
+            z = dem.isel({y: rows, x: cols}).values.astype(np.float64)
+
+            tile = np.full((4, *z.shape), np.nan, dtype=np.float32)
+            _terrain(z, dx, dy, offsets, distances, tile)
+
+            core = (
+                slice(i0 - rows.start, min(i0 + tile_size, ny) - rows.start),
+                slice(j0 - cols.start, min(j0 + tile_size, nx) - cols.start),
+            )
+            out[:, i0 : i0 + tile_size, j0 : j0 + tile_size] = tile[:, core[0], core[1]]
+            n_tiles += 1
+
+    logger.debug(
+        f"Calculated the terrain derivatives in {n_tiles} tiles "
+        f"({n_directions} horizon directions, {n_steps} steps)"
+    )
+
+    coords = {k: dem.coords[k] for k in dem.dims}
+    ds = xr.Dataset()
+    for k, name in enumerate(TERRAIN_ATTRS):
+        ds[name] = xr.DataArray(
+            out[k], coords=coords, dims=dem.dims, attrs=TERRAIN_ATTRS[name]
+        )
+    ds["sky_view_factor"].attrs.update(
+        n_directions=n_directions, svf_radius_m=float(svf_radius_m)
+    )
+    if dem.rio.crs is not None:
+        ds = ds.rio.write_crs(dem.rio.crs)
+
+    return ds
+
+
+def _get_horizon_offsets(n_directions: int, n_steps: int, dx: float, dy: float):
+    # the (row, col) offsets of the pixels along each direction and their
+    # horizontal distances in meters - rows/cols are rounded so the nearest
+    # pixel is used, and repeated pixels are dropped by giving them a
+    # distance of inf
+    offsets = np.zeros((n_directions, n_steps, 2), dtype=np.int64)
+    distances = np.full((n_directions, n_steps), np.inf)
+    step_m = min(abs(dx), abs(dy))
+    for k in range(n_directions):
+        azimuth = 2 * np.pi * k / n_directions  # clockwise from north
+        east, north = np.sin(azimuth), np.cos(azimuth)
+        last = (0, 0)
+        for s in range(n_steps):
+            di = int(round((s + 1) * step_m * north / dy))
+            dj = int(round((s + 1) * step_m * east / dx))
+            if (di, dj) == last:
+                continue
+            offsets[k, s] = di, dj
+            distances[k, s] = math.hypot(di * dy, dj * dx)
+            last = (di, dj)
+
+    return offsets, distances
+
+
+@numba.njit(parallel=True, cache=True)
+def _terrain(z, dx, dy, offsets, distances, out):
+    ny, nx = z.shape
+    n_directions, n_steps = distances.shape
+    cellsize_x, cellsize_y = abs(dx), abs(dy)
+    for i in numba.prange(1, ny - 1):
+        for j in range(1, nx - 1):
+            a = z[i - 1, j - 1]
+            b = z[i - 1, j]
+            c = z[i - 1, j + 1]
+            d = z[i, j - 1]
+            e = z[i, j]
+            f = z[i, j + 1]
+            g = z[i + 1, j - 1]
+            h = z[i + 1, j]
+            k = z[i + 1, j + 1]
+
+            # Horn's method: gradient along the columns (x) and rows (y)
+            dz_dj = ((c + 2 * f + k) - (a + 2 * d + g)) / 8
+            dz_di = ((g + 2 * h + k) - (a + 2 * b + c)) / 8
+            p = math.sqrt((dz_dj / cellsize_x) ** 2 + (dz_di / cellsize_y) ** 2)
+            out[0, i, j] = math.atan(p) * 57.29578
+
+            # the gradient towards east and north (dx and dy are signed, so the
+            # direction of the coordinates is taken into account) gives the aspect
+            dz_east = dz_dj / dx
+            dz_north = dz_di / dy
+            if dz_east == 0 and dz_north == 0:
+                out[1, i, j] = -1.0
+            else:
+                out[1, i, j] = (
+                    math.degrees(math.atan2(-dz_east, -dz_north)) + 360
+                ) % 360
+
+            dd = (b + h) / 2 - e
+            ee = (d + f) / 2 - e
+            out[2, i, j] = -2 * (dd / cellsize_y**2 + ee / cellsize_x**2) * 100
+
+            if n_directions == 0 or math.isnan(e):
+                continue
+            sin_sum = 0.0
+            for r in range(n_directions):
+                tan_max = 0.0
+                for s in range(n_steps):
+                    if distances[r, s] == np.inf:
+                        continue
+                    ii = i + offsets[r, s, 0]
+                    jj = j + offsets[r, s, 1]
+                    if ii < 0 or ii >= ny or jj < 0 or jj >= nx:
+                        break
+                    tan = (z[ii, jj] - e) / distances[r, s]
+                    if tan > tan_max:  # False for NaN
+                        tan_max = tan
+                sin_sum += tan_max / math.sqrt(1 + tan_max * tan_max)
+            out[3, i, j] = 1 - sin_sum / n_directions
@@ -171,7 +171,10 @@ def spatial_continuous_to_raster(
     import folium.raster_layers
     from matplotlib import colormaps
 
-    da = da.astype(float).rio.reproject("EPSG:3857")
+    from ..templater.reproject import reproject_with_plan
+
+    # the plan is cached, so layers on the same grid are reprojected quickly
+    da = reproject_with_plan(da.astype(float), "EPSG:3857")
     arr = normalize_minmax(da, mask_value=0)
     name = str(da.name).capitalize().replace("_", " ")
 
@@ -219,12 +222,20 @@ def calc_bounds(da: xr.DataArray) -> list:
         The bounds of the dataset in the form of [[lat0, lon0], [lat1, lon1]]
     """
 
+    from ..templater.reproject import get_target_grid
+
     assert da.rio.crs is not None, "The dataset must have a crs assigned"
 
-    da_latlon = da.rio.reproject("EPSG:4326")
+    # the pixel centers of the grid that da.rio.reproject("EPSG:4326") would
+    # create, without reprojecting the data
+    grid = get_target_grid(da, "EPSG:4326")
+    a, _, c, _, e, f = grid["transform"]
+    ny, nx = grid["shape"]
+    lon = c + (np.array([0, nx - 1]) + 0.5) * a
+    lat = f + (np.array([0, ny - 1]) + 0.5) * e
     bounds = [
-        [da_latlon.y.min().item(), da_latlon.x.min().item()],
-        [da_latlon.y.max().item(), da_latlon.x.max().item()],
+        [lat.min().item(), lon.min().item()],
+        [lat.max().item(), lon.max().item()],
     ]
     return bounds
 
@@ -0,0 +1,39 @@
+import pathlib
+import shutil
+
+import numpy as np
+import pytest
+import xarray as xr
+
+TEMPLATES = pathlib.Path(__file__).parents[1] / "templates"
+
+
+def make_geospatial_data(ny=30, nx=20, seed=0) -> xr.Dataset:
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        dict(
+            elevation=(("y", "x"), rng.uniform(3000, 5000, (ny, nx))),
+            slope=(("y", "x"), rng.uniform(0, 40, (ny, nx))),
+            aspect=(("y", "x"), rng.uniform(0, 360, (ny, nx))),
+            albedo=(("y", "x"), rng.uniform(0.1, 0.9, (ny, nx))),
+            emissivity=(("y", "x"), rng.uniform(0.9, 1.0, (ny, nx))),
+            snow_index=(("y", "x"), rng.uniform(0, 365, (ny, nx))),
+            stratigraphy_index=(("y", "x"), rng.integers(0, 4, (ny, nx))),
+        ),
+        coords=dict(y=4.1e6 - 100 * np.arange(ny), x=5e5 + 100 * np.arange(nx)),
+    )
+    ds["elevation"][:3, :5] = np.nan
+    return ds.rio.write_crs("EPSG:32643")
+
+
+@pytest.fixture
+def run_path(tmp_path):
+    # a run folder with the cluster_spatial config and synthetic geospatial data
+    run_path = tmp_path / "run"
+    (run_path / "forcing").mkdir(parents=True)
+    shutil.copy(
+        TEMPLATES / "cluster_spatial" / "run_config.xlsx", run_path / "run.xlsx"
+    )
+    (run_path / "forcing" / "bbox.txt").write_text("70.0,37.0,70.03,37.03")
+    make_geospatial_data().to_netcdf(run_path / "forcing" / "geospatial_data.nc")
+    return run_path
@@ -0,0 +1,85 @@
+import numpy as np
+import xarray as xr
+from cryogrid_run_manager.templater.cache import BboxCache
+
+
+def make_dataset():
+    return xr.Dataset(
+        {"elevation": (("y", "x"), np.arange(12, dtype=np.float32).reshape(3, 4))}
+    )
+
+
+def test_get_counts_hits_and_misses(tmp_path):
+    cache = BboxCache(tmp_path, max_size_gb=1)
+    cache.put(make_dataset(), (70, 37, 71, 38), layer="elevation")
+
+    assert cache.get((70.2, 37.2, 70.8, 37.8), layer="elevation") is not None
+    assert cache.get((69, 37, 71, 38), layer="elevation") is None
+    assert cache.get((70.2, 37.2, 70.8, 37.8), layer="slope") is None
+
+    stats = cache.stats
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_record_access_of_an_evicted_entry(tmp_path):
+    cache = BboxCache(tmp_path, max_size_gb=1)
+    cache.put(make_dataset(), (70, 37, 71, 38), layer="elevation")
+
+    entry = cache.lookup((70, 37, 71, 38), layer="elevation")
+    cache.remove(entry["name"])  # e.g. evicted by another thread
+
+    assert not cache.record_access(entry)
+    stats = cache.stats
+    assert (stats["hits"], stats["misses"]) == (0, 1)
+
+
+def fetch_dem_grid(bbox, res_m=100):
+    # the grid of get_dem_copernicus30 without fetching any data: stackstac only
+    # needs the projection of the items to build the coordinates
+    import datetime
+
+    import pystac
+    import stackstac
+    from cryogrid_pytools.utils import drop_coords_without_dim
+    from cryogrid_run_manager.templater.data import DEM_EPSG
+
+    item = pystac.Item("dem", None, [60, 30, 80, 45], datetime.datetime(2021, 1, 1), {})
+    proj = {
+        "proj:epsg": 4326,
+        "proj:transform": [1 / 3600, 0, 60, 0, -1 / 3600, 45],
+        "proj:shape": [15 * 3600, 20 * 3600],
+    }
+    item.add_asset(
+        "data", pystac.Asset("dem.tif", media_type="image/tiff", extra_fields=proj)
+    )
+    da = stackstac.stack([item], bounds_latlon=bbox, resolution=res_m, epsg=DEM_EPSG)
+    return (
+        da.squeeze(drop=True)
+        .pipe(drop_coords_without_dim)
+        .drop_attrs()
+        .rio.write_crs(f"EPSG:{DEM_EPSG}")
+    )
+
+
+def test_cached_dem_is_on_the_grid_of_a_fresh_fetch(tmp_path):
+    from cryogrid_run_manager.templater.data import (
+        _get_cached_layer,
+        _put_cached_layer,
+    )
+
+    cache = BboxCache(tmp_path, max_size_gb=1)
+    keys = dict(res_m=100, crs="EPSG:32643")
+    grid = fetch_dem_grid((70.0, 37.0, 71.0, 38.0))
+    dem = xr.zeros_like(grid, dtype=np.float32).rename("elevation")
+    _put_cached_layer(cache, "elevation", dem, (70.0, 37.0, 71.0, 38.0), **keys)
+
+    bbox = (70.03, 37.02, 70.61, 37.55)
+    clipped = _get_cached_layer(cache, "elevation", bbox, **keys)
+    fresh = fetch_dem_grid(bbox)
+    np.testing.assert_array_equal(clipped.x, fresh.x)
+    np.testing.assert_array_equal(clipped.y, fresh.y)
+
+    # a DEM in another projection is not reused
+    assert (
+        _get_cached_layer(cache, "elevation", bbox, res_m=100, crs="EPSG:32642") is None
+    )
@@ -0,0 +1,321 @@
+import pathlib
+
+import numpy as np
+import pytest
+from cryogrid_run_manager.templater.clustering import (
+    FaissKMeans,
+    _get_elbow,
+    allocate_clusters,
+    cluster_memmap,
+    cluster_stratified,
+    find_closest_model,
+    load_kmeans_model,
+    precompute_clusters,
+    save_kmeans_model,
+    sweep_n_clusters,
+)
+
+
+def make_blobs(n_per_blob=500, n_blobs=4, n_features=3, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, size=(n_blobs, n_features))
+    X = np.concatenate([c + rng.normal(size=(n_per_blob, n_features)) for c in centers])
+    return X.astype(np.float32)
+
+
+def test_objective_is_the_one_of_the_best_restart():
+    X = make_blobs(n_blobs=8)
+
+    # with this seed, the second of the three restarts is the best
+    model = FaissKMeans(n_clusters=6, n_init=3, max_iter=20, seed=1).fit(X)
+    first = FaissKMeans(n_clusters=6, n_init=1, max_iter=20, seed=1).fit(X)
+
+    assert model.objective_.shape == (20,)
+    assert model.objective_[-1] < first.objective_[-1]
+    report = model.convergence_report()
+    assert report["n_iter"] == 20
+    assert report["objective_last"] == model.objective_[-1]
+
+
+def test_inertia_is_the_one_of_the_best_restart():
+    X = make_blobs(n_blobs=8)
+
+    # with this seed, the second of the three restarts is the best
+    model = FaissKMeans(n_clusters=6, n_init=3, max_iter=20, seed=1).fit(X)
+    first = FaissKMeans(n_clusters=6, n_init=1, max_iter=20, seed=1).fit(X)
+
+    assert model.inertia_ == model.objective_[-1] < first.inertia_
+    assert model.score(type="elbow") == model.inertia_
+
+
+def test_sweep_n_clusters_scores_each_k():
+    X = make_blobs()
+
+    df, k_best = sweep_n_clusters(X, n_clusters=[2, 3, 4, 5, 6], max_workers=2)
+
+    assert df.index.tolist() == [2, 3, 4, 5, 6]
+    assert {"inertia", "silhouette", "davies_bouldin"} <= set(df.columns)
+    # the inertia drops with k, and the 4 blobs are found
+    assert df["inertia"].is_monotonic_decreasing
+    assert k_best == 4
+
+
+def test_sweep_n_clusters_elbow():
+    X = make_blobs()
+
+    df, k_best = sweep_n_clusters(X, n_clusters=range(2, 9), criterion="elbow")
+
+    assert k_best == _get_elbow(df.index.values, df["inertia"].values)
+    assert k_best == 4
+
+
+def test_get_elbow():
+    # the inertia drops steeply until k=6 and is almost flat after
+    k = np.arange(2, 21)
+    inertia = np.where(k <= 6, 100 - 20 * (k - 2), 20 - 0.5 * (k - 6)).astype(float)
+
+    assert _get_elbow(k, inertia) == 6
+
+
+def test_get_elbow_is_scale_invariant():
+    k = np.arange(2, 21)
+    inertia = 1 / k**2
+
+    assert _get_elbow(k, inertia) == _get_elbow(k * 10, inertia * 1e6) / 10
+
+
+def test_predict_in_chunks():
+    X = make_blobs()
+    model = FaissKMeans(n_clusters=4, n_init=1).fit(X)
+
+    labels = model.predict(X)
+    distance = np.empty((X.shape[0], 1), dtype=np.float32)
+    model.chunk_size = 333
+    np.testing.assert_array_equal(model.predict(X, out_distance=distance), labels)
+    assert (distance >= 0).all()
+
+
+def test_fit_minibatch_finds_the_blobs():
+    from sklearn.metrics import adjusted_rand_score
+
+    X = make_blobs()
+    truth = np.repeat(np.arange(4), 500)
+
+    kwargs = dict(n_clusters=4, n_init=3, max_points_per_centroid=50)
+    sampled = FaissKMeans(**kwargs).fit(X)
+    model = FaissKMeans(**kwargs).fit_minibatch(X, batch_size=256, n_epochs=2)
+
+    # the mini-batches refine the centroids of the sample (in the same order)
+    assert adjusted_rand_score(truth, model.predict(X).ravel()) == 1
+    np.testing.assert_allclose(
+        model.cluster_centers_, sampled.cluster_centers_, atol=0.5
+    )
+
+
+def test_cluster_memmap_equals_in_memory(tmp_path):
+    X = make_blobs()
+    np.save(tmp_path / "features.npy", X)
+
+    model, labels = cluster_memmap(
+        tmp_path / "features.npy", 4, n_init=1, chunk_size=300
+    )
+    expected = FaissKMeans(n_clusters=4, n_init=1).fit(X).predict(X)
+
+    assert (tmp_path / "labels.npy").exists()
+    np.testing.assert_array_equal(labels, expected.ravel())
+
+
+def test_precompute_clusters(run_path):
+    import scipy.io
+    import xarray as xr
+
+    exclude = dict(stratigraphy_index=[0])
+    ds_clusters = precompute_clusters(run_path, n_clusters=5, exclude=exclude)
+
+    ds = xr.open_dataset(run_path / "forcing" / "geospatial_data.nc")
+    mat = scipy.io.loadmat(run_path / "forcing" / "clusters.mat")
+    clustered = ds.elevation.notnull() & (ds.stratigraphy_index != 0)
+    # pixels that are NaN or excluded have no cluster (0)
+    np.testing.assert_array_equal(mat["cluster_number"] > 0, clustered.values)
+    np.testing.assert_array_equal(mat["cluster_number"], ds_clusters.cluster_number)
+    assert set(np.unique(mat["cluster_number"])) == set(range(6))
+    assert mat["exclude"][0] == '{"stratigraphy_index": [0]}'
+    assert mat["signature"][0] == (
+        "CLUSTER_RAW_VARIABLES_1(altitude,stratigraphy_index);CLUSTER_SLOPE_ASPECT_1;"
+    )
+
+    # the sample centroid of each cluster is one of its pixels
+    numbers = ds_clusters.cluster_number.sel(
+        x=ds_clusters.sample_centroid_x, y=ds_clusters.sample_centroid_y
+    )
+    np.testing.assert_array_equal(numbers, ds_clusters.cluster)
+
+
+def test_precompute_clusters_without_exclude(run_path):
+    import scipy.io
+
+    precompute_clusters(run_path, n_clusters=5)
+
+    mat = scipy.io.loadmat(run_path / "forcing" / "clusters.mat")
+    assert mat["exclude"].size == 0
+
+
+def test_allocate_clusters_hands_out_the_budget():
+    counts = np.array([1000, 500, 200, 50])
+    std = np.array([1.0, 2.0, 0.5, 3.0])
+
+    k = allocate_clusters(counts, std, n_clusters=40)
+
+    assert k.sum() == 40
+    assert (k >= 1).all()
+    assert (k <= counts).all()
+    # the largest counts * std gets the most clusters
+    assert k.argmax() == np.argmax(counts * std)
+
+
+def test_allocate_clusters_without_spread():
+    # the first stratum is full after 5 clusters and the second has no spread,
+    # so the rest is split by the counts
+    counts = np.array([5, 1000])
+    std = np.array([1.0, 0.0])
+
+    k = allocate_clusters(counts, std, n_clusters=20)
+
+    assert k.tolist() == [5, 15]
+
+
+def test_allocate_clusters_min_clusters():
+    counts = np.array([10_000, 10, 10])
+    std = np.array([1.0, 1.0, 1.0])
+
+    k = allocate_clusters(counts, std, n_clusters=12, min_clusters=3)
+
+    assert k.sum() == 12
+    assert (k >= 3).all()
+
+
+def test_allocate_clusters_fewer_pixels_than_clusters():
+    k = allocate_clusters(np.array([2, 3]), np.array([1.0, 1.0]), n_clusters=10)
+
+    assert k.tolist() == [2, 3]
+
+
+def test_allocate_clusters_budget_too_small():
+    with pytest.raises(ValueError):
+        allocate_clusters(
+            np.array([10, 10, 10]), np.ones(3), n_clusters=5, min_clusters=2
+        )
+
+
+def test_cluster_stratified():
+    X = make_blobs(n_blobs=6)
+    strata = np.repeat([3, 1, 2], 1000)  # two blobs per stratum
+
+    labels, distance, df = cluster_stratified(X, strata, n_clusters=6, n_init=3)
+
+    assert df.index.tolist() == [1, 2, 3]
+    assert df["n_clusters"].sum() == 6
+    assert (distance >= 0).all()
+    # the labels of each stratum are its own, offset by the strata before it
+    for stratum, offset, k in zip(df.index, df["offset"], df["n_clusters"]):
+        stratum_labels = np.unique(labels[strata == stratum])
+        assert stratum_labels.tolist() == list(range(offset, offset + k))
+
+
+def test_cluster_stratified_in_chunks():
+    X = make_blobs(n_blobs=6)
+    strata = np.tile([0, 1], 1500)
+
+    labels, _, _ = cluster_stratified(X, strata, n_clusters=6, n_init=1)
+    chunked, _, _ = cluster_stratified(
+        X, strata, n_clusters=6, n_init=1, chunk_size=333
+    )
+
+    np.testing.assert_array_equal(chunked, labels)
+
+
+def test_precompute_clusters_stratified(run_path):
+    import xarray as xr
+
+    ds_clusters = precompute_clusters(
+        run_path, n_clusters=8, stratify_by="stratigraphy_index"
+    )
+
+    ds = xr.open_dataset(run_path / "forcing" / "geospatial_data.nc")
+    numbers = ds_clusters.cluster_number.values
+    strata = ds.stratigraphy_index.values
+    assert set(np.unique(numbers[numbers > 0])) == set(range(1, 9))
+    # no cluster spans two strata
+    for number in range(1, 9):
+        assert np.unique(strata[numbers == number]).size == 1
+
+
+def make_neighbour(run_path, name, bbox):
+    # a copy of the run with another bbox: the data shifted by 5 columns
+    import shutil
+
+    import xarray as xr
+
+    neighbour = run_path.with_name(name)
+    shutil.copytree(run_path, neighbour)
+    (neighbour / f"{run_path.name}.xlsx").rename(neighbour / f"{name}.xlsx")
+    (neighbour / "forcing" / "bbox.txt").write_text(",".join(map(str, bbox)))
+    fname = neighbour / "forcing" / "geospatial_data.nc"
+    ds = xr.load_dataset(fname)
+    shifted = ds.roll(x=5, roll_coords=False)
+    rng = np.random.default_rng(1)
+    shifted["elevation"] += rng.normal(scale=10, size=ds.elevation.shape)
+    shifted.to_netcdf(fname)
+    return neighbour
+
+
+def test_find_closest_model(run_path):
+    from cryogrid_run_manager.templater.features import FeatureStore
+
+    features = FeatureStore(run_path).get(["elevation", "slope"])
+    models = {k: FaissKMeans(n_clusters=k, n_init=1).fit(features.X) for k in [3, 4]}
+    # the run is at 70.0, 37.0, 70.03, 37.03
+    runs = dict(
+        half=((70.015, 37.0, 70.045, 37.03), 3),
+        quarter=((70.015, 37.015, 70.045, 37.045), 3),
+        same_bbox_other_k=((70.0, 37.0, 70.03, 37.03), 4),
+        far=((71.0, 38.0, 71.03, 38.03), 3),
+    )
+    for name, (bbox, k) in runs.items():
+        neighbour = run_path.with_name(name)
+        (neighbour / "forcing").mkdir(parents=True)
+        (neighbour / "forcing" / "bbox.txt").write_text(",".join(map(str, bbox)))
+        save_kmeans_model(neighbour, models[k], features)
+
+    closest = find_closest_model(run_path, ["elevation", "slope"], 3)
+    assert closest["fname"].parents[2].name == "half"
+    assert closest["bbox"] == list(runs["half"][0])
+    assert find_closest_model(run_path, ["elevation", "slope"], 4) is not None
+    assert find_closest_model(run_path, ["elevation"], 3) is None
+
+    # without overlap, the nearest run
+    far_run = make_neighbour(run_path, "far_run", (71.1, 38.1, 71.13, 38.13))
+    closest = find_closest_model(far_run, ["elevation", "slope"], 3)
+    assert closest["fname"].parents[2].name == "far"
+
+
+def test_warm_start_keeps_the_cluster_numbers(run_path):
+    neighbour = make_neighbour(run_path, "neighbour", (70.01, 37.0, 70.04, 37.03))
+    precompute_clusters(run_path, n_clusters=5)
+    precompute_clusters(neighbour, n_clusters=5, warm_start=True)
+
+    fname = pathlib.Path("forcing") / "clustering" / "kmeans_model.npz"
+    model = load_kmeans_model(run_path / fname)
+    warm = load_kmeans_model(neighbour / fname)
+    assert warm["report"]["warm_start"]
+
+    # cluster i of the neighbour is the closest to cluster i of the run
+    centroids = model["centroids_raw"] / model["std"]
+    warm_centroids = warm["centroids_raw"] / model["std"]
+    distance = np.linalg.norm(warm_centroids[:, None] - centroids[None], axis=2)
+    np.testing.assert_array_equal(distance.argmin(axis=1), np.arange(5))
+
+    with pytest.raises(ValueError, match="stratify_by"):
+        precompute_clusters(
+            neighbour, warm_start=True, stratify_by="stratigraphy_index"
+        )
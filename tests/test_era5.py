@@ -0,0 +1,168 @@
+import numpy as np
+import pytest
+from cryogrid_run_manager.templater.data import get_era5_from_s3_bucket
+from cryogrid_run_manager.templater.era5 import (
+    ERA5Source,
+    _is_compact_mat,
+    _save_mat_v73,
+    era5_to_matlab_streaming,
+    extend_era5_mat,
+    load_era5_mat,
+    make_synthetic_era5_stores,
+    read_era5_coverage,
+    save_era5_mat,
+)
+
+BBOX = (70.0, 37.0, 71.0, 38.0)
+BBOX_STORES = (69.0, 36.0, 72.0, 39.0)
+
+
+@pytest.fixture(scope="module")
+def source():
+    source = ERA5Source.in_memory(name="era5-test")
+    return make_synthetic_era5_stores(source, [2020, 2021], bbox=BBOX_STORES, res=0.5)
+
+
+def stream(source, time_start, time_end, save_path):
+    return era5_to_matlab_streaming(
+        BBOX,
+        time_start,
+        time_end,
+        save_path,
+        source=source,
+        progress_callback=lambda *args: None,
+    )
+
+
+def make_era(n_times=9000):
+    # an era-like struct that spans more than one slab of _save_mat_v73
+    rng = np.random.default_rng(0)
+    return dict(
+        t=738000.5 + np.arange(n_times) / 24,
+        T2=rng.normal(size=(2, 3, n_times)),
+        wind=rng.integers(-100, 100, size=(2, 3, n_times)).astype(np.int16),
+        Zs=rng.normal(size=(2, 3)).astype(np.float32),
+        dt=1 / 24,
+        dims="lon x lat x time",
+    )
+
+
+def assert_era_equal(actual, expected):
+    assert set(actual) == set(expected)
+    for key, value in expected.items():
+        if isinstance(value, str):
+            assert actual[key] == value
+        else:
+            assert actual[key].dtype == value.dtype, key
+            np.testing.assert_array_equal(actual[key], value, err_msg=key)
+
+
+def test_save_mat_v73_roundtrip(tmp_path):
+    era = make_era()
+    fname = tmp_path / "era5.mat"
+
+    _save_mat_v73(fname, "era", era, single=False)
+
+    # the same shapes as scipy.io.loadmat: scalars are 1x1, 1-D arrays rows
+    expected = dict(era, t=era["t"][None], dt=np.array([[era["dt"]]]))
+    assert_era_equal(load_era5_mat(fname), expected)
+    assert not _is_compact_mat(fname)
+
+
+def test_save_mat_v73_single(tmp_path):
+    era = make_era()
+    fname = tmp_path / "era5.mat"
+
+    _save_mat_v73(fname, "era", era, single=True)
+    loaded = load_era5_mat(fname)
+
+    # the datenum keeps its precision, the other floats are float32
+    np.testing.assert_array_equal(loaded["t"], era["t"][None])
+    assert loaded["t"].dtype == np.float64
+    np.testing.assert_array_equal(loaded["T2"], era["T2"].astype(np.float32))
+    assert loaded["T2"].dtype == np.float32
+    assert _is_compact_mat(fname)
+
+
+def test_save_era5_mat_formats_load_the_same(tmp_path):
+    era = make_era(n_times=100)
+
+    save_era5_mat(era, tmp_path / "v5.mat")
+    save_era5_mat(era, tmp_path / "v73.mat", compact=True)
+
+    v5 = load_era5_mat(tmp_path / "v5.mat")
+    v73 = load_era5_mat(tmp_path / "v73.mat")
+    assert set(v73) == set(v5)
+    assert v73["dims"] == v5["dims"]
+    for key in ["t", "wind", "Zs"]:
+        np.testing.assert_array_equal(v73[key], v5[key], err_msg=key)
+    np.testing.assert_allclose(v73["T2"], v5["T2"], rtol=1e-6)
+
+
+def test_list_years(tmp_path):
+    source = ERA5Source.from_directory(tmp_path)
+    make_synthetic_era5_stores(source, [2020, 2022], bbox=BBOX_STORES, res=1.0)
+
+    assert source.list_years() == [2020, 2022]
+
+
+def test_list_years_loads_the_credentials(monkeypatch):
+    def check_credentials(self):
+        raise FileNotFoundError("no .env")
+
+    monkeypatch.setattr(ERA5Source, "check_credentials", check_credentials)
+    source = ERA5Source("s3://era5-bucket/era5_{year}.zarr")
+
+    # the credentials are loaded before the bucket is listed
+    with pytest.raises(FileNotFoundError, match="no .env"):
+        source.list_years()
+
+
+@pytest.mark.parametrize("time_end", ["2021-01-31", "2021-01-31 12:00"])
+def test_extend_era5_mat_equals_fresh(tmp_path, source, time_end):
+    fresh = stream(source, "2020-01-01", time_end, tmp_path / "fresh.mat")
+
+    # the existing file only covers the second half of 2020
+    fname = stream(source, "2020-07-01", "2020-12-31", tmp_path / "extended.mat")
+    extend_era5_mat(
+        fname,
+        BBOX,
+        "2020-01-01",
+        time_end,
+        source=source,
+        progress_callback=lambda *args: None,
+    )
+
+    assert_era_equal(load_era5_mat(fname), load_era5_mat(fresh))
+    assert read_era5_coverage(fname)["n_times"] == read_era5_coverage(fresh)["n_times"]
+
+
+def test_extend_legacy_era5_mat_forward(tmp_path, source):
+    from cryogrid_pytools.forcing import era5_to_matlab
+
+    fresh = stream(source, "2020-01-01", "2020-12-31", tmp_path / "fresh.mat")
+
+    # a MATLAB v5 file without a manifest, as written before the streaming writer
+    fname = tmp_path / "era5.mat"
+    ds = get_era5_from_s3_bucket(BBOX, "2020-01-01", "2020-06-30", source=source)
+    era5_to_matlab(ds, save_path=str(fname))
+    extend_era5_mat(
+        fname,
+        BBOX,
+        "2020-01-01",
+        "2020-12-31",
+        source=source,
+        progress_callback=lambda *args: None,
+    )
+
+    assert_era_equal(load_era5_mat(fname), load_era5_mat(fresh))
+
+
+def test_extend_era5_mat_covered(tmp_path, source):
+    fname = stream(source, "2020-01-01", "2020-03-31", tmp_path / "era5.mat")
+    mtime = fname.stat().st_mtime_ns
+
+    # the file ends at 23:00 of the last day, which covers the date as the end
+    extend_era5_mat(fname, BBOX, "2020-02-01", "2020-03-31", source=source)
+
+    assert fname.stat().st_mtime_ns == mtime
@@ -0,0 +1,92 @@
+import numpy as np
+import xarray as xr
+from cryogrid_run_manager.templater.features import (
+    CLUSTER_VARIABLES,
+    FeatureStore,
+    labels_to_grid,
+    make_feature_memmap,
+)
+
+
+def test_make_feature_memmap(run_path, tmp_path):
+    fname = run_path / "forcing" / "geospatial_data.nc"
+
+    features, pixel_index = make_feature_memmap(
+        fname, ["elevation", "aspect_cos"], tmp_path / "features", chunk_rows=7
+    )
+
+    ds = xr.open_dataset(fname)
+    valid = np.isfinite(ds.elevation.values.ravel())
+    assert isinstance(features, np.memmap)
+    assert features.dtype == np.float32
+    np.testing.assert_array_equal(pixel_index, np.flatnonzero(valid))
+    np.testing.assert_allclose(
+        features[:, 0], ds.elevation.values.ravel()[valid], rtol=1e-6
+    )
+    np.testing.assert_allclose(
+        features[:, 1], np.cos(np.deg2rad(ds.aspect.values.ravel()[valid])), atol=1e-6
+    )
+
+    # the NaN pixels are back as the fill value
+    grid = labels_to_grid(np.arange(pixel_index.size), pixel_index, ds.elevation)
+    assert (grid.values[:3, :5] == -1).all()
+    assert grid.values.ravel()[pixel_index].tolist() == list(range(pixel_index.size))
+
+
+def test_make_feature_memmap_exclude(run_path, tmp_path):
+    fname = run_path / "forcing" / "geospatial_data.nc"
+
+    _, pixel_index = make_feature_memmap(
+        fname, ["slope"], tmp_path, exclude=dict(stratigraphy_index=[0, 2])
+    )
+
+    ds = xr.open_dataset(fname)
+    strata = ds.stratigraphy_index.values.ravel()
+    np.testing.assert_array_equal(pixel_index, np.flatnonzero(strata % 2 == 1))
+
+
+def test_feature_store_reuses_the_features(run_path):
+    store = FeatureStore(run_path)
+
+    features = store.get()
+    mtime = (features.path / "features.npy").stat().st_mtime_ns
+    again = store.get()
+
+    assert again.path == features.path
+    assert (again.path / "features.npy").stat().st_mtime_ns == mtime
+    assert again.variables == list(CLUSTER_VARIABLES) == features.variables
+    assert "aspect" not in again.variables
+
+    # other variables or exclusions are stored separately
+    assert store.get(["slope"]).path != features.path
+    excluded = store.get(exclude=dict(stratigraphy_index=[0]))
+    assert excluded.path != features.path
+    assert excluded.X.shape[0] < features.X.shape[0]
+
+
+def test_feature_store_rebuilds_after_a_change(run_path):
+    store = FeatureStore(run_path)
+    features = store.get(dict(elevation=2.0, slope=1.0))
+    mtime = (features.path / "features.npy").stat().st_mtime_ns
+
+    fname = run_path / "forcing" / "geospatial_data.nc"
+    ds = xr.load_dataset(fname)
+    ds["elevation"] += 10
+    ds.to_netcdf(fname)
+    rebuilt = store.get(dict(elevation=2.0, slope=1.0))
+
+    assert rebuilt.path == features.path
+    assert (rebuilt.path / "features.npy").stat().st_mtime_ns != mtime
+    np.testing.assert_allclose(rebuilt.mean, features.mean + np.array([10, 0]))
+
+
+def test_feature_matrix_scaler(run_path):
+    features = FeatureStore(run_path).get(dict(elevation=2.0, slope=1.0))
+
+    X = np.asarray(features.X, dtype=np.float64)
+    np.testing.assert_allclose(X.mean(axis=0), 0, atol=1e-4)
+    np.testing.assert_allclose(X.std(axis=0), [2, 1], rtol=1e-4)
+
+    raw = np.stack([features.read("elevation"), features.read("slope")], axis=1)
+    np.testing.assert_allclose(features.transform(raw), X, atol=1e-5)
+    np.testing.assert_allclose(features.inverse_transform(X), raw, atol=1e-3)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import xarray as xr
+from cryogrid_run_manager.templater.reproject import (
+    ReprojectionPlan,
+    get_grid,
+    get_target_grid,
+    reproject_with_plan,
+)
+
+
+def make_raster(ny=60, nx=80, res=0.01, x0=72.0, y0=39.0, crs="EPSG:4326", bands=None):
+    rng = np.random.default_rng(0)
+    shape = (ny, nx) if bands is None else (bands, ny, nx)
+    dims = ("y", "x") if bands is None else ("band", "y", "x")
+    coords = dict(
+        y=y0 - (np.arange(ny) + 0.5) * res,
+        x=x0 + (np.arange(nx) + 0.5) * res,
+    )
+    if bands is not None:
+        coords["band"] = np.arange(1, bands + 1)
+    da = xr.DataArray(
+        rng.integers(1, 200, size=shape).astype(np.float32), coords=coords, dims=dims
+    )
+    return da.rio.write_crs(crs)
+
+
+def test_plan_matches_rio_reproject():
+    from rasterio.enums import Resampling
+
+    da = make_raster()
+    dst_crs = "EPSG:32643"  # UTM 43N
+
+    # tolerance=0: GDAL transforms every pixel exactly, as the plan does
+    expected = da.rio.reproject(
+        dst_crs, resampling=Resampling.nearest, nodata=np.nan, tolerance=0
+    )
+    plan = ReprojectionPlan.from_grids(get_grid(da), get_target_grid(da, dst_crs))
+    actual = plan.apply(da, resampling="nearest")
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual.x, expected.x)
+    np.testing.assert_allclose(actual.y, expected.y)
+    np.testing.assert_array_equal(actual.values, expected.values)
+
+
+def test_plan_matches_rio_reproject_match():
+    from rasterio.enums import Resampling
+
+    da = make_raster(bands=3)
+    match = make_raster(ny=45, nx=50, res=0.013, x0=72.1, y0=38.95)
+
+    expected = da.rio.reproject_match(
+        match, resampling=Resampling.nearest, nodata=np.nan, tolerance=0
+    )
+    actual = reproject_with_plan(da, match=match, use_cache=False)
+
+    assert actual.dims == expected.dims
+    np.testing.assert_array_equal(actual.values, expected.values)
+
+
+def test_plan_save_load_roundtrip(tmp_path):
+    da = make_raster()
+    plan = ReprojectionPlan.from_grids(get_grid(da), get_target_grid(da, "EPSG:32643"))
+
+    plan.save(tmp_path / "plan.npz")
+    loaded = ReprojectionPlan.load(tmp_path / "plan.npz")
+
+    assert loaded.src_grid == plan.src_grid
+    assert loaded.dst_grid == plan.dst_grid
+    np.testing.assert_array_equal(loaded.rows, plan.rows)
+    np.testing.assert_array_equal(loaded.cols, plan.cols)
+
+
+def test_plan_rejects_other_source_grid():
+    da = make_raster()
+    plan = ReprojectionPlan.from_grids(get_grid(da), get_grid(make_raster(nx=40)))
+
+    with pytest.raises(ValueError):
+        plan.apply(make_raster(nx=81))
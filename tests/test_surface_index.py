@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import xarray as xr
+from cryogrid_run_manager.templater.surface_index import (
+    exchage_values,
+    make_lookup_table,
+    remap_values,
+)
+
+
+@pytest.fixture
+def surface_index():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 5, size=(50, 40)).astype(np.uint8)
+    return xr.DataArray(data, dims=("y", "x"), name="surface_index")
+
+
+def test_remap_values_matches_exchage_values(surface_index):
+    # exchage_values offsets the values by max + 1 = 5, so the new values must
+    # not be 5 to 9 (they would be exchanged again)
+    mappings = dict(
+        stratigraphy={0: 1, 1: 3, 2: 12, 3: 3, 4: 10},
+        albedo={0: 0.2, 1: 0.35, 2: 0.15, 3: 0.25, 4: 0.3},
+    )
+
+    ds = remap_values(surface_index, mappings)
+
+    for name, mapping in mappings.items():
+        expected = exchage_values(surface_index, mapping).values
+        np.testing.assert_allclose(ds[name].values, expected, rtol=1e-6)
+    assert ds["stratigraphy"].dtype == np.uint8
+    assert ds["albedo"].dtype == np.float32
+
+
+def test_remap_values_keeps_unmapped_values(surface_index):
+    ds = remap_values(surface_index, dict(partial={1: 9}))
+
+    expected = np.where(surface_index.values == 1, 9, surface_index.values)
+    np.testing.assert_array_equal(ds["partial"].values, expected)
+
+
+def test_remap_values_dtypes(surface_index):
+    ds = remap_values(surface_index, dict(index={1: 2}), dtypes=dict(index=np.int16))
+
+    assert ds["index"].dtype == np.int16
+
+
+def test_remap_values_needs_integers(surface_index):
+    with pytest.raises(TypeError):
+        remap_values(surface_index.astype(float), dict(index={1: 2}))
+
+
+def test_make_lookup_table():
+    lut = make_lookup_table({0: 3, 2: 1})
+
+    assert lut.dtype == np.uint8
+    assert lut.size == 256
+    assert lut[[0, 1, 2, 3]].tolist() == [3, 1, 1, 3]
+
+    assert make_lookup_table({0: 0.5}).dtype == np.float32
+    with pytest.raises(ValueError):
+        make_lookup_table({256: 1})
@@ -0,0 +1,70 @@
+import cryogrid_pytools
+import pytest
+from cryogrid_run_manager import templater
+from cryogrid_run_manager.templater import data, files_n_folders, plotting
+
+DATA_OPTIONS = dict(
+    stream_era5=True,
+    extend_era5=True,
+    use_store=True,
+    compact_era5=True,
+    compact_geospatial=True,
+    pyramid_res_m=30,
+    tile_size=512,
+)
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = {}
+
+    def make_data_for_cluster_run(run_path, **kwargs):
+        calls["run"] = kwargs
+        return run_path / "forcing" / "bbox.txt", run_path / f"{run_path.name}.xlsx"
+
+    def make_data_for_cluster_run_variants(run_paths, samplings, **kwargs):
+        calls["variants"] = kwargs
+        return [(p / "forcing" / "bbox.txt", p / f"{p.name}.xlsx") for p in run_paths]
+
+    monkeypatch.setattr(data, "make_data_for_cluster_run", make_data_for_cluster_run)
+    monkeypatch.setattr(
+        data, "make_data_for_cluster_run_variants", make_data_for_cluster_run_variants
+    )
+    monkeypatch.setattr(
+        files_n_folders, "make_run_folder_structure", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(plotting, "make_forcing_plots", lambda run_path: None)
+    monkeypatch.setattr(cryogrid_pytools, "CryoGridConfigExcel", lambda path: None)
+    return calls
+
+
+def test_new_cluster_run_passes_the_data_options(tmp_path, calls):
+    templater.new_cluster_run(
+        (70.0, 37.0, 71.0, 38.0),
+        run_name="{id}-{bbox_str}",
+        runs_dir=tmp_path,
+        id="test",
+        **DATA_OPTIONS,
+    )
+
+    assert calls["run"] == dict(res_m=30, sampling="random", **DATA_OPTIONS)
+
+
+def test_new_cluster_run_variants_passes_the_data_options(tmp_path, calls):
+    templater.new_cluster_run_variants(
+        (70.0, 37.0, 71.0, 38.0),
+        samplings=["random", "mode"],
+        run_name="{bbox_str}-{sampling}",
+        runs_dir=tmp_path,
+        **DATA_OPTIONS,
+    )
+
+    assert calls["variants"] == dict(res_m=30, **DATA_OPTIONS)
+
+
+def test_make_data_for_cluster_run_takes_the_data_options():
+    import inspect
+
+    parameters = inspect.signature(data.make_data_for_cluster_run).parameters
+
+    assert set(DATA_OPTIONS) <= set(parameters)